@@ -1,8 +1,22 @@
-import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 from prompt import build_answer_adjustment_prompt
-from utils import initialize_client, safe_inference
+from answer_normalizer import AnswerNormalizer
+from utils import (
+    CacheMissError,
+    initialize_client,
+    initialize_response_cache,
+    initialize_metrics,
+    safe_inference,
+    call_context,
+    open_checkpoint,
+    checkpoint_is_stale,
+    select_json_items,
+    iter_completed,
+    metrics_report
+)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -17,53 +31,102 @@ def extract_adjusted_answer(response):
         return match.group(1).strip()
     return response  # Return full response if tags not found
 
-def process_item_adjustment(item, template_content, model):
+def process_item_adjustment(item, template_content, model, max_retries=5, retry_delay=2):
     """Process a single item for answer format adjustment."""
     logger.info(f"Processing item {item.get('index', 'unknown')} for format adjustment")
     
     prompt = build_answer_adjustment_prompt(item, template_content)
-    response = safe_inference(prompt, model)
+    with call_context(stage="adjust", index=item.get('index')):
+        response = safe_inference(prompt, model, max_retries=max_retries, retry_delay=retry_delay)
+    if response.startswith("ERROR:"):
+        raise RuntimeError(response)
     adjusted_answer = extract_adjusted_answer(response)
     
     # Update item with adjusted answer
     item['adjusted_answer'] = adjusted_answer
     item['original_answer'] = item.get('prediction', item.get('answer', ''))
+    item['adjusted_by'] = 'llm'
     
     return item
 
-def run_answer_adjustment(json_path, template_path, output_path, model):
-    """Run answer format adjustment process."""
-    # Load prediction data
-    with open(json_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
+def run_answer_adjustment(json_path, template_path, output_path, model, compact_every=50, max_workers=1,
+                          retry_failed=False, max_retries=5, retry_delay=2, normalize_locally=False):
+    """
+    Run answer format adjustment process.
+
+    Adjusted items are appended to the JSONL checkpoint next to `output_path`,
+    which is compacted into the sorted JSON output every `compact_every` items
+    and at the end. Items that already have an 'adjusted_answer' are skipped.
+    With `retry_failed`, only items stored with an error are re-run, replacing
+    their failed rows. With `normalize_locally`, answers that the rule-based
+    AnswerNormalizer (compiled from the template) can format confidently are
+    adjusted without an LLM call; only the rest are sent to the model.
+
+    Returns the number of items in the output file.
+    """
     # Load answer template
     with open(template_path, 'r', encoding='utf-8') as f:
         template_content = f.read()
     
-    logger.info(f"Starting answer format adjustment for {len(data)} items")
+    # Breakpoint resume: keep adjusted items, re-run missing and failed ones
+    checkpoint = open_checkpoint(output_path, output_field='adjusted_answer')
+    if retry_failed:
+        failed = checkpoint.failed_indices()
+        total, remaining, pending = select_json_items(json_path, failed, exclude=False)
+        logger.info(f"Retrying {remaining} failed items out of {total}")
+    else:
+        done = checkpoint.completed_indices()
+        # Items are streamed from the prediction file rather than loaded all at once
+        total, remaining, pending = select_json_items(json_path, done)
+        logger.info(f"Starting answer format adjustment for {total} items")
+        logger.info(f"Items remaining to adjust: {remaining}")
     logger.info(f"Using template from: {template_path}")
+
+    if not remaining:
+        if checkpoint_is_stale(checkpoint, output_path):
+            checkpoint.compact(output_path)
+        logger.info("Nothing left to adjust according to the output file. Exiting.")
+        return len(checkpoint)
     
-    # Process each item
-    adjusted_data = []
-    for i, item in enumerate(data):
-        logger.info(f"Processing item {i+1}/{len(data)}")
-        try:
-            adjusted_item = process_item_adjustment(item, template_content, model)
-            adjusted_data.append(adjusted_item)
-            
-            # Save intermediate results after each item
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(adjusted_data, f, ensure_ascii=False, indent=4)
-                
-        except Exception as e:
-            logger.error(f"Error processing item {item.get('index', i)}: {e}")
-            # Add error item to maintain order
-            item['error'] = str(e)
-            adjusted_data.append(item)
+    normalizer = AnswerNormalizer.from_template(template_content) if normalize_locally else None
+
+    # Process each item; max_workers=1 keeps the original one-at-a-time behaviour
+    def adjust_item(item):
+        if normalizer is not None:
+            adjusted_answer = normalizer.normalize(item)
+            if adjusted_answer is not None:
+                item['adjusted_answer'] = adjusted_answer
+                item['original_answer'] = item.get('prediction', item.get('answer', ''))
+                item['adjusted_by'] = 'rules'
+                return item
+        return process_item_adjustment(item, template_content, model, max_retries, retry_delay)
+
+    with checkpoint, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        progress = tqdm(iter_completed(executor, adjust_item, pending, 2 * max_workers),
+                        total=remaining, desc="Adjusting Items")
+        for n, (item, future) in enumerate(progress, 1):
+            try:
+                checkpoint.append(future.result())
+            except CacheMissError as e:
+                # Replay mode: leave the item unprocessed instead of storing an error row
+                logger.warning(f"Skipping item {item['index']}: {e}")
+            except Exception as e:
+                logger.error(f"Error processing item {item['index']}: {e}")
+                # Keep the error item so the output stays complete; it is retried on resume
+                # or by a retry_failed pass
+                item['error'] = str(e)
+                checkpoint.append(item)
+
+            # Periodically refresh the JSON output from the checkpoint
+            if n % compact_every == 0:
+                checkpoint.compact(output_path)
     
+    total = checkpoint.compact(output_path)
+    if normalizer is not None:
+        logger.info(normalizer.report())
     logger.info(f"Answer format adjustment completed. Results saved to {output_path}")
-    return adjusted_data
+    logger.info(f"Call metrics for this run:\n{metrics_report()}")
+    return total
 
 if __name__ == '__main__':
     # Initialize the client
@@ -71,9 +134,20 @@ if __name__ == '__main__':
         base_url="",
         api_key="",
     )
+
+    # Serve identical requests from the on-disk response cache
+    initialize_response_cache("./outputs/llm_cache")
+
+    # Record per-call latency and token usage
+    initialize_metrics("./outputs/metrics.jsonl")
     
     # Configuration
     model = 'o4-mini'
+    normalize_locally = True  # Format plain numeric answers with local rules; only the rest go to the LLM
+    retry_failed = False  # Only re-run items stored with an error, with the settings below
+    retry_workers = 2
+    retry_max_retries = 8
+    retry_delay = 10
     input_path = './outputs/prediction_refined.json'
     template_path = './outputs/answer_template.txt'
     output_path = './outputs/prediction_refined_adjusted.json'
@@ -81,4 +155,9 @@ if __name__ == '__main__':
     # Ensure output directory exists
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     
-    run_answer_adjustment(input_path, template_path, output_path, model)
+    if retry_failed:
+        run_answer_adjustment(input_path, template_path, output_path, model, max_workers=retry_workers,
+                              retry_failed=True, max_retries=retry_max_retries, retry_delay=retry_delay,
+                              normalize_locally=normalize_locally)
+    else:
+        run_answer_adjustment(input_path, template_path, output_path, model, normalize_locally=normalize_locally)
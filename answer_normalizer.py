@@ -0,0 +1,204 @@
+import re
+import threading
+from collections import Counter
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from triage import extract_boxed, latex_issues
+
+# A single value: number, optional power of ten and the rest as its unit
+_QUANTITY_RE = re.compile(
+    r'^\s*(?P<number>[-+]?(?:\d+(?:\.\d*)?|\.\d+))'
+    r'(?:\s*(?:[eE](?P<e_exponent>[-+]?\d+)'
+    r'|(?:\\times|\\cdot|×|\*)\s*10\s*\^\s*(?:\{\s*(?P<exponent>[-+]?\d+)\s*\}|(?P<digit_exponent>[-+]?\d))))?'
+    r'(?P<separator>\s*)(?P<unit>.*?)\s*$',
+    re.S
+)
+_UNIT_WRAPPER_RE = re.compile(r'^\\(?:mathrm|text|rm)\s*\{([^{}]*)\}(\^\s*(?:\{-?\d+\}|-?\d))?$')
+# A subscript belongs to its token: \mu_{N} or m_e are constants used as units, not \mu and N
+_UNIT_TOKEN_RE = re.compile(r'(?:\\[A-Za-z]+|[A-Za-zΩμÅ%]+)(?:_\{[^{}]*\}|_\\?[A-Za-z0-9]+)?')
+# Degrees: ^\circ, ^{\circ} or °, optionally followed by a temperature scale
+_DEGREE_RE = re.compile(r'^(?:\^\s*(?:\{\s*\\circ\s*\}|\\circ)|°)\s*'
+                        r'(?:\\(?:mathrm|text|rm)\s*\{\s*(?P<wrapped_scale>[CFK])\s*\}|(?P<scale>[CFK]))?$')
+_SPACING_RE = re.compile(r'^(?:\\[,;:! ]|~|\s)+|(?:\\[,;:! ]|~|\s)+$')
+
+_BASE_UNITS = {
+    'm', 's', 'g', 'N', 'J', 'W', 'Pa', 'V', 'A', 'C', 'T', 'K', 'Hz', 'eV', 'Ω', 'mol', 'rad', 'sr', 'L',
+    'cd', 'Wb', 'H', 'F', 'S', 'Bq', 'Gy', 'Sv', 'atm', 'bar', 'min', 'h', 'yr', 'lm', 'lx', 'cal', 'dB',
+    'u', 'Å', '%', 'ohm', 'ly', 'pc', 'AU', 'G', 'Torr', 'mmHg',
+}
+_PREFIXES = ('da', 'Y', 'Z', 'E', 'P', 'T', 'G', 'M', 'k', 'h', 'd', 'c', 'm', 'μ', 'u', 'n', 'p', 'f', 'a')
+_UNIT_MACROS = {'\\mu', '\\Omega', '\\cdot', '\\AA', '\\%'}
+# Bare one-letter units, prefixed or not (m, g, T, kT, mg), read just as well as physics symbols
+_SYMBOL_UNITS = {unit for unit in _BASE_UNITS if len(unit) == 1 and unit.isalpha()}
+
+
+def is_unit_token(token):
+    if token in _BASE_UNITS or token in _UNIT_MACROS:
+        return True
+    return any(token.startswith(prefix) and token[len(prefix):] in _BASE_UNITS for prefix in _PREFIXES)
+
+
+def is_symbol_like(token):
+    if token in _SYMBOL_UNITS:
+        return True
+    return any(token.startswith(prefix) and token[len(prefix):] in _SYMBOL_UNITS for prefix in _PREFIXES)
+
+def split_top_level(text, separator=','):
+    """Split `text` on `separator` outside of braces, ignoring escaped separators such as `\\,`."""
+    parts, depth, start = [], 0, 0
+    for pos, char in enumerate(text):
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+        elif char == separator and depth == 0 and text[pos - 1:pos] != '\\':
+            parts.append(text[start:pos])
+            start = pos + 1
+    parts.append(text[start:])
+    return parts
+
+
+class AnswerNormalizer:
+    """
+    Rule-based formatter for the final `\\boxed{}` answer of a prediction.
+
+    The style is compiled once from the answer template: the power-of-ten
+    operator (`\\times` or `\\cdot`), the unit macro (`\\mathrm` or `\\text`)
+    and the space between value and unit. `normalize()` rewrites boxed answers
+    made of plain values with optional units, rounding them to the item's
+    significant figures, and returns None for anything it cannot handle
+    confidently (symbolic, conditional or malformed answers), which is left to
+    the LLM. Hits and fallback reasons are counted; `report()` summarizes them.
+    """
+
+    def __init__(self, power_operator='\\times', unit_macro='mathrm', unit_space='\\,', sci_threshold=3):
+        self.power_operator = power_operator
+        self.unit_macro = unit_macro
+        self.unit_space = unit_space
+        self.sci_threshold = sci_threshold
+        self.hits = 0
+        self.fallbacks = Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_template(cls, template_content):
+        """Infer the formatting conventions used by the answer template."""
+        power_operator = '\\cdot' if template_content.count('\\cdot 10^') > template_content.count('\\times 10^') \
+            else '\\times'
+        unit_macro = 'text' if template_content.count('\\text{') > template_content.count('\\mathrm{') else 'mathrm'
+        unit_space = '\\ ' if template_content.count('\\ ') > template_content.count('\\,') else '\\,'
+        return cls(power_operator, unit_macro, unit_space)
+
+    def _fallback(self, reason):
+        with self._lock:
+            self.fallbacks[reason] += 1
+        return None
+
+    def parse_unit(self, unit, separated=False):
+        """
+        Return the bare unit text if `unit` is a recognizable unit expression, '' for none, else None.
+
+        Degrees come back as '^\\circ' followed by their temperature scale, if any. Unwrapped units
+        must be `separated` from the number (or start with a LaTeX space) and must not be a lone
+        one-letter symbol such as `g` or `kT`; anything else could be a product of symbols.
+
+        Args:
+            unit: Text following the number.
+            separated: Whether whitespace separated the unit from the number.
+        """
+        separated = separated or bool(re.match(r'\\[,;:! ]|~', unit))
+        unit = _SPACING_RE.sub('', unit)
+        if not unit:
+            return ''
+        degree = _DEGREE_RE.match(unit)
+        if degree:
+            return '^\\circ' + (degree.group('wrapped_scale') or degree.group('scale') or '')
+        wrapped = _UNIT_WRAPPER_RE.match(unit)
+        if wrapped:
+            unit = wrapped.group(1).strip() + (wrapped.group(2) or '').replace(' ', '')
+        elif re.search(r'\s', unit):
+            # Bare space-separated letters are as likely to be symbols ("m g") as units
+            return None
+        elif not separated and unit[0].isalpha():
+            # A letter glued to the number ("3mg", "2T") is more often a symbol than a unit
+            return None
+        tokens = _UNIT_TOKEN_RE.findall(unit)
+        if not tokens or not all(is_unit_token(token) for token in tokens):
+            return None
+        if not wrapped and len(tokens) == 1 and is_symbol_like(tokens[0]):
+            return None
+        if re.search(r'[^\w\s/^{}\-.·\\Ωμ°Å%()]', unit):
+            return None
+        return unit
+
+    def format_number(self, number, exponent, sig_figs):
+        """Format a value in the template's notation, rounded to `sig_figs` when given."""
+        if not sig_figs:
+            if exponent is None:
+                return number
+            return f"{number} {self.power_operator} 10^{{{exponent}}}"
+
+        value = Decimal(number).scaleb(exponent or 0)
+        if value == 0:
+            return number
+        for _ in range(2):
+            # A second pass handles rounding up into the next decade (9.96 -> 10.0)
+            magnitude = value.adjusted()
+            value = value.quantize(Decimal(1).scaleb(magnitude - sig_figs + 1), rounding=ROUND_HALF_UP)
+        magnitude = value.adjusted()
+        if abs(magnitude) >= self.sci_threshold or magnitude >= sig_figs:
+            mantissa = value.scaleb(-magnitude).quantize(Decimal(1).scaleb(1 - sig_figs))
+            return f"{mantissa} {self.power_operator} 10^{{{magnitude}}}"
+        return format(value, 'f')
+
+    def normalize_value(self, text, sig_figs):
+        match = _QUANTITY_RE.match(text.replace('−', '-'))
+        if not match:
+            return None
+        unit = self.parse_unit(match.group('unit'), separated=bool(match.group('separator')))
+        if unit is None:
+            return None
+        exponent = match.group('e_exponent') or match.group('exponent') or match.group('digit_exponent')
+        try:
+            number = self.format_number(match.group('number'), int(exponent) if exponent else None, sig_figs)
+        except InvalidOperation:
+            return None
+        if unit.startswith('^\\circ'):
+            # Angles take the degree sign directly; temperatures are spaced like other units
+            scale = unit[len('^\\circ'):]
+            return f"{number}{self.unit_space}^\\circ\\{self.unit_macro}{{{scale}}}" if scale else f"{number}^\\circ"
+        return f"{number}{self.unit_space}\\{self.unit_macro}{{{unit}}}" if unit else number
+
+    def normalize(self, item):
+        """Return item's prediction with its boxed answer normalized, or None to fall back to the LLM."""
+        text = str(item.get('prediction', item.get('answer', '')) or '')
+        if not text or text.startswith('ERROR:'):
+            return self._fallback('error_sentinel')
+        if latex_issues(text):
+            return self._fallback('broken_latex')
+        answer = extract_boxed(text)
+        if not answer:
+            return self._fallback('no_boxed_answer')
+        if re.search(r'\d,\d{3}(?!\d)', answer):
+            return self._fallback('thousands_separator')
+
+        try:
+            sig_figs = int(item['sig_figs']) if item.get('sig_figs') else None
+        except (TypeError, ValueError):
+            sig_figs = None
+        values = [self.normalize_value(part, sig_figs) for part in split_top_level(answer)]
+        if any(value is None for value in values):
+            return self._fallback('not_plain_values')
+
+        start = text.rfind('\\boxed{') + len('\\boxed{')
+        with self._lock:
+            self.hits += 1
+        return text[:start] + ', '.join(values) + text[start + len(answer):]
+
+    def report(self):
+        handled = self.hits + sum(self.fallbacks.values())
+        rate = self.hits / handled if handled else 0.0
+        lines = [f"Rule-based normalizer adjusted {self.hits}/{handled} answers locally ({rate:.1%}), "
+                 f"saving {self.hits} LLM calls"]
+        for reason, count in self.fallbacks.most_common():
+            lines.append(f"  fallback {reason:<20} {count}")
+        return '\n'.join(lines)
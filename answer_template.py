@@ -1,15 +1,215 @@
+import os
 import json
+import hashlib
 import logging
-from prompt import build_template_analysis_prompt, build_final_analysis_prompt
-from utils import initialize_client, safe_inference
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from prompt import build_template_analysis_prompt, build_final_analysis_prompt, format_template_pair
+from utils import (
+    initialize_client,
+    initialize_response_cache,
+    initialize_metrics,
+    safe_inference,
+    call_context,
+    count_tokens,
+    iter_token_batches,
+    iter_json_items,
+    iter_completed,
+    metrics_report
+)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def process_batch(batch_data, batch_num, total_batches, model):
-    """Process a single batch of data."""
-    prompt = build_template_analysis_prompt(batch_data, batch_num, total_batches)
-    return safe_inference(prompt, model)  
+# Prompt token budget of one map batch, per model
+BATCH_TOKEN_BUDGETS = {
+    'o4-mini': 60000,
+    'o3': 60000,
+    'gpt-4o': 30000,
+}
+DEFAULT_BATCH_TOKEN_BUDGET = 30000
+
+
+class TemplateStepStore:
+    """
+    Saves each map and reduce step of the template analysis and reuses it on re-runs.
+
+    A step's output is written to `<output_dir>/answer_template_<name>.txt`
+    (e.g. answer_template_split_3.txt), and a manifest records a hash of the
+    model and prompt that produced it. A saved step is reused only while its
+    prompt is unchanged, so a re-run pays only for new or changed batches and
+    for the reduce steps above them. Failed steps are not saved.
+    """
+
+    def __init__(self, output_dir, model):
+        self.output_dir = output_dir
+        self.model = model
+        self.manifest_path = os.path.join(output_dir, "answer_template_manifest.json")
+        self.manifest = {}
+        self.reused = 0
+        self._lock = threading.Lock()
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    self.manifest = json.load(f)
+            except json.JSONDecodeError:
+                logger.warning(f"Manifest {self.manifest_path} is corrupted. Ignoring it.")
+
+    def path_for(self, name):
+        return os.path.join(self.output_dir, f"answer_template_{name}.txt")
+
+    def run(self, name, prompt, stage, index=None):
+        """Return the saved output of step `name` if its prompt is unchanged, otherwise run it."""
+        digest = hashlib.sha256(f"{self.model}\n{prompt}".encode('utf-8')).hexdigest()
+        path = self.path_for(name)
+        if self.manifest.get(name) == digest and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                result = f.read()
+            with self._lock:
+                self.reused += 1
+            return result
+
+        with call_context(stage=stage, index=index):
+            result = safe_inference(prompt, self.model)
+        if result.startswith("ERROR:"):
+            return result
+
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(result)
+        with self._lock:
+            self.manifest[name] = digest
+            tmp_path = self.manifest_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.manifest, f, indent=4)
+            os.replace(tmp_path, self.manifest_path)
+        return result
+
+def plan_template_batches(input_path, model, token_budget, max_items=None):
+    """
+    Plan the map batches of `input_path` by token count rather than a fixed size.
+
+    Returns the number of items in each batch, in input order; the items are
+    streamed and only one batch is held at a time.
+    """
+    overhead = count_tokens(build_template_analysis_prompt([]), model)
+
+    def pair_tokens(item):
+        # Pair numbers are rendered with three digits for a slightly pessimistic count
+        return count_tokens(format_template_pair(100, item), model)
+
+    batches = iter_token_batches(iter_json_items(input_path), pair_tokens, token_budget, overhead, max_items)
+    return [len(batch) for batch in batches]
+
+def group_for_reduce(analyses, fan_in, max_prompt_tokens, model=None):
+    """
+    Split `analyses` into consecutive groups of at most `fan_in` whose combined
+    prompt stays within `max_prompt_tokens`. Every group but the last takes at
+    least two analyses, so every reduce level shrinks; a group that cannot
+    fit the budget even so is logged as a warning.
+    """
+    groups, group, group_tokens = [], [], 0
+    for analysis in analyses:
+        candidate = group + [analysis]
+        candidate_tokens = count_tokens(build_final_analysis_prompt(candidate), model)
+        if len(group) >= 2 and (len(candidate) > fan_in or candidate_tokens > max_prompt_tokens):
+            groups.append((group, group_tokens))
+            group = [analysis]
+            group_tokens = count_tokens(build_final_analysis_prompt(group), model)
+        else:
+            group, group_tokens = candidate, candidate_tokens
+    if group:
+        groups.append((group, group_tokens))
+
+    for number, (group, group_tokens) in enumerate(groups, 1):
+        if group_tokens > max_prompt_tokens:
+            logger.warning(f"Reduce group {number}/{len(groups)} of {len(group)} analyses needs {group_tokens} "
+                           f"prompt tokens, over the budget of {max_prompt_tokens}; the analyses are too long "
+                           f"to combine within it")
+    return [group for group, _ in groups]
+
+def build_answer_template(input_path, output_path, model, batch_token_budget=None, max_batch_items=None,
+                          fan_in=8, max_workers=8, max_prompt_tokens=100000):
+    """
+    Build the answer template with a parallel map-reduce over the dataset.
+
+    Map: items are packed into batches of up to `batch_token_budget` prompt
+    tokens (by default from BATCH_TOKEN_BUDGETS for `model`), which are
+    analyzed concurrently by up to `max_workers` threads. Reduce: the batch
+    analyses are combined in a tree, at most `fan_in` analyses per call and
+    within `max_prompt_tokens`, until a single analysis remains; it is saved to
+    `output_path`. Every step is saved next to `output_path` and reused on
+    re-runs while its inputs are unchanged.
+
+    Args:
+        input_path: Path to the dataset with 'question' and 'answer' fields (e.g. dev.json)
+        output_path: Path of the final template (e.g. answer_template.txt)
+        model: Model name to use
+        batch_token_budget: Prompt token budget of a map batch
+        max_batch_items: Optional cap on the items in a map batch
+        fan_in: Maximum analyses combined by one reduce call (at least 2)
+        max_workers: Concurrent API calls
+        max_prompt_tokens: Prompt token budget of a reduce call
+    """
+    fan_in = max(2, fan_in)
+    if batch_token_budget is None:
+        batch_token_budget = BATCH_TOKEN_BUDGETS.get(model, DEFAULT_BATCH_TOKEN_BUDGET)
+    output_dir = os.path.dirname(output_path) or '.'
+    os.makedirs(output_dir, exist_ok=True)
+    store = TemplateStepStore(output_dir, model)
+
+    batch_sizes = plan_template_batches(input_path, model, batch_token_budget, max_batch_items)
+    total_batches = len(batch_sizes)
+    logger.info(f"Analyzing {sum(batch_sizes)} items in {total_batches} batches "
+                f"of up to {batch_token_budget} tokens")
+
+    # Batches are read lazily from the input file as workers free up
+    items = iter_json_items(input_path)
+    batches = enumerate((list(islice(items, size)) for size in batch_sizes), 1)
+
+    def analyze_batch(numbered_batch):
+        batch_num, batch_data = numbered_batch
+        prompt = build_template_analysis_prompt(batch_data)
+        return store.run(f"split_{batch_num}", prompt, "template_batch", batch_num)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Map: analyze all batches concurrently
+        batch_results = {}
+        for (batch_num, _), future in iter_completed(executor, analyze_batch, batches, 2 * max_workers):
+            batch_results[batch_num] = future.result()
+            logger.info(f"Batch {batch_num}/{total_batches} analyzed")
+
+        failed = [batch_num for batch_num, result in batch_results.items() if result.startswith("ERROR:")]
+        if failed:
+            logger.error(f"Batches {sorted(failed)} failed and are left out; re-run to retry them.")
+        analyses = [batch_results[batch_num] for batch_num in sorted(batch_results) if batch_num not in failed]
+        if not analyses:
+            raise RuntimeError("Every batch analysis failed; no template was generated.")
+
+        # Reduce: combine analyses level by level until one remains
+        level = 1
+        while True:
+            groups = group_for_reduce(analyses, fan_in, max_prompt_tokens, model)
+            logger.info(f"Reduce level {level}: combining {len(analyses)} analyses in {len(groups)} calls")
+
+            def combine(numbered_group, level=level):
+                group_num, group = numbered_group
+                if len(group) == 1 and len(groups) > 1:
+                    return group[0]  # A leftover analysis moves up to the next level as is
+                prompt = build_final_analysis_prompt(group)
+                return store.run(f"reduce_{level}_{group_num}", prompt, "template_reduce", group_num)
+
+            analyses = list(executor.map(combine, enumerate(groups, 1)))
+            if any(result.startswith("ERROR:") for result in analyses):
+                raise RuntimeError(f"A reduce call at level {level} failed; re-run to retry it.")
+            if len(analyses) == 1:
+                break
+            level += 1
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(analyses[0])
+    logger.info(f"Reused {store.reused} saved analysis steps")
+    return analyses[0]
 
 if __name__ == '__main__':
     # Initialize the client
@@ -17,38 +217,26 @@ if __name__ == '__main__':
         base_url="",
         api_key=" ",
     )
-    
-    with open("./dev.json", 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
+
+    # Serve identical requests from the on-disk response cache
+    initialize_response_cache("./outputs/llm_cache")
+
+    # Record per-call latency and token usage
+    initialize_metrics("./outputs/metrics.jsonl")
+
     # Configuration
-    batch_size = 25  # Process 25 items at a time
-    model = 'o4-mini'
-    total_batches = (len(data) + batch_size - 1) // batch_size
-    
-    # Process data in batches
-    batch_results = []
-    for i in range(0, len(data), batch_size):
-        batch_num = (i // batch_size) + 1
-        batch_data = data[i:i + batch_size]
-        logger.info(f"Processing batch {batch_num}/{total_batches}")
-        
-        result = process_batch(batch_data, batch_num, total_batches, model)
-        batch_results.append(result)
-        
-        # Save intermediate results
-        intermediate_path = f"./outputs/answer_template_split_{batch_num}.txt"
-        with open(intermediate_path, 'w', encoding='utf-8') as f:
-            f.write(result)
-    
-    # Combine all batch results
-    logger.info("Combining batch results...")
-    final_prompt = build_final_analysis_prompt(batch_results)
-    final_analysis = safe_inference(final_prompt, model)
-    
-    # Save final template
+    input_path = "./dev.json"
     output_path = "./outputs/answer_template.txt"
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(final_analysis)
-    
+    batch_token_budget = None  # Map batch size in prompt tokens; None uses BATCH_TOKEN_BUDGETS
+    max_batch_items = None  # Optional cap on items per map batch
+    fan_in = 8  # Analyses combined per reduce call
+    max_workers = 8  # Concurrent batch and reduce calls
+    max_prompt_tokens = 100000  # Estimated prompt budget of a reduce call
+    model = 'o4-mini'
+
+    build_answer_template(input_path, output_path, model, batch_token_budget=batch_token_budget,
+                          max_batch_items=max_batch_items, fan_in=fan_in, max_workers=max_workers,
+                          max_prompt_tokens=max_prompt_tokens)
+
     print(f"Template has been generated and saved to {output_path}")
+    logger.info(f"Call metrics for this run:\n{metrics_report()}")
@@ -0,0 +1,491 @@
+import os
+import json
+import queue
+import gzip
+import hashlib
+import time
+import random
+import logging
+import argparse
+import tempfile
+import resource
+import threading
+import multiprocessing
+from email.policy import default as email_policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default listen backlog of 5 makes clients retry their connects at high worker counts,
+    # which would show up as latency that the code under test did not cause
+    request_queue_size = 1024
+
+
+class MockChatServer:
+    """
+    Local stand-in for an OpenAI-compatible `/chat/completions` endpoint.
+
+    Latency is drawn from a lognormal distribution around `latency_ms`
+    (`latency_sigma=0` makes it fixed). A share of requests fails with 429
+    (`rate_limit_rate`, with a Retry-After header) or 500 (`error_rate`).
+    Successful responses carry `response_chars` characters and a usage block.
+    Like providers with prefix caching, a system message seen before is
+    reported as cached prompt tokens once it reaches `prefix_cache_min_tokens`.
+
+    The Files and Batches endpoints used by utils.run_inference_batch are
+    served from memory: a batch completes `batch_delay` seconds after it is
+    created, with the same error rates applied per request.
+    """
+
+    def __init__(self, latency_ms=200, latency_sigma=0.5, error_rate=0.0, rate_limit_rate=0.0,
+                 response_chars=2000, retry_after=1, prefix_cache_min_tokens=1024, batch_delay=0.5):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.response_chars = response_chars
+        self.retry_after = retry_after
+        self.prefix_cache_min_tokens = prefix_cache_min_tokens
+        self.batch_delay = batch_delay
+        self.files = {}
+        self.batches = {}
+        self.stats = {'requests': 0, 'rate_limited': 0, 'errors': 0, 'batches': 0, 'connections': 0}
+        self._seen_prefixes = set()
+        self._lock = threading.Lock()
+        self._server = _MockHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _latency(self):
+        if self.latency_sigma <= 0:
+            return self.latency_ms / 1000
+        return random.lognormvariate(0, self.latency_sigma) * self.latency_ms / 1000
+
+    def _completion(self, request):
+        prompt_chars = sum(
+            len(part.get('text', '')) if isinstance(part, dict) else len(str(part))
+            for message in request.get('messages', [])
+            for part in (message['content'] if isinstance(message['content'], list) else [message['content']])
+        )
+        body = "x" * self.response_chars
+        content = f"<analysis>mock</analysis>\n<refined_reasoning>{body}</refined_reasoning>\n" \
+                  f"<adjusted_answer>\\boxed{{42}}</adjusted_answer>"
+        prompt_tokens = prompt_chars // 4
+        completion_tokens = len(content) // 4
+        cached_tokens = 0
+        messages = request.get('messages', [])
+        if messages and messages[0]['role'] == 'system' and isinstance(messages[0]['content'], str):
+            prefix_tokens = len(messages[0]['content']) // 4
+            prefix = hashlib.sha256(messages[0]['content'].encode('utf-8')).hexdigest()
+            with self._lock:
+                if prefix in self._seen_prefixes and prefix_tokens >= self.prefix_cache_min_tokens:
+                    # Cached in 128-token increments
+                    cached_tokens = prefix_tokens // 128 * 128
+                self._seen_prefixes.add(prefix)
+        return {
+            'id': 'chatcmpl-mock',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'mock'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+                'prompt_tokens_details': {'cached_tokens': cached_tokens},
+            },
+        }
+
+    def _roll_failure(self):
+        """Return (status, error payload, headers) for a simulated failure, or None for a success."""
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            with self._lock:
+                self.stats['rate_limited'] += 1
+            return 429, {'error': {'message': 'Rate limit exceeded (mock)', 'type': 'rate_limit'}}, \
+                {'Retry-After': str(self.retry_after)}
+        if roll < self.rate_limit_rate + self.error_rate:
+            with self._lock:
+                self.stats['errors'] += 1
+            return 500, {'error': {'message': 'Internal error (mock)', 'type': 'server_error'}}, {}
+        return None
+
+    def _store_file(self, content, filename, purpose):
+        with self._lock:
+            file_id = f"file-mock{len(self.files) + 1}"
+            self.files[file_id] = content
+        return {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+                'filename': filename, 'purpose': purpose, 'status': 'processed'}
+
+    def _create_batch(self, request):
+        with self._lock:
+            batch_id = f"batch_mock{len(self.batches) + 1}"
+            self.stats['batches'] += 1
+            batch = {
+                'id': batch_id, 'object': 'batch', 'endpoint': request.get('endpoint'),
+                'input_file_id': request.get('input_file_id'), 'completion_window': request.get('completion_window'),
+                'status': 'in_progress', 'created_at': int(time.time()), 'output_file_id': None,
+                'error_file_id': None, 'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+            }
+            self.batches[batch_id] = batch
+        threading.Thread(target=self._run_batch, args=(batch_id,), daemon=True).start()
+        return batch
+
+    def _run_batch(self, batch_id):
+        """Answer every request of a batch and publish its output and error files after `batch_delay`."""
+        batch = self.batches[batch_id]
+        outputs, errors = [], []
+        for line in self.files[batch['input_file_id']].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            with self._lock:
+                self.stats['requests'] += 1
+            failure = self._roll_failure()
+            if failure:
+                status, body = failure[0], failure[1]
+            else:
+                status, body = 200, self._completion(request['body'])
+            result = {'id': f"batch_req_{len(outputs) + len(errors)}", 'custom_id': request['custom_id'],
+                      'response': {'status_code': status, 'body': body}, 'error': None}
+            (outputs if status == 200 else errors).append(json.dumps(result))
+        time.sleep(self.batch_delay)
+        output_file = self._store_file(('\n'.join(outputs) + '\n').encode('utf-8'), 'output.jsonl',
+                                       'batch_output') if outputs else None
+        error_file = self._store_file(('\n'.join(errors) + '\n').encode('utf-8'), 'errors.jsonl',
+                                      'batch_output') if errors else None
+        with self._lock:
+            batch.update({
+                'status': 'completed',
+                'output_file_id': output_file and output_file['id'],
+                'error_file_id': error_file and error_file['id'],
+                'request_counts': {'total': len(outputs) + len(errors), 'completed': len(outputs),
+                                   'failed': len(errors)},
+            })
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; with Nagle's algorithm the body would wait
+            # for the client's delayed ACK (~40 ms) on every keep-alive response
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.stats['connections'] += 1
+
+            def _send(self, status, payload, headers=None):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # The client cancelled the request, e.g. the loser of a hedged pair
+
+            def _not_found(self):
+                self._send(404, {'error': {'message': f'Unknown path {self.path}'}})
+
+            def do_GET(self):
+                path = self.path.rstrip('/')
+                if path.endswith('/content') and '/files/' in path:
+                    content = server.files.get(path.split('/')[-2])
+                    if content is None:
+                        return self._not_found()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                elif '/batches/' in path and path.split('/')[-1] in server.batches:
+                    with server._lock:
+                        batch = dict(server.batches[path.split('/')[-1]])
+                    self._send(200, batch)
+                else:
+                    self._not_found()
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                path = self.path.rstrip('/')
+                if path.endswith('/files'):
+                    # Multipart upload: pick the "file" part and the purpose field
+                    message = BytesParser(policy=email_policy).parsebytes(
+                        f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8') + body)
+                    fields = {part.get_param('name', header='content-disposition'): part
+                              for part in message.iter_parts()}
+                    self._send(200, server._store_file(fields['file'].get_payload(decode=True),
+                                                       fields['file'].get_filename(),
+                                                       fields['purpose'].get_content().strip()))
+                    return
+                request = json.loads(body or b'{}')
+                if path.endswith('/batches'):
+                    self._send(200, server._create_batch(request))
+                    return
+                if not path.endswith('/chat/completions'):
+                    return self._not_found()
+                with server._lock:
+                    server.stats['requests'] += 1
+                time.sleep(server._latency())
+
+                failure = server._roll_failure()
+                if failure:
+                    self._send(*failure)
+                else:
+                    self._send(200, server._completion(request))
+
+        return Handler
+
+
+def build_dataset(path, items, images_per_item=0, image_kb=0, img_root=None):
+    """Write a synthetic dataset with every field the caption/prediction/refine/adjust prompts read."""
+    image_paths = []
+    if images_per_item and img_root:
+        os.makedirs(img_root, exist_ok=True)
+        for n in range(images_per_item):
+            name = f"mock_{n}.png"
+            with open(os.path.join(img_root, name), 'wb') as f:
+                f.write(b'\x89PNG\r\n\x1a\n' + os.urandom(image_kb * 1024))
+            image_paths.append(name)
+
+    data = [{
+        'index': i,
+        'question': f"A block of mass {i % 7 + 1} kg slides down a frictionless incline. Find its acceleration.",
+        'image_path': image_paths,
+        'sig_figs': 2,
+        'description': "Mock description of the figure. " * 20,
+        'image_description': "Mock image description.",
+        'caption': "Mock caption.",
+        'reasoning': "Mock reasoning step. " * 50,
+        'prediction': "Mock prediction with \\boxed{9.8 \\, \\text{m/s}^2}",
+    } for i in range(items)]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    return data
+
+
+def _written_bytes():
+    """Bytes written by this process so far (Linux only), or None."""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def _percentile(values, q):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def _run_scenario(scenario, base_url, workdir, workers, result_queue):
+    """Run one scenario in a fresh process so peak RSS and I/O are measured in isolation."""
+    logging.getLogger().setLevel(logging.WARNING)
+    import utils
+    from prompt import build_prompt_prediction
+    from refine import run_multi_step_refinement
+    from answer_adjust import run_answer_adjustment
+
+    utils.initialize_client(base_url=base_url, api_key="mock")
+
+    input_path = os.path.join(workdir, 'input.json')
+    output_path = os.path.join(workdir, f'{scenario}_{workers}.json')
+    written_before = _written_bytes()
+    start = time.perf_counter()
+
+    if scenario == 'inference':
+        utils.run_inference_concurrent(
+            json_path=input_path,
+            output_path=output_path,
+            img_root=os.path.join(workdir, 'images'),
+            model='mock',
+            max_workers=workers,
+            prompt_builder=build_prompt_prediction,
+            output_field='prediction'
+        )
+    elif scenario == 'batch':
+        utils.run_inference_batch(
+            json_path=input_path,
+            output_path=output_path,
+            img_root=os.path.join(workdir, 'images'),
+            model='mock',
+            prompt_builder=build_prompt_prediction,
+            output_field='prediction',
+            poll_interval=0.2
+        )
+    elif scenario == 'refine':
+        run_multi_step_refinement(input_path, output_path, 'mock', max_workers=workers)
+    elif scenario == 'adjust':
+        template_path = os.path.join(workdir, 'template.txt')
+        with open(template_path, 'w', encoding='utf-8') as f:
+            f.write("Mock answer template. " * 200)
+        run_answer_adjustment(input_path, template_path, output_path, 'mock', max_workers=workers)
+    else:
+        raise ValueError(f"Unknown scenario {scenario!r}")
+
+    elapsed = time.perf_counter() - start
+    latencies = utils.metrics.latencies()
+    written_after = _written_bytes()
+    with open(output_path, 'r', encoding='utf-8') as f:
+        items = len(json.load(f))
+
+    result_queue.put({
+        'scenario': scenario,
+        'workers': workers,
+        'items': items,
+        'seconds': elapsed,
+        'items_per_sec': items / elapsed if elapsed else float('nan'),
+        'calls': len(latencies),
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p95_ms': _percentile(latencies, 95) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'written_mb': (written_after - written_before) / 2**20 if written_before is not None else None,
+    })
+
+
+def _wait_for_result(process, result_queue, poll_interval=1.0):
+    """Return the result a scenario process puts on `result_queue`, or None if it exits without one."""
+    while True:
+        try:
+            return result_queue.get(timeout=poll_interval)
+        except queue.Empty:
+            if not process.is_alive():
+                # A result put just before exiting may still be in transit
+                try:
+                    return result_queue.get(timeout=poll_interval)
+                except queue.Empty:
+                    return None
+
+
+def run_benchmark(scenarios=('inference', 'refine', 'adjust'), worker_counts=(16,), items=200, images_per_item=0,
+                  image_kb=64, **server_options):
+    """
+    Run each scenario against a local mock server and return one result dict per run.
+
+    Every (scenario, worker count) pair starts from a fresh output file. The
+    checkpoint I/O figure is the bytes the run wrote (including its logging).
+    A scenario whose process crashes or is killed is reported as failed.
+    """
+    server = MockChatServer(**server_options).start()
+    context = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix='seephys_bench_') as workdir:
+            build_dataset(os.path.join(workdir, 'input.json'), items, images_per_item, image_kb,
+                          img_root=os.path.join(workdir, 'images'))
+            for scenario in scenarios:
+                for workers in worker_counts:
+                    result_queue = context.Queue()
+                    process = context.Process(
+                        target=_run_scenario, args=(scenario, server.base_url, workdir, workers, result_queue)
+                    )
+                    process.start()
+                    result = _wait_for_result(process, result_queue)
+                    process.join()
+                    if result is None:
+                        logger.error(f"Scenario {scenario} with {workers} workers exited with code "
+                                     f"{process.exitcode} without a result")
+                        results.append({'scenario': scenario, 'workers': workers, 'failed': True,
+                                        'exitcode': process.exitcode})
+                        continue
+                    results.append(result)
+                    logger.info(f"Finished {scenario} with {workers} workers in {result['seconds']:.1f}s")
+    finally:
+        server.stop()
+    return results, dict(server.stats)
+
+
+def format_report(results, server_stats):
+    header = f"{'scenario':<10} {'workers':>7} {'items':>6} {'items/s':>8} {'calls':>6} " \
+             f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'peak RSS MB':>12} {'written MB':>11}"
+    lines = [header, '-' * len(header)]
+    for r in results:
+        if r.get('failed'):
+            lines.append(f"{r['scenario']:<10} {r['workers']:>7} FAILED (exit code {r['exitcode']})")
+            continue
+        written = f"{r['written_mb']:.2f}" if r['written_mb'] is not None else 'n/a'
+        lines.append(
+            f"{r['scenario']:<10} {r['workers']:>7} {r['items']:>6} {r['items_per_sec']:>8.2f} {r['calls']:>6} "
+            f"{r['p50_ms']:>8.0f} {r['p95_ms']:>8.0f} {r['p99_ms']:>8.0f} {r['peak_rss_mb']:>12.1f} {written:>11}"
+        )
+    lines.append(f"Mock server: {server_stats['requests']} requests, "
+                 f"{server_stats['rate_limited']} rate limited, {server_stats['errors']} errors, "
+                 f"{server_stats['connections']} connections")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the inference, refine and adjust runners offline.")
+    parser.add_argument('--scenarios', nargs='+', default=['inference', 'refine', 'adjust'],
+                        choices=['inference', 'batch', 'refine', 'adjust'])
+    parser.add_argument('--workers', nargs='+', type=int, default=[16], help="Worker counts to compare (batch ignores this)")
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--images-per-item', type=int, default=0)
+    parser.add_argument('--image-kb', type=int, default=64)
+    parser.add_argument('--latency-ms', type=float, default=200, help="Median mock latency")
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help="Lognormal sigma; 0 for fixed latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered with 500")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument('--retry-after', type=float, default=1, help="Retry-After seconds sent with 429s")
+    parser.add_argument('--response-chars', type=int, default=2000)
+    parser.add_argument('--output', default=None, help="Optional path for the raw results as JSON")
+    args = parser.parse_args()
+
+    results, server_stats = run_benchmark(
+        scenarios=args.scenarios,
+        worker_counts=args.workers,
+        items=args.items,
+        images_per_item=args.images_per_item,
+        image_kb=args.image_kb,
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        response_chars=args.response_chars,
+        retry_after=args.retry_after,
+    )
+    print(format_report(results, server_stats))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'results': results, 'server': server_stats}, f, indent=4)
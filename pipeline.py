@@ -0,0 +1,204 @@
+import queue
+import logging
+import threading
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from prompt import build_prompt_caption, build_prompt_prediction
+from utils import (
+    initialize_client,
+    register_endpoint,
+    initialize_response_cache,
+    initialize_metrics,
+    initialize_image_cache,
+    process_item_generic,
+    iter_json_items,
+    iter_completed,
+    open_checkpoint,
+    checkpoint_is_stale,
+    metrics_report
+)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def run_caption_prediction_pipeline(
+    json_path,
+    caption_path,
+    prediction_path,
+    img_root,
+    caption_model='gemini-2.5-pro',
+    prediction_model='o3',
+    caption_workers=16,
+    prediction_workers=16,
+    queue_size=64
+):
+    """
+    Run captioning and prediction as one pipeline instead of two barrier-synchronized scripts.
+
+    Each item is handed to the prediction stage as soon as its description is
+    ready. Every stage has its own model and worker budget, and a bounded queue
+    between them applies backpressure: caption workers block while
+    `queue_size` captioned items wait for prediction. Both stages write the
+    same checkpoints and outputs as caption.py and prediction.py, so either
+    script can resume what the pipeline started and vice versa.
+
+    Args:
+        json_path: Path to input JSON file (e.g. total.json)
+        caption_path: Caption output JSON (e.g. total_caption.json)
+        prediction_path: Prediction output JSON (e.g. prediction.json)
+        img_root: Root directory for images
+        caption_model: Model name for the caption stage
+        prediction_model: Model name for the prediction stage
+        caption_workers: Concurrent caption requests
+        prediction_workers: Concurrent prediction requests
+        queue_size: Maximum captioned items waiting for prediction
+    """
+    caption_checkpoint = open_checkpoint(caption_path, output_field='description')
+    prediction_checkpoint = open_checkpoint(prediction_path, output_field='prediction')
+
+    # Resume: skip predicted items, and feed already captioned ones straight to prediction.
+    # The input is streamed once to plan and once to caption; only index sets stay in memory.
+    predicted = prediction_checkpoint.scan_indices()
+    previously_captioned = caption_checkpoint.scan_indices()
+    captioned = set()
+    total = caption_count = 0
+    for item in iter_json_items(json_path):
+        total += 1
+        if item['index'] in predicted:
+            continue
+        if item['index'] in previously_captioned:
+            captioned.add(item['index'])
+        else:
+            caption_count += 1
+    remaining = caption_count + len(captioned)
+    skipped = predicted | captioned
+    to_caption = (item for item in iter_json_items(json_path) if item['index'] not in skipped)
+
+    logger.info(f"Total items in dataset: {total}")
+    logger.info(f"Items already predicted: {total - remaining}")
+    logger.info(f"Items to caption: {caption_count} | Captioned items to predict: {len(captioned)}")
+
+    if not remaining:
+        for checkpoint, output_path in ((caption_checkpoint, caption_path), (prediction_checkpoint, prediction_path)):
+            if checkpoint_is_stale(checkpoint, output_path):
+                checkpoint.compact(output_path)
+        logger.info("All items have been predicted according to the output file. Exiting.")
+        return
+
+    handoff = queue.Queue(maxsize=queue_size)
+    caption_progress = tqdm(total=caption_count, desc="Captioning", position=0)
+    prediction_progress = tqdm(total=remaining, desc="Predicting", position=1)
+
+    def hand_off(record):
+        # Failed captions are kept in the caption output but not sent on to prediction
+        if str(record.get('description', '')).startswith('ERROR:'):
+            logger.error(f"Index {record['index']} | Caption failed; skipping prediction.")
+            prediction_progress.update(1)
+            return
+        handoff.put(record)
+
+    def caption_task(item):
+        result = process_item_generic(item, img_root, caption_model, build_prompt_caption, "description")
+        caption_checkpoint.append(result)
+        caption_progress.update(1)
+        hand_off(result)
+
+    def feed_captioned():
+        for record in caption_checkpoint.iter_records():
+            if record['index'] in captioned:
+                hand_off(record)
+
+    def prediction_worker():
+        while True:
+            item = handoff.get()
+            if item is None:
+                return
+            try:
+                result = process_item_generic(item, img_root, prediction_model, build_prompt_prediction, "prediction")
+                prediction_checkpoint.append(result)
+            except Exception as e:
+                logger.error(f"A prediction task for index {item.get('index')} raised an unhandled exception: {e}")
+            prediction_progress.update(1)
+
+    predictors = [threading.Thread(target=prediction_worker, daemon=True) for _ in range(prediction_workers)]
+    for thread in predictors:
+        thread.start()
+
+    with caption_checkpoint, prediction_checkpoint:
+        feeder = threading.Thread(target=feed_captioned, daemon=True)
+        feeder.start()
+        with ThreadPoolExecutor(max_workers=caption_workers) as executor:
+            # Submit lazily so at most 2x caption_workers items are held in memory
+            for item, future in iter_completed(executor, caption_task, to_caption, 2 * caption_workers):
+                if future.exception() is not None:
+                    logger.error(f"A caption task for index {item.get('index')} raised an unhandled exception: {future.exception()}")
+        feeder.join()
+
+        # Both producers are done; let every prediction worker drain the queue and stop
+        for _ in predictors:
+            handoff.put(None)
+        for thread in predictors:
+            thread.join()
+
+    caption_progress.close()
+    prediction_progress.close()
+
+    if caption_count:
+        caption_checkpoint.compact(caption_path)
+    total = prediction_checkpoint.compact(prediction_path)
+    logger.info(f"Pipeline complete. Saved {total} predictions to {prediction_path}.")
+    logger.info(f"Call metrics for this run:\n{metrics_report()}")
+
+
+if __name__ == '__main__':
+    # Define execution parameters
+    INPUT_JSON_PATH = './total.json'
+    CAPTION_JSON_PATH = './outputs/total_caption.json'
+    PREDICTION_JSON_PATH = './outputs/prediction.json'
+    IMAGE_ROOT_DIR = 'images'
+    CAPTION_MODEL_NAME = 'gemini-2.5-pro'
+    PREDICTION_MODEL_NAME = 'o3'
+    # OpenAI-compatible endpoints per model; when set, that model's requests are balanced across them
+    # with failover instead of using the single client below (see ENDPOINTS in caption.py)
+    CAPTION_ENDPOINTS = []
+    PREDICTION_ENDPOINTS = []
+    CAPTION_WORKERS = 16
+    PREDICTION_WORKERS = 16
+    QUEUE_SIZE = 64  # Captioned items allowed to wait for prediction
+    USE_HTTP2 = False  # Multiplex requests over fewer connections (requires `pip install h2`)
+
+    # Initialize the client with one connection per worker of both stages, so every request reuses
+    # a warm connection instead of repeating TCP/TLS setup
+    initialize_client(
+        base_url="",
+        api_key="",
+        max_connections=CAPTION_WORKERS + PREDICTION_WORKERS,
+        http2=USE_HTTP2,
+    )
+
+    for endpoint in CAPTION_ENDPOINTS:
+        register_endpoint(CAPTION_MODEL_NAME, **endpoint)
+    for endpoint in PREDICTION_ENDPOINTS:
+        register_endpoint(PREDICTION_MODEL_NAME, **endpoint)
+
+    # Serve identical requests from the on-disk response cache
+    initialize_response_cache("./outputs/llm_cache")
+
+    # Record per-call latency and token usage
+    initialize_metrics("./outputs/metrics.jsonl")
+
+    # Encode each figure once; encodings are shared between caption and prediction
+    initialize_image_cache("./outputs/image_cache")
+
+    run_caption_prediction_pipeline(
+        json_path=INPUT_JSON_PATH,
+        caption_path=CAPTION_JSON_PATH,
+        prediction_path=PREDICTION_JSON_PATH,
+        img_root=IMAGE_ROOT_DIR,
+        caption_model=CAPTION_MODEL_NAME,
+        prediction_model=PREDICTION_MODEL_NAME,
+        caption_workers=CAPTION_WORKERS,
+        prediction_workers=PREDICTION_WORKERS,
+        queue_size=QUEUE_SIZE
+    )
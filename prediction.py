@@ -1,6 +1,19 @@
+import asyncio
 import logging
 from prompt import build_prompt_prediction
-from utils import initialize_client, run_inference_concurrent
+from self_consistency import run_self_consistency
+from utils import (
+    initialize_client,
+    register_endpoint,
+    initialize_response_cache,
+    initialize_metrics,
+    initialize_image_cache,
+    initialize_image_preprocessing,
+    configure_hedging,
+    run_inference_concurrent,
+    arun_inference_concurrent,
+    run_inference_batch
+)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -9,24 +22,111 @@ logger = logging.getLogger(__name__)
 if __name__ == '__main__':
     # Define execution parameters
     MAX_CONCURRENT_WORKERS = 16
+    USE_ASYNC_ENGINE = False  # Single-threaded asyncio engine bounded by MAX_IN_FLIGHT
+    MAX_IN_FLIGHT = 256
+    USE_BATCH_API = False  # Submit all requests through the Batch API and poll until they are done
+    BATCH_POLL_INTERVAL = 60  # Seconds between batch status checks
+    SELF_CONSISTENCY_SAMPLES = 1  # Samples per item; above 1, the majority boxed answer is kept
+    SELF_CONSISTENCY_AGREE = 3  # Stop sampling an item once this many samples agree
+    PREPROCESS_IMAGES = False  # Downscale/recompress figures before upload (requires Pillow)
+    IMAGE_MAX_SIDE = 1536
+    USE_HTTP2 = False  # Multiplex requests over fewer connections (requires `pip install h2`)
+    HEDGE_REQUESTS = False  # Duplicate requests that run past the stage's HEDGE_PERCENTILE latency
+    HEDGE_PERCENTILE = 95
+    HEDGE_BUDGET = 0.05  # Maximum fraction of requests that may be hedged
+    RETRY_FAILED = False  # Only re-run items whose output holds an "ERROR:" sentinel
+    RETRY_WORKERS = 4
+    RETRY_MAX_RETRIES = 8
+    RETRY_DELAY = 10  # Base backoff in seconds for the retry pass
     INPUT_JSON_PATH = './outputs/total_caption.json'
     OUTPUT_JSON_PATH = './outputs/prediction.json'
     IMAGE_ROOT_DIR = 'images'
     MODEL_NAME = 'o3'
+    # OpenAI-compatible endpoints (keys/providers) for MODEL_NAME; when set, its requests are balanced
+    # across them with failover instead of using the single client below, e.g.
+    # [dict(base_url="...", api_key="...", weight=2, requests_per_minute=500), dict(base_url="...", api_key="...")]
+    ENDPOINTS = []
 
-    # Initialize the client
+    # Initialize the client with a connection pool sized to the concurrency (with headroom for hedged
+    # duplicates), so every request reuses a warm connection instead of repeating TCP/TLS setup
     initialize_client(
         base_url="",
         api_key="",
+        max_connections=MAX_IN_FLIGHT if USE_ASYNC_ENGINE else 2 * MAX_CONCURRENT_WORKERS * SELF_CONSISTENCY_AGREE,
+        http2=USE_HTTP2,
     )
 
+    for endpoint in ENDPOINTS:
+        register_endpoint(MODEL_NAME, **endpoint)
+
+    # Serve identical requests from the on-disk response cache
+    initialize_response_cache("./outputs/llm_cache")
+
+    # Record per-call latency and token usage
+    initialize_metrics("./outputs/metrics.jsonl")
+
+    # Encode each figure once; encodings are shared between caption and prediction
+    initialize_image_cache("./outputs/image_cache")
+    if PREPROCESS_IMAGES:
+        initialize_image_preprocessing("./outputs/image_preprocessed", max_side=IMAGE_MAX_SIDE)
+
+    # Cut tail latency by duplicating requests that are stuck far beyond the usual latency
+    if HEDGE_REQUESTS:
+        configure_hedging(percentile=HEDGE_PERCENTILE, max_hedge_fraction=HEDGE_BUDGET)
+
     # Run the main function
-    run_inference_concurrent(
-        json_path=INPUT_JSON_PATH,
-        output_path=OUTPUT_JSON_PATH,
-        img_root=IMAGE_ROOT_DIR,
-        model=MODEL_NAME,
-        max_workers=MAX_CONCURRENT_WORKERS,
-        prompt_builder=build_prompt_prediction,
-        output_field="prediction"
-    )
+    if RETRY_FAILED:
+        run_inference_concurrent(
+            json_path=INPUT_JSON_PATH,
+            output_path=OUTPUT_JSON_PATH,
+            img_root=IMAGE_ROOT_DIR,
+            model=MODEL_NAME,
+            max_workers=RETRY_WORKERS,
+            prompt_builder=build_prompt_prediction,
+            output_field="prediction",
+            retry_failed=True,
+            max_retries=RETRY_MAX_RETRIES,
+            retry_delay=RETRY_DELAY
+        )
+    elif SELF_CONSISTENCY_SAMPLES > 1:
+        run_self_consistency(
+            json_path=INPUT_JSON_PATH,
+            output_path=OUTPUT_JSON_PATH,
+            img_root=IMAGE_ROOT_DIR,
+            model=MODEL_NAME,
+            max_workers=MAX_CONCURRENT_WORKERS,
+            prompt_builder=build_prompt_prediction,
+            output_field="prediction",
+            num_samples=SELF_CONSISTENCY_SAMPLES,
+            min_agree=SELF_CONSISTENCY_AGREE
+        )
+    elif USE_BATCH_API:
+        run_inference_batch(
+            json_path=INPUT_JSON_PATH,
+            output_path=OUTPUT_JSON_PATH,
+            img_root=IMAGE_ROOT_DIR,
+            model=MODEL_NAME,
+            prompt_builder=build_prompt_prediction,
+            output_field="prediction",
+            poll_interval=BATCH_POLL_INTERVAL
+        )
+    elif USE_ASYNC_ENGINE:
+        asyncio.run(arun_inference_concurrent(
+            json_path=INPUT_JSON_PATH,
+            output_path=OUTPUT_JSON_PATH,
+            img_root=IMAGE_ROOT_DIR,
+            model=MODEL_NAME,
+            max_in_flight=MAX_IN_FLIGHT,
+            prompt_builder=build_prompt_prediction,
+            output_field="prediction"
+        ))
+    else:
+        run_inference_concurrent(
+            json_path=INPUT_JSON_PATH,
+            output_path=OUTPUT_JSON_PATH,
+            img_root=IMAGE_ROOT_DIR,
+            model=MODEL_NAME,
+            max_workers=MAX_CONCURRENT_WORKERS,
+            prompt_builder=build_prompt_prediction,
+            output_field="prediction"
+        )
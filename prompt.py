@@ -1,9 +1,11 @@
-def build_prompt_prediction(item):
-    question = item['question']
-    description = item['description']
+from collections import namedtuple
 
-    prompt = '''
-You are an expert Physics Problem Solver and Educator. Your task is to solve a physics problem based on a structured description of its visual and textual components. You must not only find the correct answer but also present your solution in a clear, logical, and pedagogically sound manner that demonstrates a deep understanding of the underlying principles.
+# A chat prompt split into a static system part and a per-item user part.
+# Providers with prefix caching reuse the processed system part across calls
+# when it is byte-identical, so everything that varies per item goes in `user`.
+ChatPrompt = namedtuple('ChatPrompt', ['system', 'user'])
+
+PREDICTION_SYSTEM_PROMPT = '''You are an expert Physics Problem Solver and Educator. Your task is to solve a physics problem based on a structured description of its visual and textual components. You must not only find the correct answer but also present your solution in a clear, logical, and pedagogically sound manner that demonstrates a deep understanding of the underlying principles.
 You will be provided with the structured **Image(s)**, **Image Description** and the **Question**.
 
 **Format your output as follows:**
@@ -38,19 +40,9 @@ The format of the content inside `\\boxed{}` must match the type of answer deman
 *   All LaTeX special characters inside the dollar signs MUST be escaped with TWO backslashes (e.g., `\\theta`, `\\frac`).
 
 ---
-    '''
-    prompt += '\n Image Description: ' + description
-    prompt += '\n Question: ' + question
-
-    if item['sig_figs']:
-        sf = str(int(item['sig_figs']))
-        prompt += f"\n The final answer MUST retain {sf} significant figures."
-
-    return prompt
+'''
 
-def build_prompt_caption(init_question):
-    caption_prompt = '''
-You are a meticulous Physics Data Annotation Specialist. Your primary mission is to deconstruct multimodal physics problems (consisting of images and text) and translate them into a highly structured and comprehensive natural language description. The goal is to create a "golden" reference text that is as unambiguous and detailed as a data file, which will be used to evaluate the accuracy of other AI models. Your adherence to the format described below is critical.
+CAPTION_SYSTEM_PROMPT = '''You are a meticulous Physics Data Annotation Specialist. Your primary mission is to deconstruct multimodal physics problems (consisting of images and text) and translate them into a highly structured and comprehensive natural language description. The goal is to create a "golden" reference text that is as unambiguous and detailed as a data file, which will be used to evaluate the accuracy of other AI models. Your adherence to the format described below is critical.
 You will be provided with a physics problem that consists of up to two parts: One or more **images**, and its corresponding **question text**.
 
 ### **Guiding Principles for Analysis:**
@@ -110,11 +102,26 @@ You must generate a single text block. The response must be structured using mar
 *   Do not add any introductory or concluding text outside of the prescribed format.
 
 Now, analyze the provided image(s) and question text, and generate the structured natural language description following this category-adaptive format.
------
-\n Original question: 
 '''
-    final_question = caption_prompt + init_question
-    return final_question   
+
+def build_prompt_prediction(item):
+    """Build the prediction prompt: the static solving instructions, then the item's description and question."""
+    user = 'Image Description: ' + item['description']
+    user += '\n Question: ' + item['question']
+
+    if item['sig_figs']:
+        sf = str(int(item['sig_figs']))
+        user += f"\n The final answer MUST retain {sf} significant figures."
+
+    return ChatPrompt(PREDICTION_SYSTEM_PROMPT, user)
+
+def build_prompt_caption(init_question):
+    """Build the caption prompt: the static annotation instructions, then the question text."""
+    return ChatPrompt(CAPTION_SYSTEM_PROMPT, 'Original question: \n' + init_question)
+
+def format_template_pair(i, item):
+    """Render one question-answer pair of a template analysis batch."""
+    return f"\nPair {i}:\nQuestion: {item['question']}\nAnswer: {item['answer']}\n"
 
 def build_template_analysis_prompt(items):
     """Build prompt for analyzing answer templates."""
@@ -135,9 +142,7 @@ Here are the question-answer pairs:
 """
     
     for i, item in enumerate(items, 1):
-        prompt += f"\nPair {i}:\n"
-        prompt += f"Question: {item['question']}\n"
-        prompt += f"Answer: {item['answer']}\n"
+        prompt += format_template_pair(i, item)
     
     prompt += "\nPlease analyze these pairs and provide your findings in the following format:\n"
     prompt += "1. Representative Examples:\n"
@@ -288,20 +293,13 @@ Output your response in <completeness_analysis> </completeness_analysis> tags fo
 
     return prompt
 
-def build_answer_adjustment_prompt(item, template_content):
-    """Build prompt for adjusting answer format based on template."""
-    question = item['question']
-    original_answer = item.get('prediction', item.get('answer', ''))
-    
-    prompt = f"""You are a physics answer formatting specialist. Your task is to adjust the format of a physics answer to match a specific template while preserving the core content and mathematical accuracy.
-
-Question: {question}
-
-Original Answer: {original_answer}
+def build_answer_adjustment_system_prompt(template_content):
+    """Build the static part of the adjustment prompt; it embeds the template and is identical for every item."""
+    return f"""You are a physics answer formatting specialist. Your task is to adjust the format of a physics answer to match a specific template while preserving the core content and mathematical accuracy.
 
 Answer Template (Reference Format): {template_content}
 
-Please adjust the format of the original answer to match the template's style and structure. Focus on:
+You will be given a question and its original answer. Please adjust the format of the original answer to match the template's style and structure. Focus on:
 
 1. **Formatting consistency**: Match the template's formatting style
 2. **Mathematical notation**: Use consistent mathematical notation as shown in the template
@@ -313,5 +311,10 @@ Please adjust the format of the original answer to match the template's style an
 
 Provide the adjusted answer in <adjusted_answer> </adjusted_answer> tags."""
 
-    return prompt
+def build_answer_adjustment_prompt(item, template_content):
+    """Build prompt for adjusting answer format based on template."""
+    question = item['question']
+    original_answer = item.get('prediction', item.get('answer', ''))
 
+    return ChatPrompt(build_answer_adjustment_system_prompt(template_content),
+                      f"Question: {question}\n\nOriginal Answer: {original_answer}")
@@ -1,13 +1,28 @@
-import json
 import logging
 import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 from prompt import (
     build_refinement_prompt, 
     build_mathematical_accuracy_prompt,
     build_logical_flow_prompt,
     build_completeness_prompt
 )
-from utils import initialize_client, safe_inference
+from triage import triage_item
+from utils import (
+    CacheMissError,
+    initialize_client,
+    initialize_response_cache,
+    initialize_metrics,
+    safe_inference,
+    call_context,
+    open_checkpoint,
+    checkpoint_is_stale,
+    select_json_items,
+    iter_completed,
+    metrics_report
+)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -22,84 +37,171 @@ def extract_solution_from_response(response, tag_name):
         return match.group(1).strip()
     return response  # Return full response if tags not found
 
-def process_item_multi_step(item, model):
-    """Process a single item through multiple refinement steps."""
-    logger.info(f"Processing item {item.get('index', 'unknown')} through multi-step refinement")
-    
-    # Step 1: General refinement
-    logger.info("Step 1: General refinement")
-    prompt1 = build_refinement_prompt(item)
-    response1 = safe_inference(prompt1, model=model)
-    refined_reasoning = extract_solution_from_response(response1, "refined_reasoning")
-    
-    # Update item with refined reasoning
-    item['refined_reasoning'] = refined_reasoning
-    
-    # Step 2: Mathematical accuracy check
-    logger.info("Step 2: Mathematical accuracy check")
-    prompt2 = build_mathematical_accuracy_prompt(item)
-    response2 = safe_inference(prompt2, model=model)
-    corrected_solution = extract_solution_from_response(response2, "corrected_solution")
-    
-    # Update item with corrected solution
-    item['mathematically_corrected_reasoning'] = corrected_solution
-    
-    # Step 3: Logical flow improvement
-    logger.info("Step 3: Logical flow improvement")
-    prompt3 = build_logical_flow_prompt(item)
-    response3 = safe_inference(prompt3, model=model)
-    improved_solution = extract_solution_from_response(response3, "improved_solution")
-    
-    # Update item with improved solution
-    item['logically_improved_reasoning'] = improved_solution
-    
-    # Step 4: Completeness check
-    logger.info("Step 4: Completeness check")
-    prompt4 = build_completeness_prompt(item)
-    response4 = safe_inference(prompt4, model=model)
-    complete_solution = extract_solution_from_response(response4, "complete_solution")
-    
-    # Update item with complete solution
-    item['final_refined_reasoning'] = complete_solution
-    
-    # Store all intermediate results
-    item['refinement_steps'] = {
-        'step1_general_refinement': response1,
-        'step2_mathematical_accuracy': response2,
-        'step3_logical_flow': response3,
-        'step4_completeness': response4
-    }
-    
+def run_refinement_step(prompt, model, stage, index, max_retries=5, retry_delay=2):
+    """Run one refinement step, raising if every attempt failed so the item is marked as failed."""
+    with call_context(stage=stage, index=index):
+        response = safe_inference(prompt, model=model, max_retries=max_retries, retry_delay=retry_delay)
+    if response.startswith("ERROR:"):
+        raise RuntimeError(f"{stage} failed: {response}")
+    return response
+
+# One refinement call: the reasoning field its prompt reads, the tag wrapping its
+# answer and the field the answer is stored in. A step runs once the step that
+# produces the field it reads is done; steps reading the same field are independent.
+RefinementStep = namedtuple('RefinementStep', ['name', 'build_prompt', 'reads', 'tag', 'output'])
+
+REFINEMENT_STEPS = [
+    RefinementStep('step1_general_refinement', build_refinement_prompt,
+                   'reasoning', 'refined_reasoning', 'refined_reasoning'),
+    RefinementStep('step2_mathematical_accuracy', build_mathematical_accuracy_prompt,
+                   'refined_reasoning', 'corrected_solution', 'mathematically_corrected_reasoning'),
+    RefinementStep('step3_logical_flow', build_logical_flow_prompt,
+                   'refined_reasoning', 'improved_solution', 'logically_improved_reasoning'),
+    RefinementStep('step4_completeness', build_completeness_prompt,
+                   'refined_reasoning', 'complete_solution', 'final_refined_reasoning'),
+]
+
+def is_unchanged(before, after):
+    """True when a step returned its input reasoning, ignoring whitespace."""
+    return ' '.join(str(before).split()) == ' '.join(str(after).split())
+
+def process_item_multi_step(item, model, max_retries=5, retry_delay=2, step_executor=None, skip_if_unchanged=False):
+    """
+    Process a single item through the refinement steps in REFINEMENT_STEPS.
+
+    Steps run in dependency waves: every step whose input field is ready runs
+    in the same wave, concurrently on `step_executor` when one is given. With
+    `skip_if_unchanged`, a step whose input came back unchanged from the step
+    that produced it is skipped and passes that input through.
+    """
+    index = item.get('index', 'unknown')
+    logger.info(f"Processing item {index} through multi-step refinement")
+
+    producers = {step.output: step.name for step in REFINEMENT_STEPS}
+    responses = {}
+    unchanged = set()
+    pending = list(REFINEMENT_STEPS)
+    while pending:
+        ready = [step for step in pending if step.reads not in producers or producers[step.reads] in responses]
+        if not ready:
+            raise ValueError(f"Refinement steps {[step.name for step in pending]} have unmet inputs")
+        pending = [step for step in pending if step not in ready]
+
+        wave = []
+        for step in ready:
+            if skip_if_unchanged and step.reads in unchanged:
+                logger.info(f"Index {index} | Skipping {step.name}: {step.reads} unchanged")
+                item[step.output] = item[step.reads]
+                responses[step.name] = None
+                unchanged.add(step.output)
+            else:
+                wave.append(step)
+        if not wave:
+            continue
+
+        logger.info(f"Index {index} | Running {', '.join(step.name for step in wave)}")
+        prompts = [step.build_prompt(item) for step in wave]
+
+        def run(step, prompt):
+            return run_refinement_step(prompt, model, f"refine_{step.name}", index, max_retries, retry_delay)
+
+        if step_executor is not None and len(wave) > 1:
+            results = list(step_executor.map(run, wave, prompts))
+        else:
+            results = [run(step, prompt) for step, prompt in zip(wave, prompts)]
+
+        for step, response in zip(wave, results):
+            responses[step.name] = response
+            output = extract_solution_from_response(response, step.tag)
+            if is_unchanged(item.get(step.reads, ''), output):
+                unchanged.add(step.output)
+            item[step.output] = output
+
+    # Store all intermediate results; skipped steps are recorded as None
+    item['refinement_steps'] = {step.name: responses[step.name] for step in REFINEMENT_STEPS}
+
     return item
 
-def run_multi_step_refinement(json_path, output_path, model):
-    """Run multi-step refinement process."""
-    # Load data
-    with open(json_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
-    logger.info(f"Starting multi-step refinement for {len(data)} items")
-    
-    # Process each item through all refinement steps
-    refined_data = []
-    for i, item in enumerate(data):
-        logger.info(f"Processing item {i+1}/{len(data)}")
-        try:
-            refined_item = process_item_multi_step(item, model)
-            refined_data.append(refined_item)
-            
-            # Save intermediate results after each item
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(refined_data, f, ensure_ascii=False, indent=4)
-                
-        except Exception as e:
-            logger.error(f"Error processing item {item.get('index', i)}: {e}")
-            # Add error item to maintain order
-            item['error'] = str(e)
-            refined_data.append(item)
-    
+def run_multi_step_refinement(json_path, output_path, model, max_workers=8, compact_every=50,
+                              retry_failed=False, max_retries=5, retry_delay=2,
+                              parallel_steps=True, skip_if_unchanged=False, prescreen=False):
+    """
+    Run multi-step refinement process.
+
+    Items are refined concurrently by up to `max_workers` threads. Within an
+    item, steps that only depend on 'refined_reasoning' run concurrently when
+    `parallel_steps` is set, and `skip_if_unchanged` skips them when step 1
+    leaves the reasoning unchanged. With `prescreen`, items that pass the local
+    triage checks (see triage.py) skip the API calls and are stored as-is, with
+    their reasoning as 'final_refined_reasoning'. Finished items are appended
+    to the JSONL checkpoint next to `output_path`, which is compacted into the
+    sorted JSON output every `compact_every` items and at the end. Items whose
+    'final_refined_reasoning' already exists are skipped. With `retry_failed`,
+    only items stored with an error are re-run, replacing their failed rows.
+
+    Returns the number of items in the output file.
+    """
+    # Breakpoint resume: keep finished items, re-run missing and failed ones
+    checkpoint = open_checkpoint(output_path, output_field='final_refined_reasoning')
+    if retry_failed:
+        failed = checkpoint.failed_indices()
+        total, remaining, pending = select_json_items(json_path, failed, exclude=False)
+        logger.info(f"Retrying {remaining} failed items out of {total}")
+    else:
+        done = checkpoint.completed_indices()
+        # Items are streamed from the input rather than loaded all at once
+        total, remaining, pending = select_json_items(json_path, done)
+        logger.info(f"Starting multi-step refinement for {total} items")
+        logger.info(f"Items already refined: {total - remaining}")
+        logger.info(f"Items remaining to refine: {remaining}")
+
+    if not remaining:
+        if checkpoint_is_stale(checkpoint, output_path):
+            checkpoint.compact(output_path)
+        logger.info("Nothing left to refine according to the output file. Exiting.")
+        return len(checkpoint)
+    
+    # Process items concurrently; independent steps of an item share a separate pool
+    step_workers = max_workers * (len(REFINEMENT_STEPS) - 1) if parallel_steps else 1
+
+    with checkpoint, ThreadPoolExecutor(max_workers=step_workers) as step_executor, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def refine_item(item):
+            if prescreen:
+                item['triage_flags'] = triage_item(item)
+                if not item['triage_flags']:
+                    return {**item, 'final_refined_reasoning': item.get('reasoning') or item.get('prediction', '')}
+            return process_item_multi_step(item, model, max_retries, retry_delay,
+                                           step_executor if parallel_steps else None, skip_if_unchanged)
+
+        progress = tqdm(iter_completed(executor, refine_item, pending, 2 * max_workers),
+                        total=remaining, desc="Refining Items")
+        passed_through = 0
+        for n, (item, future) in enumerate(progress, 1):
+            try:
+                result = future.result()
+                passed_through += result.get('triage_flags') == []
+                checkpoint.append(result)
+            except CacheMissError as e:
+                # Replay mode: leave the item unprocessed instead of storing an error row
+                logger.warning(f"Skipping item {item['index']}: {e}")
+            except Exception as e:
+                logger.error(f"Error processing item {item['index']}: {e}")
+                # Keep the error item so the output stays complete; it is retried on resume
+                # or by a retry_failed pass
+                item['error'] = str(e)
+                checkpoint.append(item)
+
+            # Periodically refresh the JSON output from the checkpoint
+            if n % compact_every == 0:
+                checkpoint.compact(output_path)
+
+    total = checkpoint.compact(output_path)
+    if prescreen:
+        logger.info(f"Pre-screen passed {passed_through}/{remaining} clean items through without refinement")
     logger.info(f"Multi-step refinement completed. Results saved to {output_path}")
-    return refined_data
+    logger.info(f"Call metrics for this run:\n{metrics_report()}")
+    return total
 
 if __name__ == '__main__':
     # Initialize the client
@@ -107,13 +209,33 @@ if __name__ == '__main__':
         base_url="",
         api_key="",
     )
+
+    # Serve identical requests from the on-disk response cache
+    initialize_response_cache("./outputs/llm_cache")
+
+    # Record per-call latency and token usage
+    initialize_metrics("./outputs/metrics.jsonl")
     
     # Configuration
     model = 'o4-mini'
+    max_workers = 8  # Items refined concurrently
+    parallel_steps = True  # Run steps 2-4, which all read step 1's output, concurrently
+    skip_if_unchanged = False  # Skip steps 2-4 when step 1 leaves the reasoning unchanged
+    prescreen = False  # Only refine items flagged by the local checks in triage.py
+    retry_failed = False  # Only re-run items stored with an error, with the settings below
+    retry_workers = 2
+    retry_max_retries = 8
+    retry_delay = 10
     input_path = './outputs/prediction.json'
     output_path = './outputs/prediction_refined.json'
     
     # Ensure output directory exists
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     
-    run_multi_step_refinement(input_path, output_path, model)
+    if retry_failed:
+        run_multi_step_refinement(input_path, output_path, model, max_workers=retry_workers, retry_failed=True,
+                                  max_retries=retry_max_retries, retry_delay=retry_delay)
+    else:
+        run_multi_step_refinement(input_path, output_path, model, max_workers=max_workers,
+                                  parallel_steps=parallel_steps, skip_if_unchanged=skip_if_unchanged,
+                                  prescreen=prescreen)
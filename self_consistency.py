@@ -0,0 +1,179 @@
+import re
+import logging
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from tqdm import tqdm
+import utils
+from triage import extract_boxed
+from answer_normalizer import AnswerNormalizer, split_top_level
+from utils import (
+    process_item_generic,
+    prepare_resume,
+    finalize_checkpoint,
+    iter_completed,
+    stage_name
+)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Formats plain values and units uniformly so equal answers compare equal
+_canonical_normalizer = AnswerNormalizer()
+_MARKUP_RE = re.compile(r'\\[,;:! ]|~|\\left|\\right|\s+')
+
+
+def canonical_answer(text, sig_figs=None):
+    """
+    Canonical form of the final `\\boxed{}` answer of `text`, used as its vote, or None without one.
+
+    Plain values are rounded to `sig_figs` and reformatted with their units by
+    AnswerNormalizer, so "9.81 m/s^2" and "9.8\\,\\mathrm{m/s^2}" agree at two
+    significant figures. Other answers are compared with spacing and
+    \\left/\\right markup removed.
+    """
+    if not text or text.startswith("ERROR:"):
+        return None
+    answer = extract_boxed(text)
+    if not answer:
+        return None
+    values = [_canonical_normalizer.normalize_value(part, sig_figs) for part in split_top_level(answer)]
+    if all(value is not None for value in values):
+        return ', '.join(values)
+    return _MARKUP_RE.sub('', answer).replace('\\dfrac', '\\frac').rstrip('.')
+
+def process_item_self_consistency(item, img_root, model, prompt_builder, output_field, sample_executor,
+                                  num_samples=5, min_agree=3, max_retries=5, retry_delay=2):
+    """
+    Sample an item up to `num_samples` times and keep the majority answer.
+
+    Samples run concurrently on `sample_executor`. Only as many are in flight
+    as could still complete an agreement of `min_agree` identical canonical
+    answers, and no new sample is sent once one is reached; samples that are
+    already running finish but are not counted. Without agreement the answer
+    with the most votes wins, ties going to the first one seen.
+
+    The returned item holds the first sample with the winning answer in
+    `output_field`, the vote distribution in 'votes' and the number of samples
+    counted in 'samples'. If no sample has a boxed answer, `output_field`
+    holds the first successful sample with empty 'votes', or the last error
+    if every sample failed.
+    """
+    try:
+        sig_figs = int(item['sig_figs']) if item.get('sig_figs') else None
+    except (TypeError, ValueError):
+        sig_figs = None
+
+    def draw(sample):
+        return process_item_generic(item, img_root, model, prompt_builder, output_field,
+                                    max_retries, retry_delay, sample)[output_field]
+
+    votes = Counter()
+    first_text = {}
+    first_success = last_error = None
+    launched = counted = 0
+    pending = set()
+    while True:
+        leader = max(votes.values(), default=0)
+        if leader >= min_agree:
+            break
+        # Keep just enough samples in flight to reach agreement if they all side with the leader
+        while launched < num_samples and len(pending) < min_agree - leader:
+            pending.add(sample_executor.submit(draw, launched))
+            launched += 1
+        if not pending:
+            break
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            text = future.result()
+            counted += 1
+            answer = canonical_answer(text, sig_figs)
+            if answer is None:
+                if text.startswith("ERROR:"):
+                    last_error = text
+                elif first_success is None:
+                    first_success = text
+                continue
+            votes[answer] += 1
+            first_text.setdefault(answer, text)
+    for future in pending:
+        future.cancel()
+
+    if votes:
+        # Counter.most_common keeps first-seen order among equal counts
+        winner = votes.most_common(1)[0][0]
+        output = first_text[winner]
+    elif first_success is not None:
+        output = first_success
+    else:
+        output = last_error or f"ERROR: No sample produced an answer ({counted} samples)"
+    return {**item, output_field: output, 'votes': dict(votes.most_common()), 'samples': counted}
+
+def run_self_consistency(
+    json_path,
+    output_path,
+    img_root,
+    model='o3',
+    max_workers=4,
+    prompt_builder=None,
+    output_field="prediction",
+    num_samples=5,
+    min_agree=3,
+    flush_every=20,
+    retry_failed=False,
+    max_retries=5,
+    retry_delay=2
+):
+    """
+    Self-consistency counterpart of run_inference_concurrent.
+
+    Each item is sampled up to `num_samples` times, stopping once `min_agree`
+    samples agree on the final answer (see process_item_self_consistency).
+    Resume, checkpointing and the output format are those of
+    run_inference_concurrent, with 'votes' and 'samples' added to every item.
+
+    Args:
+        json_path: Path to input JSON file
+        output_path: Path to output JSON file
+        img_root: Root directory for images
+        model: Model name to use
+        max_workers: Number of items processed concurrently
+        prompt_builder: Function to build prompts
+        output_field: Field name for output (e.g., "prediction")
+        num_samples: Maximum samples per item
+        min_agree: Identical answers that end sampling early
+        flush_every: Number of appended results between fsyncs of the checkpoint
+        retry_failed: Re-run only the items whose stored result failed
+        max_retries: Attempts per sample before it counts as failed
+        retry_delay: Base delay in seconds for the backoff between attempts
+    """
+    min_agree = max(1, min(min_agree, num_samples))
+    prepared = prepare_resume(json_path, output_path, flush_every, output_field, retry_failed)
+    if prepared is None:
+        return
+    checkpoint, items_to_process, remaining = prepared
+
+    new_count = total_samples = agreed = 0
+    # Samples of an item share a separate pool so items never wait on their own samples
+    with checkpoint, ThreadPoolExecutor(max_workers=max_workers * min_agree) as sample_executor, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def process(item):
+            return process_item_self_consistency(item, img_root, model, prompt_builder, output_field,
+                                                 sample_executor, num_samples, min_agree, max_retries, retry_delay)
+
+        progress = tqdm(iter_completed(executor, process, items_to_process, 2 * max_workers),
+                        total=remaining, desc="Sampling Items")
+        for item, future in progress:
+            try:
+                result = future.result()
+                checkpoint.append(result)
+                new_count += 1
+                total_samples += result['samples']
+                agreed += max(result['votes'].values(), default=0) >= min_agree
+                progress.set_postfix(utils.metrics.live_counters(stage_name(output_field)), refresh=False)
+            except Exception as e:
+                logger.error(f"A task for index {item.get('index')} raised an unhandled exception: {e}")
+
+    if new_count:
+        logger.info(f"{agreed}/{new_count} items reached {min_agree} agreeing samples; "
+                    f"{total_samples / new_count:.2f} samples per item on average (at most {num_samples})")
+    finalize_checkpoint(checkpoint, output_path, new_count)
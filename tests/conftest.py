@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+from benchmark import MockChatServer
+
+
+@pytest.fixture
+def mock_server():
+    servers = []
+
+    def start(**options):
+        server = MockChatServer(**{'latency_ms': 10, 'latency_sigma': 0, **options}).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture(autouse=True)
+def fresh_globals(monkeypatch):
+    """Give every test its own clients, pools, limiters and metrics"""
+    monkeypatch.setattr(utils, 'client', None)
+    monkeypatch.setattr(utils, 'async_client', None)
+    monkeypatch.setattr(utils, 'response_cache', None)
+    monkeypatch.setattr(utils, 'hedge_policy', None)
+    monkeypatch.setattr(utils, 'metrics', utils.MetricsRecorder())
+    monkeypatch.setattr(utils, 'rate_limiters', {})
+    monkeypatch.setattr(utils, 'endpoint_pools', {})
+    monkeypatch.setattr(utils, '_trace_connections', False)
@@ -0,0 +1,47 @@
+import pytest
+
+from answer_normalizer import AnswerNormalizer
+
+
+@pytest.mark.parametrize('answer, expected', [
+    ('30^\\circ', '30^\\circ'),
+    ('30^{\\circ}', '30^\\circ'),
+    ('30°', '30^\\circ'),
+    ('25 ^\\circ C', '25\\,^\\circ\\mathrm{C}'),
+    ('25\\,^\\circ\\mathrm{C}', '25\\,^\\circ\\mathrm{C}'),
+])
+def test_degrees_keep_the_degree_sign_outside_the_unit_macro(answer, expected):
+    assert AnswerNormalizer().normalize_value(answer, 2) == expected
+
+
+@pytest.mark.parametrize('answer', ['2.5\\,\\mu_{N}', '2.5 \\mu_N', '3 m_e', '4 m^\\circ'])
+def test_subscripted_and_odd_degree_units_are_left_to_the_llm(answer):
+    assert AnswerNormalizer().normalize_value(answer, 2) is None
+
+
+def test_normalize_rewrites_only_the_boxed_answer():
+    normalizer = AnswerNormalizer()
+    item = {'prediction': 'The angle is \\boxed{30.04^{\\circ}}', 'sig_figs': '3'}
+    assert normalizer.normalize(item) == 'The angle is \\boxed{30.0^\\circ}'
+    assert normalizer.normalize({'prediction': '\\boxed{5.05\\,\\mu_{N}}', 'sig_figs': '2'}) is None
+    assert normalizer.fallbacks['not_plain_values'] == 1
+
+
+@pytest.mark.parametrize('answer', ['3mg', '2T', '5kT', '2L', '4 g', '3 kg', '4 m^2'])
+def test_glued_or_one_letter_bare_units_are_left_to_the_llm(answer):
+    assert AnswerNormalizer().normalize_value(answer, 2) is None
+
+
+@pytest.mark.parametrize('answer, expected', [
+    ('3\\mathrm{mg}', '3.0\\,\\mathrm{mg}'),
+    ('3 \\text{mg}', '3.0\\,\\mathrm{mg}'),
+    ('9.81 m/s^2', '9.8\\,\\mathrm{m/s^2}'),
+    ('2.5 kHz', '2.5\\,\\mathrm{kHz}'),
+    ('7\\,Pa', '7.0\\,\\mathrm{Pa}'),
+])
+def test_wrapped_spaced_and_compound_units_are_normalized(answer, expected):
+    assert AnswerNormalizer().normalize_value(answer, 2) == expected
+
+
+def test_boxed_answer_with_glued_unit_is_not_rewritten():
+    assert AnswerNormalizer().normalize({'prediction': '\\boxed{3mg}', 'sig_figs': '2'}) is None
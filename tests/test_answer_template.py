@@ -0,0 +1,23 @@
+import logging
+
+from answer_template import group_for_reduce
+from prompt import build_final_analysis_prompt
+from utils import count_tokens
+
+
+def test_groups_respect_fan_in_and_budget():
+    analyses = [f"analysis {number}" for number in range(7)]
+    assert group_for_reduce(analyses, 3, 100000) == [analyses[0:3], analyses[3:6], analyses[6:7]]
+
+    budget = count_tokens(build_final_analysis_prompt(analyses[:2]))
+    assert group_for_reduce(analyses, 8, budget) == [analyses[2 * n:2 * n + 2] for n in range(4)]
+
+
+def test_group_over_budget_is_logged(caplog):
+    analyses = ["long analysis " * 200] * 3
+    budget = count_tokens(build_final_analysis_prompt(analyses[:1])) + 10
+    with caplog.at_level(logging.WARNING, logger='answer_template'):
+        groups = group_for_reduce(analyses, 8, budget)
+    assert [len(group) for group in groups] == [2, 1]
+    assert 'Reduce group 1/2 of 2 analyses' in caplog.text
+    assert 'Reduce group 2/2' not in caplog.text
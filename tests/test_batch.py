@@ -0,0 +1,56 @@
+import json
+import os
+import random
+
+import pytest
+
+import utils
+from benchmark import build_dataset
+from prompt import build_prompt_prediction
+
+
+def run_batch(server, tmp_path, **options):
+    utils.initialize_client(base_url=server.base_url, api_key='test')
+    utils.run_inference_batch(str(tmp_path / 'input.json'), str(tmp_path / 'prediction.json'), str(tmp_path),
+                              model='mock-model', prompt_builder=build_prompt_prediction, output_field='prediction',
+                              poll_interval=0.05, **options)
+    return {item['index']: item['prediction'] for item in json.loads((tmp_path / 'prediction.json').read_text())}
+
+
+def test_batches_are_submitted_polled_and_merged(mock_server, tmp_path):
+    random.seed(5)
+    build_dataset(str(tmp_path / 'input.json'), 25)
+    server = mock_server(error_rate=0.2, batch_delay=0.2)
+    results = run_batch(server, tmp_path, max_batch_requests=10)
+
+    assert server.stats['batches'] == 3 and server.stats['requests'] == 25
+    assert sorted(results) == list(range(25))
+    failed = {index for index, prediction in results.items() if prediction.startswith('ERROR: Batch request failed')}
+    assert len(failed) == server.stats['errors'] > 0
+    # Submitted batches and their input files are cleaned up once merged
+    assert not any('batch' in name for name in os.listdir(tmp_path))
+
+    retry_server = mock_server(batch_delay=0.1)
+    retried = run_batch(retry_server, tmp_path, retry_failed=True)
+    assert retry_server.stats['batches'] == 1 and retry_server.stats['requests'] == len(failed)
+    assert not any(prediction.startswith('ERROR:') for prediction in retried.values())
+    assert {index: results[index] for index in results if index not in failed} == \
+        {index: retried[index] for index in retried if index not in failed}
+
+
+def test_interrupted_run_resumes_polling_without_resubmitting(mock_server, tmp_path, monkeypatch):
+    build_dataset(str(tmp_path / 'input.json'), 5)
+    server = mock_server(batch_delay=0.1)
+
+    def interrupted(batch, model, stage):
+        raise KeyboardInterrupt
+    with monkeypatch.context() as patch:
+        patch.setattr(utils, 'read_batch_results', interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            run_batch(server, tmp_path)
+    assert os.path.exists(utils.batch_state_path_for(str(tmp_path / 'prediction.json')))
+
+    results = run_batch(server, tmp_path)
+    assert server.stats['batches'] == 1 and server.stats['requests'] == 5
+    assert sorted(results) == list(range(5))
+    assert not os.path.exists(utils.batch_state_path_for(str(tmp_path / 'prediction.json')))
@@ -0,0 +1,61 @@
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import benchmark
+import utils
+
+
+def test_wait_for_result_reports_a_crashed_scenario():
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    process = context.Process(target=os._exit, args=(3,))
+    process.start()
+    assert benchmark._wait_for_result(process, result_queue, poll_interval=0.1) is None
+    process.join()
+    assert process.exitcode == 3
+
+
+def test_mock_server_accepts_a_burst_of_connections(mock_server):
+    server = mock_server()
+    host, port = server._server.server_address
+
+    def connect(_):
+        started = time.perf_counter()
+        with socket.create_connection((host, port), timeout=5):
+            return time.perf_counter() - started
+
+    with ThreadPoolExecutor(200) as executor:
+        connect_times = list(executor.map(connect, range(200)))
+    # A dropped SYN is only retried after a second
+    assert max(connect_times) < 0.5
+
+
+def test_mock_server_adds_no_delayed_ack_latency(mock_server):
+    server = mock_server(latency_ms=50)
+    utils.initialize_client(base_url=server.base_url, api_key='test')
+    latencies = []
+    for i in range(10):
+        started = time.perf_counter()
+        utils.inference_one_step(f'question {i}', [], 'mock-model')
+        latencies.append(time.perf_counter() - started)
+    assert sorted(latencies)[5] < 0.08
+
+
+def test_adjust_scenario_runs_with_the_given_workers(mock_server, tmp_path):
+    server = mock_server(latency_ms=100)
+    benchmark.build_dataset(str(tmp_path / 'input.json'), 16)
+    result_queue = queue.Queue()
+    root_level = logging.getLogger().level
+    try:
+        benchmark._run_scenario('adjust', server.base_url, str(tmp_path), 8, result_queue)
+    finally:
+        logging.getLogger().setLevel(root_level)
+    result = result_queue.get_nowait()
+    assert result['items'] == 16 and server.stats['requests'] == 16
+    # One request at a time would take 1.6s
+    assert result['seconds'] < 0.8
@@ -0,0 +1,125 @@
+import json
+import os
+
+import pytest
+
+import utils
+
+
+def write_results(output_path, indices):
+    with utils.open_checkpoint(str(output_path), output_field='prediction') as checkpoint:
+        for index in indices:
+            checkpoint.append({'index': index, 'prediction': f'answer {index}'})
+        checkpoint.compact(str(output_path))
+    return checkpoint
+
+
+def test_compacted_checkpoint_is_not_stale(tmp_path):
+    output_path = tmp_path / 'prediction.json'
+    checkpoint = write_results(output_path, range(3))
+    assert not utils.checkpoint_is_stale(checkpoint, str(output_path))
+
+    checkpoint.append({'index': 3, 'prediction': 'answer 3'})
+    checkpoint.close()
+    assert utils.checkpoint_is_stale(checkpoint, str(output_path))
+
+
+def test_reopening_compacted_checkpoint_does_not_recompact(tmp_path):
+    output_path = tmp_path / 'prediction.json'
+    write_results(output_path, range(3))
+    compacted_at = os.stat(output_path).st_mtime_ns
+
+    checkpoint = utils.open_checkpoint(str(output_path), output_field='prediction')
+    assert not utils.checkpoint_is_stale(checkpoint, str(output_path))
+    assert os.stat(output_path).st_mtime_ns == compacted_at
+
+
+def test_hand_edited_output_is_imported(tmp_path):
+    output_path = tmp_path / 'prediction.json'
+    write_results(output_path, range(3))
+    records = json.loads(output_path.read_text())
+    records[1]['prediction'] = 'edited'
+    output_path.write_text(json.dumps(records))
+
+    checkpoint = utils.open_checkpoint(str(output_path), output_field='prediction')
+    assert checkpoint.get(1)['prediction'] == 'edited'
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 1 << 20])
+@pytest.mark.parametrize('items', [
+    [1.5, -20.25, 3e-7, 400, True, None, 'text'],
+    [{'index': 1, 'value': 1.5}, {'index': 2, 'nested': [1, 2.75, {'a': None}]}],
+    [],
+])
+def test_iter_json_items_with_small_chunks(tmp_path, chunk_size, items):
+    path = tmp_path / 'items.json'
+    path.write_text(json.dumps(items, indent=4))
+    assert list(utils.iter_json_items(str(path), chunk_size=chunk_size)) == items
+
+    path.write_text(json.dumps(items, separators=(',', ':')))
+    assert list(utils.iter_json_items(str(path), chunk_size=chunk_size)) == items
+
+
+def append_results(log_path, records, output_field='prediction'):
+    with utils.JsonlCheckpoint(str(log_path), output_field=output_field) as checkpoint:
+        for record in records:
+            checkpoint.append(record)
+
+
+def reopen(log_path):
+    return utils.JsonlCheckpoint(str(log_path), output_field='prediction')
+
+
+def test_reopened_store_reads_the_sidecar_and_later_lines(tmp_path):
+    log_path = tmp_path / 'results.jsonl'
+    append_results(log_path, [{'index': 0, 'prediction': 'a'}, {'index': 1, 'prediction': 'ERROR: timeout'}])
+    # A line written without its sidecar entry, e.g. by a process killed before the sidecar flush
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'index': 2, 'prediction': 'c'}) + '\n')
+
+    checkpoint = reopen(log_path)
+    assert checkpoint.completed_indices() == {0, 2}
+    assert checkpoint.failed_indices() == {1}
+    assert checkpoint.get(2) == {'index': 2, 'prediction': 'c'}
+    assert len((tmp_path / 'results.jsonl.idx').read_text().splitlines()) == 4
+
+
+def test_torn_log_tail_is_dropped(tmp_path):
+    log_path = tmp_path / 'results.jsonl'
+    append_results(log_path, [{'index': 0, 'prediction': 'a'}, {'index': 1, 'prediction': 'b'}])
+    intact_size = os.path.getsize(log_path)
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write('{"index": 2, "predic')
+
+    checkpoint = reopen(log_path)
+    assert checkpoint.scan_indices() == {0, 1}
+    assert os.path.getsize(log_path) == intact_size
+    checkpoint.append({'index': 2, 'prediction': 'c'})
+    checkpoint.close()
+    assert reopen(log_path).get(2) == {'index': 2, 'prediction': 'c'}
+
+
+@pytest.mark.parametrize('bad_entry', ['2\t10', '2\t100000\t20\t0\n'])
+def test_torn_or_unsynced_sidecar_entries_are_dropped(tmp_path, bad_entry):
+    log_path = tmp_path / 'results.jsonl'
+    append_results(log_path, [{'index': 0, 'prediction': 'a'}, {'index': 1, 'prediction': 'b'}])
+    index_path = tmp_path / 'results.jsonl.idx'
+    intact_sidecar = index_path.read_text()
+    with open(index_path, 'a', encoding='utf-8') as f:
+        f.write(bad_entry)
+
+    checkpoint = reopen(log_path)
+    assert checkpoint.scan_indices() == {0, 1}
+    assert checkpoint.get(1) == {'index': 1, 'prediction': 'b'}
+    assert index_path.read_text() == intact_sidecar
+
+
+def test_replaced_log_rebuilds_the_sidecar(tmp_path):
+    log_path = tmp_path / 'results.jsonl'
+    append_results(log_path, [{'index': 0, 'prediction': 'a'}, {'index': 1, 'prediction': 'b'}])
+    # Another log of the same size put in its place
+    log_path.write_text(''.join(json.dumps({'index': index, 'prediction': 'x'}) + '\n' for index in (5, 6)))
+
+    checkpoint = reopen(log_path)
+    assert checkpoint.scan_indices() == {5, 6}
+    assert checkpoint.get(6) == {'index': 6, 'prediction': 'x'}
@@ -0,0 +1,50 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+from prompt import build_prompt_caption
+
+
+def dead_base_url(mock_server):
+    """Base URL of a port nobody listens on any more"""
+    server = mock_server()
+    server.stop()
+    return server.base_url
+
+
+def test_dead_and_throttled_live_endpoint_lose_no_items(mock_server):
+    live = mock_server(rate_limit_rate=0.15, retry_after=0)
+    utils.register_endpoint('mock-model', dead_base_url(mock_server), 'test', name='dead', cooldown=0.2)
+    utils.register_endpoint('mock-model', live.base_url, 'test', name='live', cooldown=0.2)
+
+    def process(index):
+        item = {'index': index, 'question': f'question {index}', 'image_path': []}
+        return utils.process_item_generic(item, '.', 'mock-model', build_prompt_caption, 'description',
+                                          max_retries=5, retry_delay=0.01)
+
+    with ThreadPoolExecutor(16) as executor:
+        results = list(executor.map(process, range(150)))
+
+    assert [result['index'] for result in results if result['description'].startswith('ERROR')] == []
+    assert live.stats['rate_limited'] > 0
+    dead, live_endpoint = utils.endpoint_pools['mock-model'].endpoints
+    assert live_endpoint.ejections == 0
+    assert dead.calls < live_endpoint.calls
+
+
+def test_rate_limits_do_not_count_against_endpoint_health():
+    error = type('RateLimited', (Exception,), {'status_code': 429})()
+    assert not utils.is_endpoint_error(error)
+    assert utils.is_endpoint_error(type('ServerError', (Exception,), {'status_code': 503})())
+
+
+def test_all_ejected_fallback_prefers_healthiest_endpoint():
+    pool = utils.EndpointPool('mock-model')
+    dead = utils.Endpoint('dead', None, None, utils.RateLimiter())
+    flaky = utils.Endpoint('flaky', None, None, utils.RateLimiter())
+    pool.add(dead)
+    pool.add(flaky)
+    now = time.monotonic()
+    dead.error_rate, dead.ejected_until = 0.9, now + 10  # returns first
+    flaky.error_rate, flaky.ejected_until = 0.3, now + 100
+    assert pool._pick([]) is flaky
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+import time
+
+import utils
+
+
+def learned_policy(model='mock-model', min_deadline=0.05):
+    policy = utils.HedgePolicy(max_hedge_fraction=1.0, min_samples=1, min_deadline=min_deadline)
+    policy.observe(model, 0.01)
+    return policy
+
+
+def test_slow_request_is_hedged_and_the_duplicate_wins():
+    policy = learned_policy()
+    contexts = []
+
+    def call(hedge=False):
+        contexts.append(utils._call_context.get().get('hedge'))
+        if not hedge:
+            time.sleep(0.5)
+        return 'duplicate' if hedge else 'primary'
+
+    assert policy.run(call, 'mock-model') == 'duplicate'
+    assert (policy.calls, policy.hedged, policy.hedge_wins) == (1, 1, 1)
+    assert contexts == [None, True]
+
+
+def test_no_hedge_while_learning_or_under_the_deadline():
+    policy = utils.HedgePolicy(max_hedge_fraction=1.0, min_samples=2, min_deadline=0.05)
+    policy.observe('mock-model', 0.01)
+    assert policy.deadline('mock-model') is None
+    assert policy.run(lambda hedge=False: 'primary', 'mock-model') == 'primary'
+
+    policy.observe('mock-model', 0.01)
+    assert policy.run(lambda hedge=False: 'primary', 'mock-model') == 'primary'
+    assert (policy.calls, policy.hedged) == (2, 0)
+
+
+def test_async_hedge_cancels_the_losing_request():
+    policy = learned_policy()
+    cancelled = []
+
+    async def call(hedge=False):
+        if hedge:
+            return 'duplicate'
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return 'primary'
+
+    async def main():
+        result = await policy.arun(call, 'mock-model')
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(main()) == 'duplicate'
+    assert cancelled == [True]
+    assert (policy.hedged, policy.hedge_wins) == (1, 1)
+
+
+def test_rate_limiter_wait_neither_triggers_a_hedge_nor_counts_as_latency(mock_server, monkeypatch):
+    server = mock_server()
+    utils.initialize_client(base_url=server.base_url, api_key='test')
+    policy = learned_policy(min_deadline=0.2)
+    monkeypatch.setattr(utils, 'hedge_policy', policy)
+    limiter = utils.RateLimiter(max_concurrency=1)
+    utils.rate_limiters['mock-model'] = limiter
+
+    # Another request holds the only slot for longer than the hedge deadline
+    limiter.acquire()
+    threading.Timer(0.5, limiter.release).start()
+    started = time.perf_counter()
+    assert utils.inference_one_step('question', [], 'mock-model')
+    assert time.perf_counter() - started >= 0.5
+
+    assert (policy.hedged, server.stats['requests']) == (0, 1)
+    latencies = list(policy._latencies[('mock-model', 'default')])
+    assert len(latencies) == 2 and latencies[-1] < 0.5
@@ -0,0 +1,53 @@
+import os
+
+import utils
+
+
+def make_images(tmp_path, count):
+    paths = []
+    for n in range(count):
+        path = tmp_path / f"figure_{n}.png"
+        path.write_bytes(bytes([n]) * 10)
+        paths.append(str(path))
+    return paths
+
+
+def encode(path):
+    return os.path.basename(path) * 100
+
+
+def cached_files(cache_dir):
+    return sorted(os.listdir(cache_dir))
+
+
+def test_disk_layer_is_capped_least_recently_used_first(tmp_path):
+    cache_dir = tmp_path / 'cache'
+    images = make_images(tmp_path, 4)
+    # Room for two encodings of 1200 bytes
+    max_disk_mb = 2500 / 1024 / 1024
+
+    cache = utils.ImageCache(cache_dir=str(cache_dir), max_disk_mb=max_disk_mb)
+    for path in images[:3]:
+        cache.get(path, encode)
+    assert len(cached_files(cache_dir)) == 2
+    assert not os.path.exists(cache._disk_path(cache.make_key(images[0])))
+
+    # A new run indexes the directory; reading an encoding makes it the most recent
+    loads = []
+    rerun = utils.ImageCache(cache_dir=str(cache_dir), max_disk_mb=max_disk_mb)
+    assert rerun.get(images[1], lambda path: loads.append(path)) == encode(images[1])
+    rerun.get(images[3], encode)
+    assert loads == []
+    assert cached_files(cache_dir) == sorted(os.path.basename(rerun._disk_path(rerun.make_key(path)))
+                                             for path in (images[1], images[3]))
+
+
+def test_oversized_directory_is_pruned_on_start(tmp_path):
+    cache_dir = tmp_path / 'cache'
+    cache = utils.ImageCache(cache_dir=str(cache_dir))
+    for path in make_images(tmp_path, 3):
+        cache.get(path, encode)
+    assert len(cached_files(cache_dir)) == 3
+
+    utils.ImageCache(cache_dir=str(cache_dir), max_disk_mb=1500 / 1024 / 1024)
+    assert len(cached_files(cache_dir)) == 1
@@ -0,0 +1,38 @@
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+from prompt import build_prompt_caption
+
+
+def test_metrics_record_every_http_attempt(mock_server, tmp_path):
+    random.seed(7)
+    server = mock_server(error_rate=0.2, rate_limit_rate=0.1, retry_after=0)
+    utils.initialize_client(base_url=server.base_url, api_key='test')
+    sink_path = tmp_path / 'metrics.jsonl'
+    utils.metrics = utils.MetricsRecorder(str(sink_path))
+
+    def process(index):
+        item = {'index': index, 'question': f'question {index}', 'image_path': []}
+        return utils.process_item_generic(item, '.', 'mock-model', build_prompt_caption, 'description',
+                                          max_retries=8, retry_delay=0.01)
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(process, range(60)))
+    utils.metrics.close()
+
+    assert not any(result['description'].startswith('ERROR') for result in results)
+    records = [json.loads(line) for line in sink_path.read_text().splitlines()]
+    failures = server.stats['errors'] + server.stats['rate_limited']
+    assert failures > 0
+    assert len(records) == server.stats['requests']
+    assert sum(record['status'] == 'error' for record in records) == failures
+    assert sorted(record['status_code'] for record in records if record['status'] == 'error') == \
+        sorted([500] * server.stats['errors'] + [429] * server.stats['rate_limited'])
+    # Retried items have one record per attempt, numbered from 1
+    by_index = {}
+    for record in records:
+        by_index.setdefault(record['index'], []).append(record['attempt'])
+    assert all(sorted(attempts) == list(range(1, len(attempts) + 1)) for attempts in by_index.values())
+    assert any(len(attempts) > 1 for attempts in by_index.values())
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+import utils
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+def test_default_limiter_does_not_cap_concurrency():
+    limiter = utils.get_rate_limiter('mock-model')
+    for _ in range(400):
+        assert limiter._try_acquire(0) == 0
+    assert limiter.in_flight == 400
+
+
+def test_first_rate_limit_halves_observed_concurrency():
+    limiter = utils.RateLimiter()
+    for _ in range(100):
+        limiter.acquire()
+    limiter.release(error=RateLimited())
+    assert limiter.concurrency == 50
+
+
+def test_configured_ceiling_still_applies():
+    limiter = utils.RateLimiter(max_concurrency=2)
+    limiter.acquire()
+    limiter.acquire()
+    assert limiter._try_acquire(0) > 0
+
+
+def test_async_engine_runs_max_in_flight_requests_concurrently(mock_server):
+    server = mock_server(latency_ms=500)
+    utils.initialize_client(base_url=server.base_url, api_key='test')
+    limiter = utils.get_rate_limiter('mock-model')
+    release = limiter.release
+    peak = []
+
+    def tracking_release(*args, **kwargs):
+        peak.append(limiter.in_flight)
+        return release(*args, **kwargs)
+
+    limiter.release = tracking_release
+
+    async def run():
+        return await asyncio.gather(*(utils.ainference_one_step(f'question {i}', [], 'mock-model')
+                                      for i in range(200)))
+
+    results = asyncio.run(run())
+    assert not any(result.startswith('ERROR') for result in results)
+    assert max(peak) > 64
+
+
+def test_limiter_sees_every_rate_limited_request(mock_server):
+    server = mock_server(rate_limit_rate=1.0, retry_after=0)
+    utils.initialize_client(base_url=server.base_url, api_key='test')
+
+    with pytest.raises(Exception) as raised:
+        utils.inference_one_step('question', [], 'mock-model')
+
+    assert utils.is_rate_limit_error(raised.value)
+    assert server.stats['requests'] == 1
+    assert utils.get_rate_limiter('mock-model').rate_limited == 1
@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+import refine
+
+
+def make_item():
+    return {'index': 0, 'question': 'Find the acceleration.', 'reasoning': 'a = g sin(theta)',
+            'prediction': 'a = \\boxed{4.9}', 'sig_figs': 2, 'image_description': 'An incline.',
+            'caption': 'A block on an incline.'}
+
+
+def fake_steps(monkeypatch, respond):
+    calls = []
+
+    def run_refinement_step(prompt, model, stage, index, max_retries=5, retry_delay=2):
+        calls.append(stage)
+        return respond(stage, prompt)
+    monkeypatch.setattr(refine, 'run_refinement_step', run_refinement_step)
+    return calls
+
+
+def tagged(step_name, text):
+    step = next(step for step in refine.REFINEMENT_STEPS if step.name == step_name)
+    return f"<{step.tag}>{text}</{step.tag}>"
+
+
+def test_steps_reading_refined_reasoning_run_concurrently_after_step1(monkeypatch):
+    barrier = threading.Barrier(3, timeout=5)
+
+    def respond(stage, prompt):
+        name = stage[len('refine_'):]
+        if name == 'step1_general_refinement':
+            return tagged(name, 'refined')
+        # Steps 2-4 only get past the barrier when all three are in flight
+        assert 'refined' in prompt
+        barrier.wait()
+        return tagged(name, f'{name} output')
+
+    calls = fake_steps(monkeypatch, respond)
+    with refine.ThreadPoolExecutor(3) as executor:
+        item = refine.process_item_multi_step(make_item(), 'mock-model', step_executor=executor)
+    assert calls[0] == 'refine_step1_general_refinement' and len(calls) == 4
+    assert item['refined_reasoning'] == 'refined'
+    assert item['final_refined_reasoning'] == 'step4_completeness output'
+    assert set(item['refinement_steps']) == {step.name for step in refine.REFINEMENT_STEPS}
+
+
+@pytest.mark.parametrize('skip_if_unchanged, expected_calls', [(True, 1), (False, 4)])
+def test_unchanged_reasoning_skips_dependent_steps(monkeypatch, skip_if_unchanged, expected_calls):
+    calls = fake_steps(monkeypatch, lambda stage, prompt: tagged(stage[len('refine_'):], '  a = g   sin(theta) '))
+    item = refine.process_item_multi_step(make_item(), 'mock-model', skip_if_unchanged=skip_if_unchanged)
+    assert len(calls) == expected_calls
+    if skip_if_unchanged:
+        assert item['final_refined_reasoning'] == item['refined_reasoning']
+        assert item['refinement_steps']['step1_general_refinement'] is not None
+        assert item['refinement_steps']['step4_completeness'] is None
+
+
+def test_unmet_step_inputs_raise(monkeypatch):
+    steps = [refine.RefinementStep('a', refine.build_refinement_prompt, 'b_output', 'x', 'a_output'),
+             refine.RefinementStep('b', refine.build_refinement_prompt, 'a_output', 'x', 'b_output')]
+    monkeypatch.setattr(refine, 'REFINEMENT_STEPS', steps)
+    fake_steps(monkeypatch, lambda stage, prompt: '')
+    with pytest.raises(ValueError, match='unmet inputs'):
+        refine.process_item_multi_step(make_item(), 'mock-model')
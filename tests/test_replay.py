@@ -0,0 +1,30 @@
+import json
+
+import pytest
+
+import utils
+from prompt import build_prompt_caption
+
+
+@pytest.fixture
+def replay_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'response_cache', utils.ResponseCache(str(tmp_path / 'cache'), mode='replay'))
+
+
+def test_cache_miss_is_not_stored_as_error(replay_cache):
+    item = {'index': 0, 'question': 'question', 'image_path': []}
+    with pytest.raises(utils.CacheMissError):
+        utils.process_item_generic(item, '.', 'mock-model', build_prompt_caption, 'description')
+
+
+def test_replay_run_writes_no_rows_for_cache_misses(replay_cache, tmp_path):
+    input_path = tmp_path / 'input.json'
+    input_path.write_text(json.dumps([{'index': i, 'question': f'question {i}', 'image_path': []}
+                                      for i in range(5)]))
+    output_path = tmp_path / 'caption.json'
+    utils.run_inference_concurrent(str(input_path), str(output_path), str(tmp_path), model='mock-model',
+                                   prompt_builder=build_prompt_caption, output_field='description')
+
+    checkpoint = utils.open_checkpoint(str(output_path), output_field='description')
+    assert len(checkpoint) == 0
+    assert checkpoint.failed_indices() == set()
@@ -0,0 +1,39 @@
+import json
+import random
+
+import utils
+from benchmark import build_dataset
+from prompt import build_prompt_prediction
+
+
+def run(server, tmp_path, retry_failed=False):
+    utils.initialize_client(base_url=server.base_url, api_key='test')
+    utils.run_inference_concurrent(str(tmp_path / 'input.json'), str(tmp_path / 'prediction.json'), str(tmp_path),
+                                   model='mock-model', max_workers=4, prompt_builder=build_prompt_prediction,
+                                   output_field='prediction', retry_failed=retry_failed, max_retries=1,
+                                   retry_delay=0.01)
+    return {item['index']: item['prediction'] for item in json.loads((tmp_path / 'prediction.json').read_text())}
+
+
+def test_retry_failed_reruns_and_upserts_only_failed_rows(mock_server, tmp_path):
+    random.seed(3)
+    build_dataset(str(tmp_path / 'input.json'), 30)
+    first = run(mock_server(error_rate=0.3), tmp_path)
+    failed = {index for index, prediction in first.items() if prediction.startswith('ERROR:')}
+    assert 0 < len(failed) < 30
+
+    server = mock_server()
+    second = run(server, tmp_path, retry_failed=True)
+    assert server.stats['requests'] == len(failed)
+    assert sorted(second) == list(range(30))
+    assert not any(prediction.startswith('ERROR:') for prediction in second.values())
+    assert {index: first[index] for index in first if index not in failed} == \
+        {index: second[index] for index in second if index not in failed}
+
+    # Retried rows are appended to the log as upserts; successful rows are never rewritten
+    with open(utils.checkpoint_path_for(str(tmp_path / 'prediction.json')), encoding='utf-8') as f:
+        assert len(f.readlines()) == 30 + len(failed)
+
+    nothing_left = mock_server()
+    run(nothing_left, tmp_path, retry_failed=True)
+    assert nothing_left.stats['requests'] == 0
@@ -0,0 +1,56 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import self_consistency
+import utils
+
+
+def fake_samples(monkeypatch, texts):
+    def process_item_generic(item, img_root, model, prompt_builder, output_field, max_retries, retry_delay, sample):
+        return {**item, output_field: texts[sample]}
+    monkeypatch.setattr(self_consistency, 'process_item_generic', process_item_generic)
+
+
+def sample(item, num_samples=3, min_agree=2):
+    with ThreadPoolExecutor(2) as executor:
+        return self_consistency.process_item_self_consistency(item, '.', 'mock-model', None, 'prediction', executor,
+                                                              num_samples, min_agree)
+
+
+def test_majority_answer_wins(monkeypatch):
+    fake_samples(monkeypatch, ['\\boxed{4}', 'x = \\boxed{5.0}', 'x = \\boxed{5.0}'])
+    result = sample({'index': 0}, min_agree=3)
+    assert result['prediction'] == 'x = \\boxed{5.0}'
+    assert result['votes'] == {'5.0': 2, '4': 1}
+    assert result['samples'] == 3
+
+
+@pytest.mark.parametrize('texts, expected', [
+    (['ERROR: timeout', 'The answer is 5', 'ERROR: server error'], 'The answer is 5'),
+    (['ERROR: timeout', 'ERROR: rate limited', 'ERROR: server error'], None),
+])
+def test_samples_without_boxed_answers_fall_back(monkeypatch, texts, expected):
+    fake_samples(monkeypatch, texts)
+    result = sample({'index': 0})
+    assert result['votes'] == {}
+    assert result['samples'] == 3
+    if expected is None:
+        assert result['prediction'].startswith('ERROR:')
+    else:
+        assert result['prediction'] == expected
+
+
+def test_progress_uses_the_current_metrics_recorder(monkeypatch, tmp_path):
+    fake_samples(monkeypatch, ['\\boxed{1}'] * 2)
+    input_path = tmp_path / 'input.json'
+    input_path.write_text(json.dumps([{'index': 0}, {'index': 1}]))
+    stages = []
+    utils.initialize_metrics(str(tmp_path / 'metrics.jsonl'))
+    monkeypatch.setattr(utils.metrics, 'live_counters', lambda stage: stages.append(stage) or {})
+
+    self_consistency.run_self_consistency(str(input_path), str(tmp_path / 'output.json'), '.', max_workers=1,
+                                          num_samples=2, min_agree=2)
+    assert stages == ['prediction', 'prediction']
+    assert [item['votes'] for item in json.loads((tmp_path / 'output.json').read_text())] == [{'1': 2}, {'1': 2}]
@@ -0,0 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+
+def test_initialize_client_with_transport_options_reuses_connections(mock_server):
+    server = mock_server()
+    utils.initialize_client(base_url=server.base_url, api_key='test', max_connections=4,
+                            compress_requests=True, compress_min_bytes=100)
+
+    def call(i):
+        with utils.call_context(stage='transport', index=i):
+            return utils.inference_one_step(f'question {i} ' + 'x' * 1000, [], 'mock-model')
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(call, range(40)))
+
+    assert not any(result.startswith('ERROR') for result in results)
+    stats = utils.metrics._stages['transport']
+    assert stats['calls'] == 40
+    assert 1 <= server.stats['connections'] <= 4
+    assert stats['new_connections'] == server.stats['connections']
+
+
+def test_http_module_matches_openai_client():
+    assert issubclass(utils.DefaultHttpxClient, utils.http_module().Client)
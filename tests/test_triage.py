@@ -0,0 +1,32 @@
+import pytest
+
+from triage import triage_item
+
+
+@pytest.mark.parametrize('prediction, sig_figs, expected', [
+    ('So $a = 4.9\\,\\mathrm{m/s^2}$, i.e. \\boxed{4.9\\,\\mathrm{m/s^2}}', 2, []),
+    ('ERROR: Max retries exceeded', 2, ['error_sentinel']),
+    ('', 2, ['error_sentinel']),
+    ('The acceleration is 4.9', 2, ['missing_box']),
+    ('\\boxed{4.9', 2, ['unterminated_box', 'unbalanced_braces']),
+    ('\\boxed{ }', None, ['empty_box']),
+    ('\\left( x \\boxed{4.9}', 2, ['unbalanced_left_right']),
+    ('\\begin{align} x \\end{aligned} \\boxed{4.9}', 2, ['mismatched_environment']),
+    ('$x = 1 \\boxed{4.9}', 2, ['unbalanced_dollars']),
+    ('\\boxed{4.90}', 2, ['sig_figs']),
+    ('\\boxed{4.9 \\times 10^{3}}', 2, []),
+    ('\\boxed{4900}', 2, []),
+    ('\\boxed{4.9}', None, []),
+])
+def test_triage_flags(prediction, sig_figs, expected):
+    assert triage_item({'prediction': prediction, 'sig_figs': sig_figs, 'question': 'Find a.'}) == expected
+
+
+@pytest.mark.parametrize('answer, expected', [
+    ('\\boxed{4.9\\,\\mathrm{km/s}}', []),
+    ('\\boxed{4900\\,\\mathrm{m/s}}', ['unit']),
+    ('\\boxed{4.9}', []),
+])
+def test_unit_flag_compares_with_the_requested_unit(answer, expected):
+    item = {'question': 'Find the speed (in km/s).', 'prediction': answer, 'sig_figs': 2}
+    assert triage_item(item) == expected
@@ -0,0 +1,143 @@
+import re
+import sys
+import logging
+from collections import Counter
+from utils import iter_json_items
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Exponents and sub/superscripts, removed before counting significant figures
+_EXPONENT_RE = re.compile(r'(?:\\times|\\cdot|×)\s*10\s*\^\s*(?:\{[^{}]*\}|[-+]?\d+)|[\^_]\s*(?:\{[^{}]*\}|[-+]?\d)')
+_TEXT_RE = re.compile(r'\\(?:text|mathrm|rm|operatorname)\s*\{[^{}]*\}')
+_NUMBER_RE = re.compile(r'(?<![\w.])[-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?')
+_REQUESTED_UNIT_RE = re.compile(r'\(\s*in\s+(?:units\s+of\s+)?\$?([^()$]{1,20}?)\$?\s*\)')
+_UNIT_MARKUP_RE = re.compile(r'\\(?:mathrm|text|rm)\b|\\[,;:! ]|[{}~\s]')
+
+
+def extract_boxed(text):
+    """
+    Return the contents of the last `\\boxed{...}` in `text`.
+
+    Returns None when there is no box and False when the last box is never
+    closed. Nested braces are matched.
+    """
+    start = text.rfind('\\boxed{')
+    if start < 0:
+        return None
+    depth = 0
+    for pos in range(start + len('\\boxed'), len(text)):
+        char = text[pos]
+        if char == '{' and text[pos - 1] != '\\':
+            depth += 1
+        elif char == '}' and text[pos - 1] != '\\':
+            depth -= 1
+            if depth == 0:
+                return text[start + len('\\boxed{'):pos]
+    return False
+
+def latex_issues(text):
+    """List structural LaTeX problems: unbalanced braces, \\left/\\right, environments or `$`."""
+    issues = []
+    unescaped = re.sub(r'\\[{}$]', '', text)
+    if unescaped.count('{') != unescaped.count('}'):
+        issues.append('unbalanced_braces')
+    if len(re.findall(r'\\left(?![a-zA-Z])', text)) != len(re.findall(r'\\right(?![a-zA-Z])', text)):
+        issues.append('unbalanced_left_right')
+    environments = []
+    for kind, name in re.findall(r'\\(begin|end)\{([^{}]*)\}', text):
+        if kind == 'begin':
+            environments.append(name)
+        elif not environments or environments.pop() != name:
+            issues.append('mismatched_environment')
+            break
+    else:
+        if environments:
+            issues.append('mismatched_environment')
+    if unescaped.count('$') % 2:
+        issues.append('unbalanced_dollars')
+    return issues
+
+def sig_fig_range(number):
+    """(min, max) significant figures of a decimal literal; trailing zeros of an integer are ambiguous."""
+    mantissa = re.split('[eE]', number.lstrip('+-'))[0]
+    if '.' in mantissa:
+        digits = mantissa.replace('.', '').lstrip('0')
+        return (len(digits), len(digits)) if digits else (1, 1)
+    digits = mantissa.lstrip('0')
+    if not digits:
+        return 1, 1
+    return len(digits.rstrip('0')), len(digits)
+
+def sig_fig_mismatch(answer, sig_figs):
+    """True when a number in `answer` cannot carry `sig_figs` significant figures, or none is given."""
+    body = _EXPONENT_RE.sub(' ', _TEXT_RE.sub(' ', answer))
+    numbers = _NUMBER_RE.findall(body)
+    if not numbers:
+        return True
+    return any(not low <= sig_figs <= high for low, high in map(sig_fig_range, numbers))
+
+def normalize_unit(text):
+    return _UNIT_MARKUP_RE.sub('', text)
+
+def unit_mismatch(question, answer):
+    """True when the question asks "(in <unit>)" and the answer states a unit that is not it."""
+    match = _REQUESTED_UNIT_RE.search(question)
+    stated = _TEXT_RE.findall(answer)
+    if not match or not stated:
+        return False
+    return normalize_unit(match.group(1)) not in normalize_unit(answer)
+
+def triage_item(item, answer_field='prediction'):
+    """
+    Return the reasons `item` needs refinement; an empty list means it is clean.
+
+    Checks for an "ERROR:" sentinel, a missing, unterminated or empty final
+    `\\boxed{}`, broken LaTeX, a significant-figure mismatch against
+    item['sig_figs'] and a unit that differs from one the question asks for.
+    """
+    text = str(item.get(answer_field) or '')
+    if not text or text.startswith('ERROR:'):
+        return ['error_sentinel']
+
+    flags = []
+    answer = extract_boxed(text)
+    if answer is None:
+        flags.append('missing_box')
+    elif answer is False:
+        flags.append('unterminated_box')
+    elif not answer.strip():
+        flags.append('empty_box')
+    flags.extend(latex_issues(text))
+
+    if answer:
+        sig_figs = item.get('sig_figs')
+        try:
+            sig_figs = int(sig_figs) if sig_figs else None
+        except (TypeError, ValueError):
+            sig_figs = None
+        if sig_figs and sig_fig_mismatch(answer, sig_figs):
+            flags.append('sig_figs')
+        if unit_mismatch(str(item.get('question', '')), answer):
+            flags.append('unit')
+    return flags
+
+def summarize_triage(json_path, answer_field='prediction'):
+    """Triage every item of `json_path` in one streaming pass and return (total, flagged, flag counts)."""
+    total = flagged = 0
+    counts = Counter()
+    for item in iter_json_items(json_path):
+        total += 1
+        flags = triage_item(item, answer_field)
+        if flags:
+            flagged += 1
+            counts.update(flags)
+    return total, flagged, counts
+
+if __name__ == '__main__':
+    # Report how many predictions the pre-screen would send to refine.py
+    input_path = sys.argv[1] if len(sys.argv) > 1 else './outputs/prediction.json'
+    total, flagged, counts = summarize_triage(input_path)
+    logger.info(f"{flagged}/{total} items flagged for refinement, {total - flagged} clean")
+    for flag, count in counts.most_common():
+        logger.info(f"  {flag:<24} {count}")
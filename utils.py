@@ -1,73 +1,1449 @@
 import os
+import re
 import time
+import random
+import asyncio
 import json
+import gzip
+import importlib
 import base64
+import sqlite3
+import hashlib
+import shutil
 import logging
+import textwrap
+import threading
+import contextvars
+import multiprocessing
+from contextlib import contextmanager
+from collections import OrderedDict, deque
 from tqdm import tqdm
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, APIConnectionError, DefaultHttpxClient, DefaultAsyncHttpxClient
+from openai.types.chat import ChatCompletion
 from os.path import exists
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Global client instance
+# Global client instances
 client = None
+async_client = None
+
+# Global response cache, see initialize_response_cache()
+response_cache = None
+
+class CacheMissError(Exception):
+    """Raised in replay mode when a request has no cached response."""
+
+class ResponseCache:
+    """
+    On-disk, content-addressed cache of chat completion responses.
+
+    Entries are keyed by a hash of (model, prompt text, image hashes, sampling
+    params) and stored in SQLite. When the stored responses exceed
+    `max_size_mb`, the least recently used entries are evicted.
+
+    Modes:
+        "readwrite": serve hits, call the API on misses and store the result
+        "readonly":  serve hits, call the API on misses but store nothing
+        "replay":    serve hits, raise CacheMissError on misses (no API calls)
+    """
+
+    MODES = ("readwrite", "readonly", "replay")
+
+    def __init__(self, cache_dir, max_size_mb=2048, mode="readwrite"):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown cache mode {mode!r}, expected one of {self.MODES}")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.mode = mode
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, "responses.sqlite3"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, prompt, base64_images, sampling_params):
+        image_hashes = [hashlib.sha256(image.encode('ascii')).hexdigest() for image in base64_images]
+        payload = json.dumps([model, prompt, image_hashes, sampling_params], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the cached response for `key`, or None on a miss."""
+        with self._lock:
+            row = self._db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.mode == "replay":
+                    raise CacheMissError(f"No cached response for key {key[:12]} in replay mode")
+                return None
+            self.hits += 1
+            if self.mode == "readwrite":
+                self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._db.commit()
+            return row[0]
+
+    def put(self, key, response):
+        if self.mode != "readwrite" or response is None:
+            return
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time())
+            )
+            self._size += size - (old[0] if old else 0)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        # Drop least recently used entries until the cache fits its size cap.
+        while self._size > self.max_bytes:
+            rows = self._db.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= size
+                if self._size <= self.max_bytes:
+                    break
+
+def initialize_response_cache(cache_dir="./outputs/llm_cache", max_size_mb=2048, mode="readwrite"):
+    """Enable the global response cache used by inference_one_step and ainference_one_step"""
+    global response_cache
+    response_cache = ResponseCache(cache_dir, max_size_mb=max_size_mb, mode=mode)
+    logger.info(f"Response cache enabled at {cache_dir} (mode: {mode}, cap: {max_size_mb} MB)")
+
+class RateLimiter:
+    """
+    Shared, per-model request limiter.
+
+    Enforces optional requests-per-minute and tokens-per-minute budgets with
+    token buckets, and an adaptive cap on concurrent requests (AIMD): the cap
+    halves on every 429 and grows by one after a full window of successes.
+    A server retry hint pauses every caller of the model, not just the one
+    that received it.
+
+    With `max_concurrency=None` (the default) concurrency is only bounded by
+    the caller's workers or `max_in_flight` until the first 429, which caps
+    it at half the concurrency observed at that moment; from there it grows
+    back without a ceiling. A `max_concurrency` below the caller's worker or
+    in-flight count throttles the run to that many concurrent requests.
+    """
+
+    # 429s from one burst of requests count as a single congestion signal
+    DECREASE_COOLDOWN = 1.0
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_concurrency=None, min_concurrency=1):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = max_concurrency
+        self.in_flight = 0
+        self.rate_limited = 0
+        self._request_bucket = float(requests_per_minute or 0)
+        self._token_bucket = float(tokens_per_minute or 0)
+        self._successes = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.requests_per_minute:
+            self._request_bucket = min(self.requests_per_minute,
+                                       self._request_bucket + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._token_bucket = min(self.tokens_per_minute,
+                                     self._token_bucket + elapsed * self.tokens_per_minute / 60)
+
+    def _try_acquire(self, estimated_tokens):
+        """Take a slot and budget if available; otherwise return how long to wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self.concurrency is not None and self.in_flight >= self.concurrency:
+                return 0.05
+            if self.requests_per_minute and self._request_bucket < 1:
+                return (1 - self._request_bucket) * 60 / self.requests_per_minute
+            if self.tokens_per_minute:
+                # A request larger than the whole budget only waits for a full bucket
+                needed = min(estimated_tokens, self.tokens_per_minute)
+                if self._token_bucket < needed:
+                    return (needed - self._token_bucket) * 60 / self.tokens_per_minute
+            self.in_flight += 1
+            self._request_bucket -= 1
+            self._token_bucket -= estimated_tokens
+            return 0
+
+    def acquire(self, estimated_tokens=0):
+        while True:
+            wait = self._try_acquire(estimated_tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, estimated_tokens=0):
+        while True:
+            wait = self._try_acquire(estimated_tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, estimated_tokens=0, used_tokens=None, error=None):
+        """Return the slot, reconcile the token estimate and adapt concurrency."""
+        with self._lock:
+            self.in_flight -= 1
+            if used_tokens is not None:
+                self._token_bucket -= used_tokens - estimated_tokens
+            if error is not None and is_rate_limit_error(error):
+                self.rate_limited += 1
+                self._successes = 0
+                now = time.monotonic()
+                if now - self._last_decrease >= self.DECREASE_COOLDOWN:
+                    self._last_decrease = now
+                    # Without a cap yet, halve the concurrency this request was running at
+                    concurrency = self.concurrency if self.concurrency is not None else self.in_flight + 1
+                    new_concurrency = max(self.min_concurrency, concurrency // 2)
+                    if new_concurrency < concurrency:
+                        logger.warning(f"Rate limited; reducing concurrency {concurrency} -> {new_concurrency}")
+                    self.concurrency = new_concurrency
+                retry_after = retry_after_seconds(error)
+                if retry_after:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            elif error is None:
+                self._successes += 1
+                if self.concurrency is not None and self._successes >= self.concurrency \
+                        and (self.max_concurrency is None or self.concurrency < self.max_concurrency):
+                    self.concurrency += 1
+                    self._successes = 0
+
+# Per-model rate limiters, see configure_rate_limit()
+rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def configure_rate_limit(model, requests_per_minute=None, tokens_per_minute=None, max_concurrency=None,
+                         min_concurrency=1):
+    """Set request/token budgets and the concurrency ceiling (None: the caller's own concurrency) for one model"""
+    with _rate_limiters_lock:
+        rate_limiters[model] = RateLimiter(requests_per_minute, tokens_per_minute, max_concurrency, min_concurrency)
+
+def get_rate_limiter(model):
+    """Return the limiter for `model`, creating an unbudgeted one on first use"""
+    with _rate_limiters_lock:
+        if model not in rate_limiters:
+            rate_limiters[model] = RateLimiter()
+        return rate_limiters[model]
+
+def split_prompt(prompt):
+    """Return (system, user) text of a prompt; a plain string prompt has no system part"""
+    if isinstance(prompt, str):
+        return None, prompt
+    system, user = prompt
+    return system, user
+
+def estimate_request_tokens(prompt, base64_images):
+    """Rough prompt token estimate used to charge the token budget up front"""
+    system, user = split_prompt(prompt)
+    return (len(system or '') + len(user)) // 4 + 1000 * len(base64_images)
+
+# Tokenizers by model, see count_tokens(); None when tiktoken is unavailable
+_token_encoders = {}
+_token_encoders_lock = threading.Lock()
+
+# Characters per token assumed without a tokenizer. LaTeX-heavy physics text
+# tokenizes denser than prose, so this errs on the side of overcounting.
+FALLBACK_CHARS_PER_TOKEN = 3
+
+def _token_encoder(model):
+    with _token_encoders_lock:
+        if model not in _token_encoders:
+            try:
+                import tiktoken
+            except ImportError:
+                _token_encoders[model] = None
+            else:
+                try:
+                    _token_encoders[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    _token_encoders[model] = tiktoken.get_encoding("o200k_base")
+        return _token_encoders[model]
+
+def count_tokens(text, model=None):
+    """Token count of `text`, exact when tiktoken is installed, otherwise a conservative estimate"""
+    encoder = _token_encoder(model or "gpt-4o")
+    if encoder is None:
+        return -(-len(text) // FALLBACK_CHARS_PER_TOKEN)
+    return len(encoder.encode(text, disallowed_special=()))
+
+def iter_token_batches(items, item_tokens, token_budget, overhead_tokens=0, max_items=None):
+    """
+    Pack `items`, in order, into batches whose estimated prompt size fits `token_budget`.
+
+    `item_tokens(item)` is the cost of one item as rendered in the prompt and
+    `overhead_tokens` the fixed cost of the prompt around the items. A batch is
+    closed when the next item would exceed the budget or when it holds
+    `max_items`; an item that alone exceeds the budget gets a batch of its own.
+    Items are consumed lazily and batches are yielded as lists.
+    """
+    batch, used = [], overhead_tokens
+    for item in items:
+        cost = item_tokens(item)
+        if batch and (used + cost > token_budget or (max_items and len(batch) >= max_items)):
+            yield batch
+            batch, used = [], overhead_tokens
+        if not batch and overhead_tokens + cost > token_budget:
+            logger.warning(f"Item {item.get('index', '?')} alone needs ~{overhead_tokens + cost} tokens, "
+                           f"over the batch budget of {token_budget}")
+        batch.append(item)
+        used += cost
+    if batch:
+        yield batch
+
+def is_rate_limit_error(error):
+    return getattr(error, 'status_code', None) == 429
+
+def retry_after_seconds(error):
+    """Read the server's retry hint (Retry-After / retry-after-ms) from an API error, if any"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def backoff_delay(attempt, base_delay=2, max_delay=60, error=None):
+    """Jittered exponential backoff for retry `attempt` (1-based), honoring server retry hints"""
+    retry_after = retry_after_seconds(error) if error is not None else None
+    if retry_after:
+        return retry_after + random.uniform(0, 1)
+    delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+# Per-call context (stage, index, attempt) attached to metrics records.
+# Context variables are local to each thread and asyncio task.
+_call_context = contextvars.ContextVar('call_context', default={})
+
+@contextmanager
+def call_context(**fields):
+    """Attach fields such as stage, index or attempt to every API call made inside the block"""
+    token = _call_context.set({**_call_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _call_context.reset(token)
+
+class MetricsRecorder:
+    """
+    Per-call metrics for every LLM request.
+
+    Each call is recorded with its model, stage, index, attempt, status
+    ("ok", "error" or "cache_hit"), latency and prompt/completion/reasoning
+    token counts, plus the prompt tokens the provider served from its prefix
+    cache. Records are appended to a JSONL sink when `sink_path` is
+    set, and aggregated per stage in memory for live counters and `report()`.
+    """
+
+    def __init__(self, sink_path=None):
+        self.sink_path = sink_path
+        self._file = None
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record_call(self, model, latency=0.0, status="ok", usage=None, error=None):
+        context = _call_context.get()
+        details = getattr(usage, 'completion_tokens_details', None)
+        prompt_details = getattr(usage, 'prompt_tokens_details', None)
+        record = {
+            'ts': time.time(),
+            'model': model,
+            'stage': context.get('stage', 'default'),
+            'index': context.get('index'),
+            'attempt': context.get('attempt', 1),
+            'status': "error" if error is not None else status,
+            'latency_s': round(latency, 4),
+            'prompt_tokens': getattr(usage, 'prompt_tokens', None) or 0,
+            'completion_tokens': getattr(usage, 'completion_tokens', None) or 0,
+            'reasoning_tokens': getattr(details, 'reasoning_tokens', None) or 0,
+            'cached_tokens': getattr(prompt_details, 'cached_tokens', None) or 0,
+        }
+        trace = _connection_trace.get()
+        if trace is not None:
+            record['new_connections'] = trace['new_connections']
+            record['connect_s'] = round(trace['connect_s'], 4)
+        if context.get('hedge'):
+            record['hedge'] = True
+        if context.get('endpoint'):
+            record['endpoint'] = context['endpoint']
+        if error is not None:
+            record['error'] = f"{type(error).__name__}: {error}"[:500]
+            if getattr(error, 'status_code', None) is not None:
+                record['status_code'] = error.status_code
+        self.add(record)
+
+    def add(self, record):
+        """Aggregate one call record and write it to the sink."""
+        with self._lock:
+            stats = self._stages.setdefault(record['stage'], {
+                'calls': 0, 'ok': 0, 'errors': 0, 'cache_hits': 0, 'latencies': [],
+                'prompt_tokens': 0, 'completion_tokens': 0, 'reasoning_tokens': 0, 'cached_tokens': 0,
+                'new_connections': 0, 'connect_s': 0.0,
+            })
+            stats['calls'] += 1
+            stats[{'ok': 'ok', 'error': 'errors', 'cache_hit': 'cache_hits'}[record['status']]] += 1
+            if record['status'] != 'cache_hit':
+                stats['latencies'].append(record['latency_s'])
+            for field in ('prompt_tokens', 'completion_tokens', 'reasoning_tokens', 'cached_tokens',
+                          'new_connections', 'connect_s'):
+                stats[field] += record.get(field, 0)
+            if self.sink_path:
+                if self._file is None:
+                    self._file = open(self.sink_path, 'a', encoding='utf-8')
+                self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                self._file.flush()
+
+    def latencies(self, stage=None):
+        """Latencies (seconds) of API calls, for one stage or all of them."""
+        with self._lock:
+            stages = [self._stages[stage]] if stage in self._stages else ([] if stage else self._stages.values())
+            return [latency for stats in stages for latency in stats['latencies']]
+
+    def live_counters(self, stage):
+        """Short counters for a progress bar postfix."""
+        with self._lock:
+            stats = self._stages.get(stage)
+            if not stats:
+                return {}
+            latencies = stats['latencies']
+            return {
+                'calls': stats['calls'],
+                'err': stats['errors'],
+                'tok': stats['prompt_tokens'] + stats['completion_tokens'],
+                'avg_s': round(sum(latencies) / len(latencies), 1) if latencies else 0,
+            }
+
+    def report(self):
+        """
+        Per-stage summary of calls, tokens and latency.
+
+        "cached tok" counts prompt tokens hit in the provider's prefix cache;
+        "new conn" and "setup s" count the connections opened and the time
+        spent on TCP/TLS setup (only tracked with transport options, see
+        build_http_clients).
+        """
+        header = f"{'stage':<36} {'calls':>6} {'errors':>6} {'cached':>6} {'prompt tok':>11} {'cached tok':>10} " \
+                 f"{'compl tok':>10} {'reason tok':>10} {'total s':>9} {'p50 s':>7} {'p95 s':>7} " \
+                 f"{'new conn':>8} {'setup s':>7}"
+        lines = [header, '-' * len(header)]
+        with self._lock:
+            for stage, stats in sorted(self._stages.items()):
+                latencies = sorted(stats['latencies'])
+                p50 = latencies[int(0.50 * (len(latencies) - 1))] if latencies else 0
+                p95 = latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0
+                lines.append(
+                    f"{stage:<36} {stats['calls']:>6} {stats['errors']:>6} {stats['cache_hits']:>6} "
+                    f"{stats['prompt_tokens']:>11} {stats['cached_tokens']:>10} "
+                    f"{stats['completion_tokens']:>10} {stats['reasoning_tokens']:>10} "
+                    f"{sum(latencies):>9.1f} {p50:>7.2f} {p95:>7.2f} "
+                    f"{stats['new_connections']:>8} {stats['connect_s']:>7.2f}"
+                )
+        return '\n'.join(lines)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+# Global metrics recorder; in-memory only until initialize_metrics() sets a sink
+metrics = MetricsRecorder()
+
+def initialize_metrics(sink_path="./outputs/metrics.jsonl"):
+    """Write a JSONL record for every LLM call to `sink_path`"""
+    global metrics
+    os.makedirs(os.path.dirname(sink_path) or '.', exist_ok=True)
+    metrics = MetricsRecorder(sink_path)
+
+def metrics_report():
+    """Per-stage report of the calls recorded in this process"""
+    return metrics.report()
+
+def summarize_metrics(sink_path="./outputs/metrics.jsonl"):
+    """Build the per-stage report from a metrics JSONL file, e.g. across several runs"""
+    recorder = MetricsRecorder()
+    with open(sink_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                recorder.add(json.loads(line))
+    return recorder.report()
+
+def run_in_thread(fn):
+    """Run `fn` in a new daemon thread with the caller's call context; returns a Future"""
+    future = Future()
+    context = contextvars.copy_context()
+
+    def target():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(context.run(fn))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+class HedgePolicy:
+    """
+    Speculative duplicate ("hedged") requests against tail latency.
+
+    Callers report the HTTP latency of successful requests with `observe()`;
+    they are kept per (model, stage) over the last `window` calls. Once
+    `min_samples` are known, a request still running after the `percentile`
+    latency (at least `min_deadline` seconds) gets a duplicate, and the first
+    success wins. At most `max_hedge_fraction` of the requests are hedged. The
+    duplicate is made by calling the request function with `hedge=True`. In
+    the async engine the losing request is cancelled; a synchronous request
+    cannot be interrupted from another thread, so the loser finishes in the
+    background and its answer is discarded. Duplicates are recorded in the
+    call metrics with `hedge: true`.
+    """
+
+    def __init__(self, percentile=95, max_hedge_fraction=0.05, min_samples=20, window=500, min_deadline=1.0):
+        self.percentile = percentile
+        self.max_hedge_fraction = max_hedge_fraction
+        self.min_samples = min_samples
+        self.window = window
+        self.min_deadline = min_deadline
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def _key(self, model):
+        return model, _call_context.get().get('stage', 'default')
+
+    def deadline(self, model):
+        """Seconds after which a request to `model` in the current stage is hedged, or None while learning"""
+        with self._lock:
+            latencies = self._latencies.get(self._key(model))
+            if not latencies or len(latencies) < self.min_samples:
+                return None
+            ordered = sorted(latencies)
+        return max(self.min_deadline, ordered[int(self.percentile / 100 * (len(ordered) - 1))])
+
+    def observe(self, model, latency):
+        with self._lock:
+            latencies = self._latencies.setdefault(self._key(model), deque(maxlen=self.window))
+            latencies.append(latency)
+
+    def _start(self):
+        with self._lock:
+            self.calls += 1
+
+    def _try_hedge(self):
+        with self._lock:
+            if self.hedged + 1 > self.max_hedge_fraction * self.calls:
+                return False
+            self.hedged += 1
+            return True
+
+    def _won(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    @staticmethod
+    def _duplicate(fn):
+        with call_context(hedge=True):
+            return fn(hedge=True)
+
+    @staticmethod
+    async def _aduplicate(coroutine_fn):
+        with call_context(hedge=True):
+            return await coroutine_fn(hedge=True)
+
+    def run(self, fn, model):
+        """Call `fn()`, hedging it with `fn(hedge=True)` if it outlives the deadline"""
+        self._start()
+        deadline = self.deadline(model)
+        if deadline is None:
+            return fn()
+
+        primary = run_in_thread(fn)
+        done, _ = wait([primary], timeout=deadline)
+        if done or not self._try_hedge():
+            return primary.result()
+
+        logger.info(f"Request to {model} still running after {deadline:.1f}s; sending a hedged duplicate")
+        hedge = run_in_thread(lambda: self._duplicate(fn))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._won()
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def arun(self, coroutine_fn, model):
+        """Async counterpart of run; the losing request is cancelled"""
+        self._start()
+        deadline = self.deadline(model)
+        if deadline is None:
+            return await coroutine_fn()
+
+        primary = asyncio.ensure_future(coroutine_fn())
+        done, _ = await asyncio.wait({primary}, timeout=deadline)
+        if done or not self._try_hedge():
+            return await primary
+
+        logger.info(f"Request to {model} still running after {deadline:.1f}s; sending a hedged duplicate")
+        hedge = asyncio.ensure_future(self._aduplicate(coroutine_fn))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._won()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def report(self):
+        rate = self.hedged / self.calls if self.calls else 0.0
+        return f"Hedged {self.hedged}/{self.calls} requests ({rate:.1%}); the duplicate won {self.hedge_wins} times"
+
+# Global hedging policy; None (no hedging) until configure_hedging() is called
+hedge_policy = None
+
+def configure_hedging(percentile=95, max_hedge_fraction=0.05, min_samples=20, window=500, min_deadline=1.0):
+    """Hedge requests that outlive the `percentile` latency of their stage, up to `max_hedge_fraction` of calls"""
+    global hedge_policy
+    hedge_policy = HedgePolicy(percentile, max_hedge_fraction, min_samples, window, min_deadline)
+    return hedge_policy
 
 def safe_inference(prompt, model='gpt-4o', max_retries=5, retry_delay=2):
     """Execute inference with retry mechanism"""
     attempt = 0
     while attempt < max_retries:
         try:
-            response = inference_one_step(prompt, [], model)
+            with call_context(attempt=attempt + 1):
+                response = inference_one_step(prompt, [], model)
             return response
+        except CacheMissError:
+            raise
         except Exception as e:
             attempt += 1
             logger.error(f"Attempt {attempt} failed: {e}")
             if attempt < max_retries:
-                logger.info(f"Waiting {retry_delay} seconds before retrying...")
-                import time
-                time.sleep(retry_delay)
-                retry_delay += 2
+                delay = backoff_delay(attempt, retry_delay, error=e)
+                logger.info(f"Waiting {delay:.1f} seconds before retrying...")
+                time.sleep(delay)
             else:
                 logger.error("Max retries reached. Skipping this item.")
                 return "ERROR: Max retries reached."
 
-def initialize_client(base_url="", api_key=""):
-    """Initialize the OpenAI client globally"""
-    global client
-    client = OpenAI(base_url=base_url, api_key=api_key)
+# Connections opened and seconds spent setting them up (TCP + TLS) by the current API request,
+# filled in by the transport trace hooks of a client built with transport options
+_connection_trace = contextvars.ContextVar('connection_trace', default=None)
+_trace_connections = False
 
-def encode_image(image_path):
-    """Encode image to base64 string"""
+@contextmanager
+def connection_trace():
+    """Collect the connection setup of the API request made inside the block for its metrics record"""
+    if not _trace_connections:
+        yield
+        return
+    token = _connection_trace.set({'new_connections': 0, 'connect_s': 0.0})
+    try:
+        yield
+    finally:
+        _connection_trace.reset(token)
+
+def _trace_connection(event_name, info):
+    trace = _connection_trace.get()
+    if trace is None:
+        return
+    if event_name == "connection.connect_tcp.started":
+        trace['new_connections'] += 1
+        trace['_setup_started'] = time.perf_counter()
+    elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete") \
+            and trace.get('_setup_started') is not None:
+        now = time.perf_counter()
+        trace['connect_s'] += now - trace['_setup_started']
+        trace['_setup_started'] = now
+
+async def _atrace_connection(event_name, info):
+    _trace_connection(event_name, info)
+
+def http_module():
+    """The httpx package behind the installed OpenAI client (`httpx`, or `httpx2` in newer releases)"""
+    base = next(cls for cls in DefaultHttpxClient.__mro__ if cls.__name__ == 'Client')
+    return importlib.import_module(base.__module__.split('.')[0])
+
+def _compress_request(request, min_bytes):
+    """Gzip a large request body in place, for endpoints that accept Content-Encoding: gzip"""
+    httpx = http_module()
+    body = request.read()
+    if len(body) < min_bytes or 'content-encoding' in request.headers:
+        return
+    compressed = gzip.compress(body, compresslevel=1)
+    request.stream = httpx.ByteStream(compressed)
+    request.headers['Content-Encoding'] = 'gzip'
+    request.headers['Content-Length'] = str(len(compressed))
+
+def build_http_clients(max_connections=100, max_keepalive_connections=None, keepalive_expiry=60.0, http2=False,
+                       connect_timeout=10.0, timeout=600.0, compress_requests=False, compress_min_bytes=65536):
+    """
+    Build the sync and async HTTP clients used by the OpenAI clients.
+
+    The connection pool holds up to `max_connections`, of which
+    `max_keepalive_connections` (all by default) stay open for
+    `keepalive_expiry` idle seconds, so a steady number of workers keeps
+    reusing warm connections instead of repeating TCP and TLS handshakes.
+    `http2` multiplexes requests over fewer connections (requires
+    the `h2` package). `compress_requests` gzips request bodies of
+    at least `compress_min_bytes`; only enable it for endpoints that accept
+    compressed requests. Every request is traced so the call metrics record
+    whether it opened a new connection and how long the setup took.
+    """
+    httpx = http_module()
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("HTTP/2 requested but the h2 package is not installed; using HTTP/1.1")
+            http2 = False
+    limits = httpx.Limits(max_connections=max_connections,
+                          max_keepalive_connections=max_keepalive_connections or max_connections,
+                          keepalive_expiry=keepalive_expiry)
+    timeouts = httpx.Timeout(timeout, connect=connect_timeout)
+
+    def on_request(request):
+        request.extensions['trace'] = _trace_connection
+        if compress_requests:
+            _compress_request(request, compress_min_bytes)
+
+    async def aon_request(request):
+        request.extensions['trace'] = _atrace_connection
+        if compress_requests:
+            _compress_request(request, compress_min_bytes)
+
+    http_client = DefaultHttpxClient(limits=limits, timeout=timeouts, http2=http2,
+                                     event_hooks={'request': [on_request]})
+    async_http_client = DefaultAsyncHttpxClient(limits=limits, timeout=timeouts, http2=http2,
+                                                event_hooks={'request': [aon_request]})
+    return http_client, async_http_client
+
+def initialize_client(base_url="", api_key="", **transport_options):
+    """
+    Initialize the OpenAI clients (sync and async) globally.
+
+    Without `transport_options` the OpenAI defaults are used; otherwise they
+    are passed to build_http_clients (e.g. max_connections, http2, timeout).
+    """
+    global client, async_client, _trace_connections
+    _trace_connections = bool(transport_options)
+    # No retries inside the SDK: the rate limiter, the call metrics and the callers' retry loops
+    # must see every HTTP request (the Batch API calls opt back in, see BATCH_API_MAX_RETRIES)
+    client_options = {'base_url': base_url, 'api_key': api_key, 'max_retries': 0}
+    if not transport_options:
+        client = OpenAI(**client_options)
+        async_client = AsyncOpenAI(**client_options)
+        return
+    http_client, async_http_client = build_http_clients(**transport_options)
+    client = OpenAI(**client_options, http_client=http_client)
+    async_client = AsyncOpenAI(**client_options, http_client=async_http_client)
+
+def is_endpoint_error(error):
+    """
+    Whether `error` points at a broken endpoint (unreachable, failing or refusing the key) rather than the request.
+
+    Rate limiting (429) is not a fault of the endpoint; it is left to the
+    endpoint's rate limiter and the retry logic.
+    """
+    if isinstance(error, APIConnectionError):
+        return True
+    status = getattr(error, 'status_code', None)
+    return status is not None and (status in (401, 403, 408) or status >= 500)
+
+class Endpoint:
+    """An OpenAI-compatible endpoint serving one model, with its own clients, rate limiter and health stats"""
+
+    def __init__(self, name, client, async_client, limiter, weight=1.0, model_name=None):
+        self.name = name
+        self.client = client
+        self.async_client = async_client
+        self.limiter = limiter
+        self.weight = weight
+        self.model_name = model_name
+        self.latency = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+class EndpointPool:
+    """
+    Load balancing and failover across the endpoints registered for one model.
+
+    Each request goes to the available endpoint with the lowest expected wait,
+    (in flight + 1) * latency / weight, inflated by its recent error rate, so
+    traffic follows the weights while slow or failing endpoints get less of
+    it. Latency and error rate are moving averages over recent calls. After
+    `eject_after` consecutive endpoint errors (connection failures, timeouts,
+    401/403, 5xx) an endpoint is ejected for `cooldown` seconds, doubling
+    with every repeated ejection up to `max_cooldown`; it then rejoins on
+    probation, where a single further error ejects it again. A request that
+    fails with an endpoint error, or is rate limited, is retried at once on
+    the best endpoint it has not tried yet; rate limiting does not count
+    against the endpoint's health, and errors caused by the request itself
+    are raised unchanged. While every endpoint is ejected, the one with the
+    best recent health is used.
+    """
+
+    # Weight of the latest call in the latency and error rate averages
+    SMOOTHING = 0.2
+
+    def __init__(self, model, eject_after=3, cooldown=30.0, max_cooldown=600.0):
+        self.model = model
+        self.eject_after = eject_after
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.endpoints = []
+        self.failovers = 0
+        self._lock = threading.Lock()
+
+    def add(self, endpoint):
+        with self._lock:
+            self.endpoints.append(endpoint)
+
+    def _expected_wait(self, endpoint, default_latency):
+        latency = endpoint.latency if endpoint.latency is not None else default_latency
+        return (endpoint.in_flight + 1) * latency / endpoint.weight / max(0.05, 1 - endpoint.error_rate)
+
+    def _pick(self, tried):
+        """Reserve the next endpoint to try, or None once failover has run out of healthy endpoints"""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in tried]
+            available = [endpoint for endpoint in candidates if endpoint.ejected_until <= now]
+            if available:
+                # Endpoints without latency samples yet compete as the fastest known one, so they get probed
+                known = [endpoint.latency for endpoint in self.endpoints if endpoint.latency is not None]
+                default_latency = min(known, default=1.0)
+                endpoint = min(available, key=lambda e: self._expected_wait(e, default_latency))
+            elif candidates and not tried:
+                endpoint = min(candidates, key=lambda e: (e.error_rate, e.consecutive_errors, e.ejected_until))
+            else:
+                return None
+            endpoint.in_flight += 1
+            return endpoint
+
+    def _finish(self, endpoint, latency=None, failed=False):
+        """Release the endpoint; `latency` is None when the call says nothing about its health"""
+        with self._lock:
+            endpoint.in_flight -= 1
+            if latency is None:
+                return
+            endpoint.calls += 1
+            if not failed:
+                endpoint.latency = latency if endpoint.latency is None \
+                    else self.SMOOTHING * latency + (1 - self.SMOOTHING) * endpoint.latency
+                endpoint.error_rate *= 1 - self.SMOOTHING
+                endpoint.consecutive_errors = 0
+                endpoint.ejections = 0
+                return
+            endpoint.errors += 1
+            endpoint.error_rate = self.SMOOTHING + (1 - self.SMOOTHING) * endpoint.error_rate
+            endpoint.consecutive_errors += 1
+            now = time.monotonic()
+            if endpoint.consecutive_errors >= self.eject_after and endpoint.ejected_until <= now:
+                cooldown = min(self.max_cooldown, self.cooldown * 2 ** endpoint.ejections)
+                endpoint.ejections += 1
+                endpoint.ejected_until = now + cooldown
+                logger.warning(f"Ejecting endpoint {endpoint.name} for {self.model} for {cooldown:.0f}s "
+                               f"after {endpoint.consecutive_errors} consecutive errors")
+
+    def _settle_error(self, endpoint, error, latency, tried):
+        """Account for a failed call and return the endpoint to retry it on, or None to raise the error"""
+        if is_endpoint_error(error):
+            self._finish(endpoint, latency, failed=True)
+        else:
+            self._finish(endpoint)
+            if not is_rate_limit_error(error):
+                return None
+        next_endpoint = self._pick(tried)
+        if next_endpoint is not None:
+            with self._lock:
+                self.failovers += 1
+            logger.warning(f"Request to {self.model} failed on {endpoint.name} ({error}); "
+                           f"failing over to {next_endpoint.name}")
+        return next_endpoint
+
+    def run(self, request_fn):
+        """Call `request_fn(endpoint)` on the best endpoint, failing over to the others on endpoint errors"""
+        tried = []
+        endpoint = self._pick(tried)
+        while True:
+            tried.append(endpoint)
+            started = time.perf_counter()
+            try:
+                with call_context(endpoint=endpoint.name):
+                    result = request_fn(endpoint)
+            except Exception as e:
+                endpoint = self._settle_error(endpoint, e, time.perf_counter() - started, tried)
+                if endpoint is None:
+                    raise
+                continue
+            self._finish(endpoint, time.perf_counter() - started)
+            return result
+
+    async def arun(self, coroutine_fn):
+        """Async counterpart of run; a cancelled request only gives its endpoint slot back"""
+        tried = []
+        endpoint = self._pick(tried)
+        while True:
+            tried.append(endpoint)
+            started = time.perf_counter()
+            try:
+                with call_context(endpoint=endpoint.name):
+                    result = await coroutine_fn(endpoint)
+            except asyncio.CancelledError:
+                self._finish(endpoint)
+                raise
+            except Exception as e:
+                endpoint = self._settle_error(endpoint, e, time.perf_counter() - started, tried)
+                if endpoint is None:
+                    raise
+                continue
+            self._finish(endpoint, time.perf_counter() - started)
+            return result
+
+    def report(self):
+        with self._lock:
+            total = sum(endpoint.calls for endpoint in self.endpoints)
+            lines = [f"Endpoints for {self.model}: {self.failovers} failovers"]
+            now = time.monotonic()
+            for endpoint in self.endpoints:
+                share = endpoint.calls / total if total else 0.0
+                latency = f"{endpoint.latency:.2f}s" if endpoint.latency is not None else "n/a"
+                state = f", ejected for {endpoint.ejected_until - now:.0f}s" if endpoint.ejected_until > now else ""
+                lines.append(f"  {endpoint.name:<24} weight {endpoint.weight:<5g} {endpoint.calls:>6} calls "
+                             f"({share:.1%}), {endpoint.errors} errors, latency {latency}{state}")
+        return '\n'.join(lines)
+
+# Endpoint pools by model, see register_endpoint(); models without one use the global client
+endpoint_pools = {}
+_endpoint_pools_lock = threading.Lock()
+
+def register_endpoint(model, base_url, api_key, weight=1.0, name=None, model_name=None, requests_per_minute=None,
+                      tokens_per_minute=None, max_concurrency=None, eject_after=3, cooldown=30.0, **transport_options):
+    """
+    Add an OpenAI-compatible endpoint serving `model` to the model's endpoint pool.
+
+    Requests for `model` are then balanced across all its registered
+    endpoints (see EndpointPool) instead of going to the global client. Each
+    endpoint has its own rate limiter, since budgets are per key. The Batch
+    API mode keeps using the global client.
+
+    Args:
+        model: Model name used by the scripts (and in the call metrics)
+        base_url: Endpoint base URL
+        api_key: API key for this endpoint
+        weight: Relative share of the traffic at equal latency
+        name: Label in logs and metrics; defaults to the base URL
+        model_name: Model name expected by this endpoint, if it differs from `model`
+        requests_per_minute: Request budget of this endpoint's key
+        tokens_per_minute: Token budget of this endpoint's key
+        max_concurrency: Ceiling of concurrent requests to this endpoint (None: no ceiling)
+        eject_after: Consecutive endpoint errors before the endpoint is ejected (pool-wide)
+        cooldown: Seconds of the first ejection (pool-wide)
+        **transport_options: Passed to build_http_clients, as for initialize_client
+    """
+    # The pool fails over instead of letting the client retry on the same endpoint
+    client_options = {'base_url': base_url, 'api_key': api_key, 'max_retries': 0}
+    if transport_options:
+        http_client, async_http_client = build_http_clients(**transport_options)
+        sync_client = OpenAI(**client_options, http_client=http_client)
+        async_api_client = AsyncOpenAI(**client_options, http_client=async_http_client)
+    else:
+        sync_client = OpenAI(**client_options)
+        async_api_client = AsyncOpenAI(**client_options)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute, max_concurrency)
+    endpoint = Endpoint(name or base_url, sync_client, async_api_client, limiter, weight, model_name)
+    with _endpoint_pools_lock:
+        pool = endpoint_pools.get(model)
+        if pool is None:
+            pool = endpoint_pools[model] = EndpointPool(model, eject_after, cooldown)
+        pool.eject_after = eject_after
+        pool.cooldown = cooldown
+    pool.add(endpoint)
+    logger.info(f"Registered endpoint {endpoint.name} for {model} (weight {weight})")
+    return endpoint
+
+class ImageCache:
+    """
+    Bounded cache of base64-encoded images, keyed by path, mtime and size.
+
+    Encoded images are kept in an in-process LRU capped at `max_size_mb`.
+    Concurrent requests for the same figure wait for a single encode instead
+    of each reading the file. With `cache_dir` set, encodings are also
+    persisted to disk so later stages (e.g. prediction after caption) reuse them;
+    the directory is capped at `max_disk_mb`, least recently used files first
+    (by mtime, so the order carries over between runs).
+    """
+
+    def __init__(self, max_size_mb=256, cache_dir=None, max_disk_mb=1024):
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.max_disk_bytes = int(max_disk_mb * 1024 * 1024)
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._disk_files = OrderedDict()
+        self._disk_size = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._index_disk()
+
+    @staticmethod
+    def make_key(image_path, variant=""):
+        stat = os.stat(image_path)
+        return f"{os.path.abspath(image_path)}|{stat.st_mtime_ns}|{stat.st_size}|{variant}"
+
+    def get(self, image_path, loader, variant=""):
+        """
+        Return the cached encoding of `image_path`, computing it with `loader` on a miss.
+
+        `variant` distinguishes encodings of the same file made with different
+        preprocessing settings.
+        """
+        key = self.make_key(image_path, variant)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+        if not owner:
+            return future.result()
+
+        try:
+            value = self._load_persisted(key)
+            if value is None:
+                value = loader(image_path)
+                self._persist(key, value)
+            future.set_result(value)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        self._remember(key, value)
+        return value
+
+    def _remember(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.b64')
+
+    def _index_disk(self):
+        """Index the persisted encodings left by earlier runs, least recently used first"""
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.b64'):
+                stat = entry.stat()
+                files.append((stat.st_mtime_ns, entry.path, stat.st_size))
+        for _, path, size in sorted(files):
+            self._disk_files[path] = size
+            self._disk_size += size
+        with self._lock:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        while self._disk_size > self.max_disk_bytes and len(self._disk_files) > 1:
+            path, size = self._disk_files.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process sharing the directory pruned it first
+                pass
+
+    def _load_persisted(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='ascii') as f:
+                value = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if path in self._disk_files:
+                self._disk_files.move_to_end(path)
+        return value
+
+    def _persist(self, key, value):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='ascii') as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._disk_size += len(value) - self._disk_files.pop(path, 0)
+            self._disk_files[path] = len(value)
+            self._prune_disk()
+
+# Global image cache, always on in-process; see initialize_image_cache() for persistence
+image_cache = ImageCache()
+
+def initialize_image_cache(cache_dir=None, max_size_mb=256, max_disk_mb=1024):
+    """Configure the global image cache, optionally persisting up to `max_disk_mb` of encodings under `cache_dir`"""
+    global image_cache
+    image_cache = ImageCache(max_size_mb=max_size_mb, cache_dir=cache_dir, max_disk_mb=max_disk_mb)
+
+def _preprocess_image_file(src_path, dst_path, max_side, image_format, quality, keep_line_art_lossless):
+    """
+    Downscale and recompress one image file (runs in a worker process).
+
+    Images with transparency or only a few colors (typical line diagrams)
+    stay PNG when `keep_line_art_lossless` is set; everything else is
+    re-encoded as `image_format`. The original bytes are kept if they are already smaller
+    and no resize was needed.
+    """
+    from PIL import Image
+
+    with Image.open(src_path) as img:
+        img.load()
+        # Judge the palette before resampling, which adds anti-aliasing shades
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        lossless = keep_line_art_lossless and (has_alpha or img.getcolors(maxcolors=64) is not None)
+
+        resized = max(img.size) > max_side
+        if resized:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        tmp_path = f"{dst_path}.{os.getpid()}.tmp"
+        if lossless:
+            img.save(tmp_path, format='PNG', optimize=True)
+        else:
+            img.convert('RGB').save(tmp_path, format=image_format, quality=quality)
+
+    if not resized and os.path.getsize(tmp_path) >= os.path.getsize(src_path):
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+    return dst_path
+
+class ImagePreprocessor:
+    """
+    Optional stage that shrinks images before they are base64-encoded.
+
+    Images are resized to at most `max_side` pixels on the longer side and
+    recompressed (see _preprocess_image_file) in a process pool, so the CPU
+    work does not hold the GIL of the request threads. Results are cached
+    under `cache_dir`, so captioning and prediction share the same payloads.
+    Requires Pillow.
+    """
+
+    def __init__(self, cache_dir, max_side=1536, image_format="JPEG", quality=85,
+                 keep_line_art_lossless=True, max_workers=None):
+        try:
+            import PIL  # noqa: F401
+        except ImportError as e:
+            raise ImportError("Image preprocessing requires Pillow: pip install pillow") from e
+        if image_format not in ("JPEG", "WEBP"):
+            raise ValueError(f"Unsupported image format {image_format!r}, expected 'JPEG' or 'WEBP'")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.settings = (max_side, image_format, quality, keep_line_art_lossless)
+        self.signature = "|".join(str(value) for value in self.settings)
+        # Spawned workers avoid forking a process that already runs request threads.
+        self._pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def process(self, image_path):
+        """Return the path of the preprocessed copy of `image_path`, creating it if needed."""
+        key = ImageCache.make_key(image_path, self.signature)
+        dst_path = os.path.join(self.cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.img')
+        if not exists(dst_path):
+            self._pool.submit(_preprocess_image_file, image_path, dst_path, *self.settings).result()
+        return dst_path
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+# Global image preprocessor, disabled unless initialize_image_preprocessing() is called
+image_preprocessor = None
+
+def initialize_image_preprocessing(cache_dir="./outputs/image_preprocessed", max_side=1536, image_format="JPEG",
+                                   quality=85, keep_line_art_lossless=True, max_workers=None):
+    """Enable downscaling and recompression of images before upload"""
+    global image_preprocessor
+    image_preprocessor = ImagePreprocessor(
+        cache_dir, max_side=max_side, image_format=image_format, quality=quality,
+        keep_line_art_lossless=keep_line_art_lossless, max_workers=max_workers
+    )
+    logger.info(f"Image preprocessing enabled (max side {max_side}px, {image_format} q{quality}), cached in {cache_dir}")
+
+def _read_and_encode(image_path):
+    if image_preprocessor is not None:
+        image_path = image_preprocessor.process(image_path)
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
 
-def inference_one_step(prompt, base64_images, model):
-    """Perform inference with the given prompt and images"""
+def encode_image(image_path):
+    """Encode image to base64 string, reusing earlier encodings of the same file"""
+    variant = image_preprocessor.signature if image_preprocessor is not None else ""
+    return image_cache.get(image_path, _read_and_encode, variant)
+
+# Leading base64 characters of common image file signatures
+_BASE64_MIME_PREFIXES = (
+    ("iVBORw0KGgo", "image/png"),
+    ("/9j/", "image/jpeg"),
+    ("UklGR", "image/webp"),
+    ("R0lGOD", "image/gif"),
+)
+
+def image_mime_type(base64_image):
+    """Detect the MIME type of a base64-encoded image from its file signature"""
+    for prefix, mime_type in _BASE64_MIME_PREFIXES:
+        if base64_image.startswith(prefix):
+            return mime_type
+    return "image/png"
+
+def build_messages(prompt, base64_images):
+    """
+    Build the chat messages for a prompt and its images.
+
+    A (system, user) prompt such as prompt.ChatPrompt puts its static part in
+    a leading system message, so the start of every request of a stage is
+    byte-identical and can be served from the provider's prefix cache. The
+    images follow the user text.
+    """
+    system, prompt = split_prompt(prompt)
+    messages = [{"role": "system", "content": system}] if system else []
+    return messages + [
+        {
+            "role": "user",
+            "content": [{
+                "type": "text",
+                "text": prompt
+            }] + [{
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{image_mime_type(base64_image)};base64,{base64_image}"
+                },
+            } for base64_image in base64_images]
+        },
+    ]
+
+def lookup_cached_response(model, prompt, base64_images, sampling_params, sample=0):
+    """
+    Return (cache_key, cached_content); both are None without a response cache.
+
+    Independent samples of the same request (see self_consistency.py) are
+    cached separately by their `sample` number; sample 0 is the plain request.
+    """
+    if response_cache is None:
+        return None, None
+    key_params = {**sampling_params, '_sample': sample} if sample else sampling_params
+    cache_key = response_cache.make_key(model, prompt, base64_images, key_params)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        metrics.record_call(model, status="cache_hit")
+    return cache_key, cached
+
+def finish_completion(model, response, latency, limiter, estimated_tokens, cache_key):
+    """Account for a successful completion and return its text"""
+    usage = getattr(response, 'usage', None)
+    limiter.release(estimated_tokens, used_tokens=getattr(usage, 'total_tokens', None))
+    metrics.record_call(model, latency, usage=usage)
+    content = response.choices[0].message.content
+    if cache_key is not None:
+        response_cache.put(cache_key, content)
+    return content
+
+def inference_one_step(prompt, base64_images, model, sample=0, **sampling_params):
+    """Perform inference with the given prompt and images, served from the response cache when possible"""
+    cache_key, cached = lookup_cached_response(model, prompt, base64_images, sampling_params, sample)
+    if cached is not None:
+        return cached
+    return request_completion(prompt, base64_images, model, cache_key, sampling_params)
+
+def request_completion(prompt, base64_images, model, cache_key, sampling_params):
+    """Make one chat completion request, through the model's endpoint pool if it has one, else the global client"""
+    pool = endpoint_pools.get(model)
+    if pool is not None:
+        return pool.run(lambda endpoint: send_completion(
+            endpoint.client, endpoint.limiter, prompt, base64_images, model, cache_key, sampling_params,
+            endpoint.model_name))
     if client is None:
         raise ValueError("Client not initialized. Call initialize_client() first.")
-    
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {
-                "role": "user",
-                "content": [{
-                    "type": "text",
-                    "text": prompt
-                }] + [{
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/png;base64,{base64_image}"
-                    },
-                } for base64_image in base64_images]
-            },
-        ],
-    )
-    return response.choices[0].message.content
+    return send_completion(client, get_rate_limiter(model), prompt, base64_images, model, cache_key, sampling_params)
+
+def send_completion(api_client, limiter, prompt, base64_images, model, cache_key, sampling_params, model_name=None):
+    """
+    Send one chat completion request with `api_client`, rate limited and recorded in the call metrics.
+
+    With a hedging policy, the request is hedged once its rate limit slot is
+    acquired, so time spent waiting for the limiter never triggers a
+    duplicate; the duplicate waits for a slot of its own.
+    """
+    estimated_tokens = estimate_request_tokens(prompt, base64_images)
+    limiter.acquire(estimated_tokens)
+
+    def call(hedge=False):
+        if hedge:
+            limiter.acquire(estimated_tokens)
+        with connection_trace():
+            started = time.perf_counter()
+            try:
+                response = api_client.chat.completions.create(
+                    model=model_name or model,
+                    messages=build_messages(prompt, base64_images),
+                    **sampling_params
+                )
+            except Exception as e:
+                limiter.release(estimated_tokens, error=e)
+                metrics.record_call(model, time.perf_counter() - started, error=e)
+                raise
+            latency = time.perf_counter() - started
+            if hedge_policy is not None:
+                hedge_policy.observe(model, latency)
+            return finish_completion(model, response, latency, limiter, estimated_tokens, cache_key)
+
+    if hedge_policy is not None:
+        return hedge_policy.run(call, model)
+    return call()
+
+async def ainference_one_step(prompt, base64_images, model, sample=0, **sampling_params):
+    """Async counterpart of inference_one_step, using the async client"""
+    cache_key, cached = lookup_cached_response(model, prompt, base64_images, sampling_params, sample)
+    if cached is not None:
+        return cached
+    return await arequest_completion(prompt, base64_images, model, cache_key, sampling_params)
+
+async def arequest_completion(prompt, base64_images, model, cache_key, sampling_params):
+    """Async counterpart of request_completion, using the async clients"""
+    pool = endpoint_pools.get(model)
+    if pool is not None:
+        return await pool.arun(lambda endpoint: asend_completion(
+            endpoint.async_client, endpoint.limiter, prompt, base64_images, model, cache_key, sampling_params,
+            endpoint.model_name))
+    if async_client is None:
+        raise ValueError("Client not initialized. Call initialize_client() first.")
+    return await asend_completion(async_client, get_rate_limiter(model), prompt, base64_images, model, cache_key,
+                                  sampling_params)
+
+async def asend_completion(api_client, limiter, prompt, base64_images, model, cache_key, sampling_params,
+                           model_name=None):
+    """Async counterpart of send_completion; a cancelled request gives its rate limit slot back"""
+    estimated_tokens = estimate_request_tokens(prompt, base64_images)
+    await limiter.aacquire(estimated_tokens)
+
+    async def call(hedge=False):
+        if hedge:
+            await limiter.aacquire(estimated_tokens)
+        with connection_trace():
+            started = time.perf_counter()
+            try:
+                response = await api_client.chat.completions.create(
+                    model=model_name or model,
+                    messages=build_messages(prompt, base64_images),
+                    **sampling_params
+                )
+            except asyncio.CancelledError as e:
+                limiter.release(estimated_tokens, error=e)
+                raise
+            except Exception as e:
+                limiter.release(estimated_tokens, error=e)
+                metrics.record_call(model, time.perf_counter() - started, error=e)
+                raise
+            latency = time.perf_counter() - started
+            if hedge_policy is not None:
+                hedge_policy.observe(model, latency)
+            return finish_completion(model, response, latency, limiter, estimated_tokens, cache_key)
+
+    if hedge_policy is not None:
+        return await hedge_policy.arun(call, model)
+    return await call()
+
+def stage_name(output_field):
+    """Metrics stage name for a caption/prediction output field"""
+    return "caption" if output_field == "description" else output_field
+
+def build_item_request(item, img_root, prompt_builder, output_field):
+    """Build the prompt and encoded images for a caption or prediction item"""
+    # Handle different input structures for caption vs prediction
+    if output_field == "description":
+        # For caption: item has 'question' and 'image_path'
+        question, image_paths = item['question'], item['image_path']
+        prompt = prompt_builder(question)
+    else:
+        # For prediction: item has 'image_path' and prompt is built from full item
+        image_paths = item['image_path']
+        prompt = prompt_builder(item)
 
-def process_item_generic(item, img_root, model, prompt_builder, output_field, max_retries=5, retry_delay=2):
+    base64_images = [encode_image(os.path.join(img_root, img_path)) for img_path in image_paths]
+    return prompt, base64_images
+
+def process_item_generic(item, img_root, model, prompt_builder, output_field, max_retries=5, retry_delay=2, sample=0):
     """
     Generic process_item function that can be used for both caption and prediction tasks.
     
@@ -79,34 +1455,28 @@ def process_item_generic(item, img_root, model, prompt_builder, output_field, ma
         output_field: Field name for the output (e.g., "description" or "prediction")
         max_retries: Maximum number of retries
         retry_delay: Delay between retries
+        sample: Sample number, so repeated samples of an item are cached separately
     """
     index = item['index']
 
     try:
-        # Handle different input structures for caption vs prediction
-        if output_field == "description":
-            # For caption: item has 'question' and 'image_path'
-            question, image_paths = item['question'], item['image_path']
-            prompt = prompt_builder(question)
-        else:
-            # For prediction: item has 'image_path' and prompt is built from full item
-            image_paths = item['image_path']
-            prompt = prompt_builder(item)
-        
-        base64_images = [encode_image(os.path.join(img_root, img_path)) for img_path in image_paths]
+        prompt, base64_images = build_item_request(item, img_root, prompt_builder, output_field)
 
         attempt = 0
         response_content = None
 
         while attempt < max_retries:
             try:
-                response_content = inference_one_step(prompt, base64_images, model)
+                with call_context(stage=stage_name(output_field), index=index, attempt=attempt + 1):
+                    response_content = inference_one_step(prompt, base64_images, model, sample)
                 break  # Success
+            except CacheMissError:
+                raise
             except Exception as e:
                 attempt += 1
                 logger.error(f"Index {index} | Attempt {attempt}/{max_retries} failed: {e}")
                 if attempt < max_retries:
-                    time.sleep(retry_delay * attempt)  # Exponential backoff
+                    time.sleep(backoff_delay(attempt, retry_delay, error=e))
                 else:
                     logger.error(f"Index {index} | Max retries reached. Marking as error.")
                     response_content = f"ERROR: Max retries reached - {e}"
@@ -114,11 +1484,574 @@ def process_item_generic(item, img_root, model, prompt_builder, output_field, ma
         # Return a new dictionary with the original item's data plus the new output
         return {**item, output_field: response_content}
 
+    except CacheMissError:
+        # Replay mode: leave the item without a result instead of storing an error row
+        raise
     except Exception as e:
         logger.error(f"FATAL error processing item with index {index}: {e}", exc_info=True)
         # Return a structured error record, preserving the original item data
         return {**item, output_field: f"ERROR: Unrecoverable failure in processing pipeline: {e}"}
 
+async def aprocess_item_generic(item, img_root, model, prompt_builder, output_field, semaphore, max_retries=5, retry_delay=2):
+    """
+    Async counterpart of process_item_generic.
+
+    Building the request and the API call hold a slot of `semaphore`, so encoded
+    images only exist for items in flight. Image encoding runs in a worker
+    thread, and retry waits do not count against the in-flight limit.
+    """
+    index = item['index']
+
+    try:
+        request = None
+        attempt = 0
+        response_content = None
+
+        while attempt < max_retries:
+            async with semaphore:
+                if request is None:
+                    request = await asyncio.to_thread(build_item_request, item, img_root, prompt_builder, output_field)
+                prompt, base64_images = request
+                try:
+                    with call_context(stage=stage_name(output_field), index=index, attempt=attempt + 1):
+                        response_content = await ainference_one_step(prompt, base64_images, model)
+                    break  # Success
+                except CacheMissError:
+                    raise
+                except Exception as e:
+                    attempt += 1
+                    error = e
+                    logger.error(f"Index {index} | Attempt {attempt}/{max_retries} failed: {e}")
+            if attempt < max_retries:
+                await asyncio.sleep(backoff_delay(attempt, retry_delay, error=error))
+            else:
+                logger.error(f"Index {index} | Max retries reached. Marking as error.")
+                response_content = f"ERROR: Max retries reached - {error}"
+
+        return {**item, output_field: response_content}
+
+    except CacheMissError:
+        # Replay mode: leave the item without a result instead of storing an error row
+        raise
+    except Exception as e:
+        logger.error(f"FATAL error processing item with index {index}: {e}", exc_info=True)
+        return {**item, output_field: f"ERROR: Unrecoverable failure in processing pipeline: {e}"}
+
+class JsonlCheckpoint:
+    """
+    Append-only JSONL result store that backs a JSON output file, keyed by 'index'.
+
+    Every result is written as one line as soon as it is available, with its
+    'index' as the first key. Appending a record for an index that is already
+    stored upserts it: the later line wins. A sidecar offset index
+    (`<log>.idx`) maps each index to the byte offset of its latest line and
+    whether that record failed, so reopening the store reads the sidecar and
+    only the lines appended after it, instead of re-parsing the whole log.
+    Lines are flushed and fsynced every `flush_every` appends. Appending is
+    thread-safe.
+    `compact()` turns the log into the sorted JSON array the downstream
+    scripts read, and records the log size it covered and the size and
+    mtime of the JSON it wrote in `<log>.compacted`, so later runs can tell
+    whether the JSON is behind the log or was edited by hand.
+
+    A record counts as failed when it has an 'error' key or, if
+    `output_field` is given, when that field is missing or holds an "ERROR:"
+    sentinel.
+    """
+
+    _INDEX_RE = re.compile(r'^\{"index": (-?\d+)[,}]')
+    _SIDECAR_VERSION = 1
+
+    def __init__(self, path, flush_every=20, output_field=None):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.compaction_path = path + '.compacted'
+        self.flush_every = max(1, flush_every)
+        self.output_field = output_field
+        self._file = None
+        self._index_file = None
+        self._pending = 0
+        # index -> (byte offset of its latest line, failed); loaded on first use
+        self._entries = None
+        self._end = 0
+        # Appends may come from several worker threads
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, index):
+        with self._lock:
+            self._load_locked()
+            return index in self._entries
+
+    def __len__(self):
+        with self._lock:
+            self._load_locked()
+            return len(self._entries)
+
+    def is_failed(self, record):
+        if 'error' in record:
+            return True
+        if self.output_field is None:
+            return False
+        value = record.get(self.output_field)
+        return not value or str(value).startswith('ERROR:')
+
+    def _sidecar_header(self):
+        return json.dumps({'version': self._SIDECAR_VERSION, 'output_field': self.output_field}) + '\n'
+
+    @staticmethod
+    def _sidecar_entry(index, offset, length, failed):
+        return f"{json.dumps(index)}\t{offset}\t{length}\t{int(failed)}\n".encode('utf-8')
+
+    def _read_sidecar(self, log_size):
+        """Load sidecar entries that match the log; return False when it must be rebuilt."""
+        if not exists(self.index_path):
+            return False
+        with open(self.index_path, 'rb') as f:
+            if f.readline().decode('utf-8', errors='replace') != self._sidecar_header():
+                return False
+            valid_end = f.tell()
+            last = None
+            for raw in f:
+                parts = raw.split(b'\t')
+                if not raw.endswith(b'\n') or len(parts) != 4:
+                    break  # torn final entry
+                index = int(parts[0]) if parts[0].lstrip(b'-').isdigit() else json.loads(parts[0])
+                offset, length = int(parts[1]), int(parts[2])
+                if offset + length > log_size:
+                    break  # the log line behind this entry never reached the disk
+                self._entries[index] = (offset, parts[3].strip() == b'1')
+                if offset + length > self._end:
+                    self._end, last = offset + length, (index, offset)
+                valid_end += len(raw)
+        # The latest entry must still point at its record, or the log was replaced
+        if last is not None:
+            with open(self.path, 'rb') as log:
+                log.seek(last[1])
+                if self._index_of(log.readline().decode('utf-8', errors='replace')) != last[0]:
+                    return False
+        if valid_end < os.path.getsize(self.index_path):
+            with open(self.index_path, 'r+b') as f:
+                f.truncate(valid_end)
+        return True
+
+    def _load_locked(self):
+        if self._entries is not None:
+            return
+        self._entries, self._end = {}, 0
+        log_size = os.path.getsize(self.path) if exists(self.path) else 0
+        if not self._read_sidecar(log_size):
+            self._entries, self._end = {}, 0
+            with open(self.index_path, 'wb') as f:
+                f.write(self._sidecar_header().encode('utf-8'))
+
+        # Index the lines appended after the sidecar was last written
+        new_entries = []
+        if self._end < log_size:
+            with open(self.path, 'rb') as log:
+                log.seek(self._end)
+                for raw in log:
+                    if not raw.endswith(b'\n'):
+                        break  # a torn final line from a crash mid-write; the item will be redone
+                    try:
+                        record = json.loads(raw)
+                    except json.JSONDecodeError:
+                        record = None
+                    if isinstance(record, dict) and record.get('index') is not None:
+                        failed = self.is_failed(record)
+                        self._entries[record['index']] = (self._end, failed)
+                        new_entries.append(self._sidecar_entry(record['index'], self._end, len(raw), failed))
+                    self._end += len(raw)
+            if self._end < log_size:
+                # Drop the torn tail so the next append starts on a fresh line
+                with open(self.path, 'r+b') as log:
+                    log.truncate(self._end)
+        if new_entries:
+            with open(self.index_path, 'ab') as f:
+                f.writelines(new_entries)
+
+    def _index_of(self, line):
+        match = self._INDEX_RE.match(line)
+        if match:
+            return int(match.group(1))
+        try:
+            return json.loads(line).get('index')
+        except json.JSONDecodeError:
+            return None
+
+    def scan_offsets(self):
+        """Map each index in the store to the byte offset of its latest record."""
+        with self._lock:
+            self._load_locked()
+            return {index: offset for index, (offset, _) in self._entries.items()}
+
+    def scan_indices(self):
+        """Return the set of indices already recorded in the store."""
+        with self._lock:
+            self._load_locked()
+            return set(self._entries)
+
+    def completed_indices(self):
+        """Return the indices whose latest record did not fail."""
+        with self._lock:
+            self._load_locked()
+            return {index for index, (_, failed) in self._entries.items() if not failed}
+
+    def failed_indices(self):
+        """Return the indices whose latest record failed."""
+        with self._lock:
+            self._load_locked()
+            return {index for index, (_, failed) in self._entries.items() if failed}
+
+    def get(self, index):
+        """Return the latest record stored for `index`, or None."""
+        with self._lock:
+            self._load_locked()
+            self._flush_locked()
+            entry = self._entries.get(index)
+        if entry is None:
+            return None
+        with open(self.path, 'rb') as log:
+            log.seek(entry[0])
+            return json.loads(log.readline())
+
+    def append(self, record):
+        """Store `record`, replacing any earlier record with the same 'index'."""
+        index = record.get('index')
+        data = (json.dumps({'index': index, **record}, ensure_ascii=False) + '\n').encode('utf-8')
+        failed = self.is_failed(record)
+        with self._lock:
+            self._load_locked()
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+                self._index_file = open(self.index_path, 'ab')
+            self._file.write(data)
+            self._index_file.write(self._sidecar_entry(index, self._end, len(data), failed))
+            self._entries[index] = (self._end, failed)
+            self._end += len(data)
+            self._pending += 1
+            if self._pending >= self.flush_every:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if self._file is not None and self._pending:
+            # The log is synced before its sidecar entries, which are checked against it on load
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._index_file.flush()
+            self._pending = 0
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            if self._file is not None:
+                self._file.close()
+                self._index_file.close()
+                self._file = self._index_file = None
+
+    def seed_from_json(self, json_path):
+        """Rebuild the store from an existing JSON array output."""
+        self.close()
+        with open(json_path, 'r', encoding='utf-8') as f:
+            records = json.load(f)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for record in records:
+                if isinstance(record, dict) and 'index' in record:
+                    f.write(json.dumps({'index': record['index'], **record}, ensure_ascii=False) + '\n')
+        # The offset index and the compaction record no longer match; the index is rebuilt on next use
+        with self._lock:
+            self._entries = None
+            for path in (self.index_path, self.compaction_path):
+                if exists(path):
+                    os.remove(path)
+        return len(records)
+
+    def iter_records(self):
+        """Yield the latest record for each index, in 'index' order."""
+        offsets = self.scan_offsets()
+        self.flush()
+        if not offsets:
+            return
+        with open(self.path, 'rb') as log:
+            for index in sorted(offsets):
+                log.seek(offsets[index])
+                yield json.loads(log.readline())
+
+    def compact(self, output_path):
+        """Atomically write the deduplicated log as a JSON array sorted by 'index'."""
+        with self._lock:
+            self._load_locked()
+            self._flush_locked()
+            # Records appended while compacting may or may not make it in; a
+            # later staleness check then errs on the side of compacting again
+            covered_size = self._end
+        tmp_path = output_path + '.tmp'
+        total = 0
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            out.write('[')
+            for record in self.iter_records():
+                body = textwrap.indent(json.dumps(record, ensure_ascii=False, indent=4), '    ')
+                out.write((',\n' if total else '\n') + body)
+                total += 1
+            out.write('\n]' if total else ']')
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, output_path)
+        self._record_compaction(output_path, covered_size)
+        return total
+
+    def _record_compaction(self, output_path, log_size):
+        stat = os.stat(output_path)
+        state = {'output': os.path.basename(output_path), 'log_size': log_size,
+                 'output_size': stat.st_size, 'output_mtime_ns': stat.st_mtime_ns}
+        tmp_path = self.compaction_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.compaction_path)
+
+    def compaction_state(self, output_path):
+        """
+        The record of the last compaction into `output_path`, or None without one.
+
+        Its 'output_matches' is False when `output_path` changed since then.
+        """
+        if not exists(self.compaction_path):
+            return None
+        try:
+            with open(self.compaction_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if state.get('output') != os.path.basename(output_path):
+            return None
+        stat = os.stat(output_path) if exists(output_path) else None
+        state['output_matches'] = stat is not None and stat.st_size == state.get('output_size') \
+            and stat.st_mtime_ns == state.get('output_mtime_ns')
+        return state
+
+def checkpoint_path_for(output_path):
+    """Return the JSONL log path used to checkpoint `output_path`."""
+    return os.path.splitext(output_path)[0] + '.jsonl'
+
+def open_checkpoint(output_path, flush_every=20, output_field=None):
+    """
+    Open the JSONL checkpoint backing `output_path`.
+
+    The log is the source of truth. An output JSON without a log (or edited by
+    hand after the last compaction) is imported into the log first.
+    `output_field` is the field the stage produces, used to tell failed
+    records from finished ones.
+    """
+    checkpoint = JsonlCheckpoint(checkpoint_path_for(output_path), flush_every=flush_every,
+                                 output_field=output_field)
+    if exists(output_path) and (not exists(checkpoint.path) or output_edited(checkpoint, output_path)):
+        try:
+            seeded = checkpoint.seed_from_json(output_path)
+            logger.info(f"Imported {seeded} existing results from {output_path} into {checkpoint.path}.")
+        except json.JSONDecodeError:
+            logger.warning(f"Output file {output_path} is corrupted. Ignoring it.")
+    return checkpoint
+
+def output_edited(checkpoint, output_path):
+    """True when `output_path` was changed after the checkpoint last compacted into it."""
+    state = checkpoint.compaction_state(output_path)
+    if state is None:
+        # Logs compacted before compaction records existed: compare modification times
+        return os.path.getmtime(output_path) > os.path.getmtime(checkpoint.path)
+    return not state['output_matches']
+
+def checkpoint_is_stale(checkpoint, output_path):
+    """True when the log holds results that are not yet compacted into `output_path`."""
+    if not exists(checkpoint.path):
+        return False
+    if not exists(output_path):
+        return True
+    state = checkpoint.compaction_state(output_path)
+    if state is None or not state['output_matches']:
+        return os.path.getmtime(checkpoint.path) > os.path.getmtime(output_path)
+    return os.path.getsize(checkpoint.path) != state['log_size']
+
+def iter_json_items(path, chunk_size=1 << 20):
+    """
+    Yield the items of a JSON array file, or of a JSONL file, one at a time.
+
+    The array is decoded incrementally from `chunk_size` reads, so memory is
+    bounded by the largest single item rather than by the file. A file whose
+    first non-blank character is not '[' is read as JSONL.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        buffer = f.read(chunk_size)
+        while buffer and not buffer.strip():
+            buffer = f.read(chunk_size)
+        if not buffer:
+            return
+        if not buffer.lstrip().startswith('['):
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        pos = buffer.index('[') + 1
+        eof = False
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ','):
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            # Only decode once the item is complete and followed by more input
+            try:
+                if pos >= len(buffer):
+                    raise json.JSONDecodeError("Unterminated array", buffer, pos)
+                item, end = decoder.raw_decode(buffer, pos)
+                # A number cut by the chunk boundary decodes as a shorter number ("1." -> 1),
+                # so bare scalars are only complete once a delimiter follows them
+                if not eof and (end == len(buffer) or (not isinstance(item, (dict, list, str))
+                                                       and buffer[end] not in ' \t\r\n,]')):
+                    raise json.JSONDecodeError("Item may continue in the next chunk", buffer, end)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+            pos = end
+
+def count_json_items(path, skip_indices=()):
+    """Count the items of a JSON/JSONL file, and how many of them are not in `skip_indices`."""
+    total = remaining = 0
+    for item in iter_json_items(path):
+        total += 1
+        if item.get('index') not in skip_indices:
+            remaining += 1
+    return total, remaining
+
+def select_json_items(path, indices, exclude=True):
+    """
+    Plan a streaming pass over the items of `path` whose 'index' is not in
+    `indices` (or, with `exclude=False`, only those whose index is).
+
+    Returns (total, selected, items), where `items` lazily yields the selected
+    items from a fresh read of the file.
+    """
+    total, outside = count_json_items(path, indices)
+    selected = outside if exclude else total - outside
+    items = (item for item in iter_json_items(path) if (item.get('index') in indices) != exclude)
+    return total, selected, items
+
+def iter_completed(executor, fn, items, max_pending):
+    """
+    Submit `fn(item)` lazily, keeping at most `max_pending` unfinished, and
+    yield (item, future) pairs as they complete.
+    """
+    items = iter(items)
+    pending = {}
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < max_pending:
+            item = next(items, None)
+            if item is None:
+                exhausted = True
+                break
+            pending[executor.submit(fn, item)] = item
+        if not pending:
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield pending.pop(future), future
+
+async def aiter_completed(coroutine_fn, items, max_pending):
+    """Async counterpart of iter_completed, running `coroutine_fn(item)` as tasks."""
+    items = iter(items)
+    pending = {}
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < max_pending:
+            item = next(items, None)
+            if item is None:
+                exhausted = True
+                break
+            pending[asyncio.create_task(coroutine_fn(item))] = item
+        if not pending:
+            return
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield pending.pop(task), task
+
+def prepare_resume(json_path, output_path, flush_every=20, output_field=None, retry_failed=False):
+    """
+    Open the checkpoint for `output_path` and plan the items left to process.
+
+    Items with any stored result, failed or not, count as done. With
+    `retry_failed`, only the items whose stored result failed (an "ERROR:"
+    sentinel in `output_field`) are planned instead.
+
+    Returns (checkpoint, items_to_process, remaining), where `items_to_process`
+    lazily streams the planned items from `json_path`, or None when the
+    input cannot be read or there is nothing to do.
+    """
+    # 1. Implement breakpoint resume capability.
+    checkpoint = open_checkpoint(output_path, flush_every, output_field)
+
+    # Use the 'index' key from the data to identify completed (or failed) items.
+    if retry_failed:
+        planned_indices = checkpoint.failed_indices()
+    else:
+        planned_indices = {index for index in checkpoint.scan_indices() if isinstance(index, int)}
+
+    # 2. Count the planned items in a streaming pass; the input is never fully loaded.
+    # Assumes the input is a JSON array (or JSONL) of objects, each with a unique 'index' key.
+    try:
+        total, remaining, items_to_process = select_json_items(json_path, planned_indices, exclude=not retry_failed)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        logger.error(f"Failed to load or parse input file {json_path}: {e}")
+        return None
+
+    if not remaining:
+        if checkpoint_is_stale(checkpoint, output_path):
+            # A previous run finished every item but stopped before compacting.
+            checkpoint.compact(output_path)
+        if retry_failed:
+            logger.info("No failed items to retry according to the output file. Exiting.")
+        else:
+            logger.info("All items have been processed according to the output file. Exiting.")
+        return None
+
+    logger.info(f"Total items in dataset: {total}")
+    if retry_failed:
+        logger.info(f"Failed items to retry: {remaining}")
+    else:
+        logger.info(f"Items already processed: {len(planned_indices)}")
+        logger.info(f"Items remaining to process: {remaining}")
+
+    return checkpoint, items_to_process, remaining
+
+def finalize_checkpoint(checkpoint, output_path, new_count):
+    """Compact the checkpoint into the sorted JSON output if anything new was written."""
+    if new_count:
+        total = checkpoint.compact(output_path)
+        logger.info(f"Processing complete. Saved {total} total items to {output_path}.")
+        logger.info(f"Call metrics for this run:\n{metrics_report()}")
+        if hedge_policy is not None:
+            logger.info(hedge_policy.report())
+        for pool in endpoint_pools.values():
+            logger.info(pool.report())
+    else:
+        logger.info("No new items were processed in this run.")
+
 def run_inference_concurrent(
     json_path,
     output_path,
@@ -126,10 +2059,19 @@ def run_inference_concurrent(
     model='gpt-4o',
     max_workers=4,
     prompt_builder=None,
-    output_field="description"
+    output_field="description",
+    flush_every=20,
+    retry_failed=False,
+    max_retries=5,
+    retry_delay=2
 ):
     """
     Generic inference function that can be used for both caption and prediction tasks.
+
+    Results are streamed to a JSONL checkpoint next to `output_path` as soon as
+    each item finishes, and compacted into the sorted JSON array at the end.
+    With `retry_failed`, only items whose output holds an "ERROR:" sentinel
+    are re-run, and their new results replace the failed rows in place.
     
     Args:
         json_path: Path to input JSON file
@@ -139,64 +2081,315 @@ def run_inference_concurrent(
         max_workers: Number of concurrent workers
         prompt_builder: Function to build prompts
         output_field: Field name for output (e.g., "description" or "prediction")
+        flush_every: Number of appended results between fsyncs of the checkpoint
+        retry_failed: Re-run only the items whose stored result failed
+        max_retries: Attempts per item before it is stored as failed
+        retry_delay: Base delay in seconds for the backoff between attempts
     """
-    # 1. Load the full dataset.
-    # Assumes the input JSON is a list of objects, each with a unique 'index' key.
-    try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            full_dataset = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        logger.error(f"Failed to load or parse input file {json_path}: {e}")
+    prepared = prepare_resume(json_path, output_path, flush_every, output_field, retry_failed)
+    if prepared is None:
         return
+    checkpoint, items_to_process, remaining = prepared
 
-    # 2. Implement breakpoint resume capability.
-    existing_results = []
-    if exists(output_path):
-        try:
-            with open(output_path, 'r', encoding='utf-8') as f:
-                existing_results = json.load(f)
-        except json.JSONDecodeError:
-            logger.warning(f"Output file {output_path} is corrupted. Starting fresh.")
+    # 3. Process remaining items concurrently, appending each result as it completes.
+    # Items are read and submitted lazily, so only about 2 * max_workers are held at once.
+    def process(item):
+        return process_item_generic(item, img_root, model, prompt_builder, output_field, max_retries, retry_delay)
 
-    # Use the 'index' key from the data to identify completed items.
-    completed_indices = {item.get('index') for item in existing_results if isinstance(item.get('index'), int)}
-    items_to_process = [item for item in full_dataset if item.get('index') not in completed_indices]
+    new_count = 0
+    with checkpoint, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        progress = tqdm(iter_completed(executor, process, items_to_process, 2 * max_workers),
+                        total=remaining, desc="Processing Items")
+        for item, future in progress:
+            try:
+                result = future.result()
+                if result:
+                    checkpoint.append(result)
+                    new_count += 1
+                progress.set_postfix(metrics.live_counters(stage_name(output_field)), refresh=False)
+            except CacheMissError as e:
+                logger.warning(f"Skipping index {item.get('index')}: {e}")
+            except Exception as e:
+                logger.error(f"A task for index {item.get('index')} raised an unhandled exception: {e}")
 
-    if not items_to_process:
-        logger.info("All items have been processed according to the output file. Exiting.")
+    # 4. Compact the checkpoint into the sorted JSON output.
+    finalize_checkpoint(checkpoint, output_path, new_count)
+
+async def arun_inference_concurrent(
+    json_path,
+    output_path,
+    img_root,
+    model='gpt-4o',
+    max_in_flight=64,
+    prompt_builder=None,
+    output_field="description",
+    flush_every=20,
+    retry_failed=False,
+    max_retries=5,
+    retry_delay=2
+):
+    """
+    Asyncio counterpart of run_inference_concurrent.
+
+    Requests are issued with the async client from a single thread, and the
+    number of requests in flight is bounded by a semaphore instead of by a
+    thread pool. Resume, checkpointing and the final output are identical to
+    run_inference_concurrent. Run it with `asyncio.run(...)`.
+
+    Args:
+        json_path: Path to input JSON file
+        output_path: Path to output JSON file
+        img_root: Root directory for images
+        model: Model name to use
+        max_in_flight: Maximum number of concurrent API requests
+        prompt_builder: Function to build prompts
+        output_field: Field name for output (e.g., "description" or "prediction")
+        flush_every: Number of appended results between fsyncs of the checkpoint
+        retry_failed: Re-run only the items whose stored result failed
+        max_retries: Attempts per item before it is stored as failed
+        retry_delay: Base delay in seconds for the backoff between attempts
+    """
+    prepared = prepare_resume(json_path, output_path, flush_every, output_field, retry_failed)
+    if prepared is None:
         return
+    checkpoint, items_to_process, remaining = prepared
 
-    logger.info(f"Total items in dataset: {len(full_dataset)}")
-    logger.info(f"Items already processed: {len(completed_indices)}")
-    logger.info(f"Items remaining to process: {len(items_to_process)}")
+    semaphore = asyncio.Semaphore(max_in_flight)
 
-    # 3. Process remaining items concurrently.
-    new_results = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_item = {
-            executor.submit(process_item_generic, item, img_root, model, prompt_builder, output_field): item 
-            for item in items_to_process
-        }
+    def process(item):
+        return aprocess_item_generic(item, img_root, model, prompt_builder, output_field, semaphore,
+                                     max_retries, retry_delay)
 
-        progress = tqdm(as_completed(future_to_item), total=len(items_to_process), desc="Processing Items")
-        for future in progress:
+    # Tasks are created lazily, so only about 2 * max_in_flight items are held at once.
+    new_count = 0
+    with checkpoint:
+        progress = tqdm(total=remaining, desc="Processing Items")
+        async for item, task in aiter_completed(process, items_to_process, 2 * max_in_flight):
+            progress.update(1)
             try:
-                result = future.result()
+                result = task.result()
                 if result:
-                    new_results.append(result)
+                    checkpoint.append(result)
+                    new_count += 1
+                progress.set_postfix(metrics.live_counters(stage_name(output_field)), refresh=False)
+            except CacheMissError as e:
+                logger.warning(f"Skipping index {item.get('index')}: {e}")
             except Exception as e:
-                item = future_to_item[future]
                 logger.error(f"A task for index {item.get('index')} raised an unhandled exception: {e}")
+        progress.close()
+
+    finalize_checkpoint(checkpoint, output_path, new_count)
+
+# Batch API: terminal batch states and the chat completions endpoint requests are sent to
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+BATCH_ENDPOINT = "/v1/chat/completions"
+# File and batch status calls have no retry loop of their own, so they keep the SDK's retries
+BATCH_API_MAX_RETRIES = 2
+
+def batch_state_path_for(output_path):
+    """Return the file recording the submitted, not yet merged batches of `output_path`."""
+    return os.path.splitext(output_path)[0] + '.batches.json'
+
+def _save_batch_state(state_path, batches):
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(batches, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+def write_batch_inputs(items, output_path, img_root, model, prompt_builder, output_field, checkpoint,
+                       max_requests=50000, max_mb=190):
+    """
+    Write the chat requests of `items` to JSONL batch input files next to `output_path`.
+
+    A new file is started when one reaches `max_requests` requests or `max_mb`
+    megabytes (the Batch API limits are 50,000 and 200 MB). Items served by
+    the response cache and items whose request cannot be built are appended to
+    `checkpoint` directly. Returns one dict per file with its path, the item
+    indices it holds and their response cache keys.
+    """
+    stem = os.path.splitext(output_path)[0]
+    max_bytes = int(max_mb * 1024 * 1024)
+    files, handle, current = [], None, None
+
+    def close_current():
+        if handle is not None:
+            handle.close()
+            files.append(current)
+
+    for item in items:
+        index = item['index']
+        try:
+            prompt, base64_images = build_item_request(item, img_root, prompt_builder, output_field)
+            with call_context(stage=stage_name(output_field), index=index):
+                cache_key, cached = lookup_cached_response(model, prompt, base64_images, {})
+        except CacheMissError:
+            raise
+        except Exception as e:
+            logger.error(f"Index {index} | Could not build the batch request: {e}")
+            checkpoint.append({**item, output_field: f"ERROR: Unrecoverable failure in processing pipeline: {e}"})
+            continue
+        if cached is not None:
+            checkpoint.append({**item, output_field: cached})
+            continue
+
+        line = json.dumps({
+            "custom_id": str(index),
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": {"model": model, "messages": build_messages(prompt, base64_images)},
+        }, ensure_ascii=False).encode('utf-8') + b'\n'
+        if handle is not None and (len(current['indices']) >= max_requests or current['bytes'] + len(line) > max_bytes):
+            close_current()
+            handle = None
+        if handle is None:
+            current = {'path': f"{stem}.batch_{len(files) + 1}.jsonl", 'indices': [], 'cache_keys': {}, 'bytes': 0}
+            handle = open(current['path'], 'wb')
+        handle.write(line)
+        current['indices'].append(index)
+        current['bytes'] += len(line)
+        if cache_key is not None:
+            current['cache_keys'][str(index)] = cache_key
+    close_current()
+    return files
+
+def read_batch_results(batch, model, stage):
+    """
+    Download the output and error files of a finished batch.
+
+    Returns {custom_id: content or "ERROR: ..." sentinel}; every result is
+    recorded in the call metrics under `stage`.
+    """
+    api = client.with_options(max_retries=BATCH_API_MAX_RETRIES)
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in api.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            custom_id = record['custom_id']
+            response = record.get('response') or {}
+            with call_context(stage=stage, index=int(custom_id) if custom_id.isdigit() else custom_id):
+                if response.get('status_code') == 200:
+                    completion = ChatCompletion.model_validate(response['body'])
+                    metrics.record_call(model, usage=completion.usage)
+                    results[custom_id] = completion.choices[0].message.content
+                else:
+                    error = record.get('error') or (response.get('body') or {}).get('error') or {}
+                    message = f"{response.get('status_code', 'no response')} {error.get('message', error)}"
+                    metrics.record_call(model, error=RuntimeError(message))
+                    results[custom_id] = f"ERROR: Batch request failed - {message}"
+    return results
 
-    # 4. Merge, sort, and save results.
-    if new_results:
-        combined_results = existing_results + new_results
+def run_inference_batch(
+    json_path,
+    output_path,
+    img_root,
+    model='gpt-4o',
+    prompt_builder=None,
+    output_field="description",
+    flush_every=20,
+    retry_failed=False,
+    poll_interval=60,
+    max_batch_requests=50000,
+    max_batch_mb=190,
+    completion_window="24h"
+):
+    """
+    Batch API counterpart of run_inference_concurrent for offline runs.
 
-        # Sort by the pre-existing 'index' key to ensure original order.
-        combined_results.sort(key=lambda x: x.get('index', float('inf')))
+    The requests of the remaining items are written to JSONL batch input
+    files, uploaded and submitted as batches; the batches are polled every
+    `poll_interval` seconds and each finished batch is merged back by 'index'
+    into the checkpoint, so the output has the same format as the concurrent
+    runners. Requests the batch did not answer are stored with an "ERROR:"
+    sentinel and can be re-run with `retry_failed`. Submitted batches are
+    recorded next to `output_path` (see batch_state_path_for), so an
+    interrupted run resumes polling them instead of submitting again.
 
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(combined_results, f, ensure_ascii=False, indent=4)
-        logger.info(f"Processing complete. Saved {len(combined_results)} total items to {output_path}.")
+    Args:
+        json_path: Path to input JSON file
+        output_path: Path to output JSON file
+        img_root: Root directory for images
+        model: Model name to use
+        prompt_builder: Function to build prompts
+        output_field: Field name for output (e.g., "description" or "prediction")
+        flush_every: Number of appended results between fsyncs of the checkpoint
+        retry_failed: Submit only the items whose stored result failed
+        poll_interval: Seconds between batch status checks
+        max_batch_requests: Maximum requests per batch
+        max_batch_mb: Maximum size of a batch input file in megabytes
+        completion_window: Batch completion window
+    """
+    if client is None:
+        raise ValueError("Client not initialized. Call initialize_client() first.")
+
+    api = client.with_options(max_retries=BATCH_API_MAX_RETRIES)
+    state_path = batch_state_path_for(output_path)
+    batches = []
+    if os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            batches = json.load(f)
+    new_count = 0
+
+    if batches:
+        logger.info(f"Resuming {len(batches)} submitted batches from {state_path}; "
+                    f"items not yet submitted are picked up by the next run")
+        checkpoint = open_checkpoint(output_path, flush_every, output_field)
     else:
-        logger.info("No new items were processed in this run.")
\ No newline at end of file
+        prepared = prepare_resume(json_path, output_path, flush_every, output_field, retry_failed)
+        if prepared is None:
+            return
+        checkpoint, items_to_process, remaining = prepared
+        with checkpoint:
+            input_files = write_batch_inputs(items_to_process, output_path, img_root, model, prompt_builder,
+                                             output_field, checkpoint, max_batch_requests, max_batch_mb)
+        new_count += remaining - sum(len(input_file['indices']) for input_file in input_files)
+        if new_count:
+            logger.info(f"{new_count} items were answered from the response cache or failed before submission")
+
+        for input_file in input_files:
+            with open(input_file['path'], 'rb') as f:
+                uploaded = api.files.create(file=f, purpose="batch")
+            batch = api.batches.create(input_file_id=uploaded.id, endpoint=BATCH_ENDPOINT,
+                                          completion_window=completion_window)
+            logger.info(f"Submitted batch {batch.id} with {len(input_file['indices'])} requests")
+            batches.append({'id': batch.id, 'input_path': input_file['path'],
+                            'indices': input_file['indices'], 'cache_keys': input_file['cache_keys']})
+            _save_batch_state(state_path, batches)
+
+    stage = f"{stage_name(output_field)}_batch"
+    with checkpoint:
+        while batches:
+            for record in list(batches):
+                batch = api.batches.retrieve(record['id'])
+                if batch.status not in BATCH_FINAL_STATUSES:
+                    counts = batch.request_counts
+                    done = f"{counts.completed + counts.failed}/{counts.total}" if counts else "?"
+                    logger.info(f"Batch {batch.id} is {batch.status} ({done} requests done)")
+                    continue
+
+                results = read_batch_results(batch, model, stage)
+                logger.info(f"Batch {batch.id} {batch.status}: {len(results)}/{len(record['indices'])} results")
+                _, _, items = select_json_items(json_path, set(record['indices']), exclude=False)
+                for item in items:
+                    content = results.get(str(item['index']), f"ERROR: Batch {batch.status} without a result")
+                    if not content.startswith("ERROR:"):
+                        cache_key = record['cache_keys'].get(str(item['index']))
+                        if cache_key is not None:
+                            response_cache.put(cache_key, content)
+                    checkpoint.append({**item, output_field: content})
+                    new_count += 1
+                checkpoint.flush()
+
+                batches.remove(record)
+                _save_batch_state(state_path, batches)
+                if os.path.exists(record['input_path']):
+                    os.remove(record['input_path'])
+            if batches:
+                time.sleep(poll_interval)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+    finalize_checkpoint(checkpoint, output_path, new_count)